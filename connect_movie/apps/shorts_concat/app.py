@@ -1,18 +1,19 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
-import os, io, tempfile, shutil, subprocess
+import streamlit.components.v1 as components
+import os, sys, uuid
 from pathlib import Path
-from typing import List, Tuple
-
-# --- FFmpeg path via imageio-ffmpeg (works on Streamlit Cloud) ---
-def get_ffmpeg_exe() -> str:
-    try:
-        return imageio_ffmpeg.get_ffmpeg_exe()
-    except Exception:
-        # Fallback: hope system ffmpeg exists (local dev)
-        return "ffmpeg"
-
-import imageio_ffmpeg
+from dataclasses import astuple, replace
+from types import SimpleNamespace
+from typing import Callable, List, Optional
+
+# レンダリングは connect_movie/concat_engine（Streamlit 非依存）で行い、このアプリは入力と表示だけを受け持つ
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from concat_engine import (CLIP_TTL_SECONDS, CACHE_ROOT, ENCODER_SPECS, OUTPUT_TTL_SECONDS, RENDER_MODES,
+                           CaptionStyle, Clip, ClipStore, EncodeSettings, EncoderRegistry, Job, JobStatus, PreviewSettings,
+                           RenderResult, Scheduler, StageTimer, default_workers, encoder_registry, format_meta, format_usage,
+                           get_media_meta, has_ffmpeg, hls_player_html, new_output_dir, output_url, render_stills,
+                           serve_outputs, store_font)
 
 st.set_page_config(page_title="shorts動画作成", layout="wide")
 
@@ -25,61 +26,165 @@ st.markdown("""
 3. 「▶ プレビューを生成」でレイアウト確認 → 問題なければ「🎬 結合して書き出す」  
 """)
 
-# --------------- Utils ---------------
-def has_ffmpeg() -> bool:
-    try:
-        ff = get_ffmpeg_exe()
-        import subprocess
-        subprocess.run([ff, "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
-        return True
-    except Exception:
-        return False
-
-def ff_esc(text: str) -> str:
-    """Escape for ffmpeg drawtext. Keep explicit \\n for line breaks."""
-    if text is None:
-        return ""
-    t = text.replace("\\", r"\\\\")
-    t = t.replace(":", r"\:")
-    t = t.replace("'", r"\'")
-    t = t.replace("\n", r"\n")
-    return t
-
-def run_ffmpeg(cmd: List[str]) -> Tuple[bool, str]:
-    try:
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-        logs = []
-        for line in proc.stdout:
-            logs.append(line)
-        proc.wait()
-        ok = proc.returncode == 0
-        return ok, "".join(logs)
-    except Exception as e:
-        return False, f"Exception: {e}"
+# --------------- Engine glue ---------------
+def show_timings(timer: StageTimer, usage: Optional[dict] = None):
+    with st.expander("⏱ 処理時間の内訳"):
+        st.table([{"工程": name, "秒": round(sec, 2)} for name, sec in timer.rows])
+        if usage:
+            st.caption(format_usage(usage))
+
+@st.cache_resource
+def get_clip_store() -> ClipStore:
+    # プロセス内の全セッションで共有
+    return ClipStore(CACHE_ROOT / "clips" / "shorts", CLIP_TTL_SECONDS)
+
+@st.cache_resource
+def start_output_server() -> bool:
+    return serve_outputs()
+
+@st.cache_resource
+def get_encoders() -> EncoderRegistry:
+    # エンコーダは起動時に1回だけ検出する。速さの計測（マシンごとに最初の1回）は裏で進める
+    return encoder_registry()
+
+def preset_label(encoder: str, preset: str) -> str:
+    fps = get_encoders().fps(encoder, preset)
+    return f"{preset}（720p で約 {fps:.0f} fps）" if fps else preset
+
+@st.cache_resource
+def get_scheduler() -> Scheduler:
+    # プレビュー・書き出しはプロセス内の全セッションで1つのキューに並べ、CPU を分け合う
+    return Scheduler()
+
+def session_key() -> str:
+    if "session_key" not in st.session_state:
+        st.session_state["session_key"] = uuid.uuid4().hex
+    return st.session_state["session_key"]
+
+# プレビュー・書き出しはスケジューラのスレッドで動く。ジョブ ID をセッションと URL に控えておき、
+# 再実行（ウィジェット操作）やブラウザの再読み込みの後も同じジョブの進捗・結果を表示する
+JOB_LABELS = {"preview": "プレビュー", "export": "書き出し"}
+
+def submit_job(kind: str, job: Job, out_path: Path, **kwargs):
+    previous = current_job(kind)
+    if previous is not None and not previous.done:
+        get_scheduler().cancel(previous.id)  # 同じ種類の古いジョブは打ち切る
+    # クリップのファイルはジョブが終わるまで消さない（行を外しても待ち行列のジョブは最後まで動く）
+    job_id = get_scheduler().submit(session_key(), kind, job, out_path, clip_store=get_clip_store(),
+                                    workers=cfg.workers, use_part_cache=cfg.use_part_cache, **kwargs)
+    st.session_state[f"job_{kind}"] = job_id
+    st.query_params[f"job_{kind}"] = job_id
+
+def current_job(kind: str) -> Optional[JobStatus]:
+    job_id = st.session_state.get(f"job_{kind}") or st.query_params.get(f"job_{kind}")
+    if not job_id:
+        return None
+    status = get_scheduler().status(job_id)
+    if status is None:
+        # 期限切れ・サーバ再起動で消えたジョブ
+        st.session_state.pop(f"job_{kind}", None)
+        st.query_params.pop(f"job_{kind}", None)
+        return None
+    st.session_state[f"job_{kind}"] = job_id
+    return status
+
+def job_panel(kind: str, show_result: Callable[[RenderResult], None]):
+    """ジョブの進捗（実行中は1秒ごとに更新・キャンセル可）か結果を表示する"""
+    status = current_job(kind)
+    if status is None:
+        return
+    label = JOB_LABELS[kind]
+    if not status.done:
+        @st.fragment(run_every=1.0)
+        def _live():
+            s = get_scheduler().status(status.id)
+            if s is None or s.done:
+                st.rerun()  # 結果の表示はアプリ全体の再実行で
+            if s.state == "queued":
+                st.progress(0.0, text=f"{label}: 順番待ち…（前に {s.position} 件）")
+            else:
+                st.progress(min(1.0, s.fraction), text=f"{label}: {s.text or '準備中…'}")
+            for text in s.notices:
+                st.info(text)
+            if s.stream is not None and start_output_server():
+                # 仕上がった分から再生（同じ内容なので毎秒の再実行でもプレイヤーは作り直されない）
+                components.html(hls_player_html(output_url(s.stream), max_height=560), height=580)
+            st.button("⏹ キャンセル", key=f"cancel_{kind}", on_click=get_scheduler().cancel, args=(s.id,))
+        _live()
+        return
+    if status.state == "cancelled":
+        st.warning(f"{label}をキャンセルしました。")
+        return
+    for text in status.notices:
+        st.info(text)
+    if status.state == "failed":
+        st.error(f"{status.error}ログ:\n\n{status.log}")
+        return
+    show_result(status.result)
 
 # --------------- Sidebar Settings ---------------
-st.sidebar.header("共通設定（上部字幕 & 書き出し）")
-global_top_text = st.sidebar.text_area("上部字幕（全クリップ共通）", value="", height=80, help="空欄で上部字幕なし。改行可。")
-fs_top = st.sidebar.number_input("上部字幕フォントサイズ（映像高さ×）", value=0.04, step=0.001, min_value=0.01, max_value=0.5,key="fs_top_001",format="%.3f")
-fs_bottom_default = st.sidebar.number_input("下部字幕フォントサイズ（既定・映像高さ×）", value=0.06, step=0.001, min_value=0.01, max_value=0.5,key="fs_bottom_001",format="%.3f")
-margin_top = st.sidebar.number_input("上部の余白(px)", value=300, step=2, min_value=0)
-margin_bottom_default = st.sidebar.number_input("下部の余白（既定・px）", value=500, step=2, min_value=0)
-box_opacity = st.sidebar.slider("字幕背景の不透明度", 0.0, 1.0, 0.55, 0.05)
-crf = st.sidebar.number_input("CRF（画質：16-23推奨）", value=18, step=1, min_value=12, max_value=30)
-preset = st.sidebar.selectbox("preset", ["ultrafast","superfast","veryfast","faster","fast","medium","slow","slower","veryslow"], index=5)
-output_name = st.sidebar.text_input("出力ファイル名", value="output_joined.mp4")
-font_file = st.sidebar.file_uploader("（任意）TrueType/OpenTypeフォントを指定", type=["ttf","otf"], accept_multiple_files=False, help="日本語字幕でフォントを指定したい場合に使用")
-
-st.sidebar.header("縦動画キャンバス設定")
-use_vertical_canvas = st.sidebar.checkbox("縦1080×1920のキャンバスに固定する", value=True)
-scale_ratio = st.sidebar.number_input("元動画の縮小率（例: 0.32）", value=1.00, step=0.01, min_value=0.05, max_value=2.0)
-offset_up = st.sidebar.number_input("中央から上方向オフセット（px）", value=120, step=10, min_value=0, help="数値が大きいほど上に寄せます")
-
-st.sidebar.header("プレビュー設定")
-preview_seconds = st.sidebar.number_input("各クリップあたりのプレビュー秒数", value=3.0, step=0.5, min_value=0.5, max_value=30.0)
-preview_half_res = st.sidebar.checkbox("プレビューを半分解像度(540×960)で生成", value=True)
-
-st.sidebar.info("⚠️ ローカル/サーバ実行を想定。stlite（ブラウザのみ）では FFmpeg は動きません。")
+# サイドバーはフラグメントにして、設定を変えても動画の取り込みやクリップ表を再実行しない。
+# 値はアプリ全体が再実行されたとき（ボタン・アップロード）に戻り値として読む
+@st.fragment
+def sidebar_settings() -> SimpleNamespace:
+    cfg = SimpleNamespace()
+    st.header("共通設定（上部字幕 & 書き出し）")
+    cfg.global_top_text = st.text_area("上部字幕（全クリップ共通）", value="", height=80, help="空欄で上部字幕なし。改行可。")
+    cfg.fs_top = st.number_input("上部字幕フォントサイズ（映像高さ×）", value=0.04, step=0.001, min_value=0.01, max_value=0.5,key="fs_top_001",format="%.3f")
+    cfg.fs_bottom_default = st.number_input("下部字幕フォントサイズ（既定・映像高さ×）", value=0.06, step=0.001, min_value=0.01, max_value=0.5,key="fs_bottom_001",format="%.3f")
+    cfg.margin_top = st.number_input("上部の余白(px)", value=300, step=2, min_value=0)
+    cfg.margin_bottom_default = st.number_input("下部の余白（既定・px）", value=500, step=2, min_value=0)
+    cfg.box_opacity = st.slider("字幕背景の不透明度", 0.0, 1.0, 0.55, 0.05)
+    cfg.use_caption_overlay = st.checkbox("字幕を画像化して重ねる（高速）", value=True,
+                                          help="字幕を1回だけ透明PNGに描き、各フレームには重ねるだけにします。オフで毎フレーム drawtext")
+    cfg.crf = st.number_input("CRF（画質：16-23推奨）", value=18, step=1, min_value=12, max_value=30)
+    encoders = get_encoders().selectable()
+    cfg.encoder = st.selectbox("エンコーダ", encoders, format_func=lambda n: ENCODER_SPECS[n].label,
+                               help="HEVC・AV1 は H.264 より小さくなりますが、再生できない端末・ブラウザがあります（CRF は H.264 相当の画質に換算します）")
+    spec = ENCODER_SPECS[cfg.encoder]
+    cfg.use_time_budget = st.checkbox("書き出し時間の目安から preset を選ぶ", value=False,
+                                      help="クリップの尺・解像度とこのマシンでの速さから所要時間を見積もり、時間内に収まる中でいちばん画質の良い設定で書き出します")
+    if cfg.use_time_budget:
+        cfg.budget_minutes = st.number_input("この時間内に書き出す（分）", value=10.0, min_value=0.5, step=0.5)
+        cfg.budget_encoders = st.multiselect("選んでよいエンコーダ", encoders, default=[cfg.encoder],
+                                             format_func=lambda n: ENCODER_SPECS[n].label)
+        cfg.preset = spec.default_preset
+    else:
+        cfg.budget_minutes, cfg.budget_encoders = 0.0, [cfg.encoder]
+        cfg.preset = st.selectbox("preset", list(spec.presets), index=spec.presets.index(spec.default_preset),
+                                  format_func=lambda p: preset_label(cfg.encoder, p),
+                                  help="右に行くほど遅く、同じ画質でファイルが小さくなります")
+    if not get_encoders().done.is_set():
+        st.caption("このマシンでのエンコード速度を計測中です（最初の1回だけ）。")
+    cfg.workers = st.number_input("並列エンコード数", value=default_workers(), min_value=1, max_value=32, step=1,
+                                  help=f"クリップを同時にエンコードする本数。x264 のスレッドは CPU {os.cpu_count() or 1} コアを並列数で分け合います")
+    cfg.render_mode = st.selectbox("書き出し方式", list(RENDER_MODES), format_func=RENDER_MODES.get, index=0,
+                                   help="一括: 全クリップを1つの filter_complex で1回だけエンコード（中間ファイルなし）。失敗時は2段階に切り替えます")
+    cfg.use_part_cache = st.checkbox("パーツをキャッシュして再書き出しを高速化", value=True,
+                                     help="変更のないクリップは前回のエンコード結果を再利用します（自動選択時は2段階方式になります）")
+    cfg.also_horizontal = st.checkbox("横動画版も同時に書き出す", value=False,
+                                      help="各クリップを1回だけデコードして、2つのレイアウトを1つの ffmpeg で同時にエンコードします（横動画版の字幕サイズ・余白は横動画の既定値）")
+    cfg.output_name = st.text_input("出力ファイル名", value="output_joined.mp4")
+    cfg.font_file = st.file_uploader("（任意）TrueType/OpenTypeフォントを指定", type=["ttf","otf"], accept_multiple_files=False, help="日本語字幕でフォントを指定したい場合に使用")
+
+    st.header("縦動画キャンバス設定")
+    cfg.use_vertical_canvas = st.checkbox("縦1080×1920のキャンバスに固定する", value=True)
+    cfg.scale_ratio = st.number_input("元動画の縮小率（例: 0.32）", value=1.00, step=0.01, min_value=0.05, max_value=2.0)
+    cfg.offset_up = st.number_input("中央から上方向オフセット（px）", value=120, step=10, min_value=0, help="数値が大きいほど上に寄せます")
+
+    st.header("プレビュー設定")
+    cfg.preview_seconds = st.number_input("各クリップあたりのプレビュー秒数", value=3.0, step=0.5, min_value=0.5, max_value=30.0)
+    cfg.preview_half_res = st.checkbox("プレビューを半分解像度(540×960)で生成", value=True)
+    cfg.preview_stream = st.checkbox("仕上がったクリップから再生を始める", value=True, disabled=not start_output_server(),
+                                     help="エンコードが終わったクリップから順に再生できるようにし、残りのクリップは再生中に作ります（配信サーバ MOVIE_CONNECTER_DL_BASE_URL を設定したときだけ）")
+    cfg.still_seconds = st.number_input("静止画チェックの位置（各クリップの秒）", value=1.0, min_value=0.0, step=0.5,
+                                        help="「字幕レイアウトを静止画で確認」で使うフレーム（近くのキーフレーム）")
+
+    st.info("⚠️ ローカル/サーバ実行を想定。stlite（ブラウザのみ）では FFmpeg は動きません。")
+    return cfg
+
+with st.sidebar:
+    cfg = sidebar_settings()
 
 # --------------- Inputs: videos ---------------
 st.subheader("動画と下部字幕の入力")
@@ -87,35 +192,102 @@ uploads = st.file_uploader("動画ファイルを複数選択（順序は後で
 
 if "clips" not in st.session_state:
     st.session_state["clips"] = []  # List[dict]
-    # dict keys: {"name","data","order","bottom","fs_bottom","margin_bottom"}
+    # dict keys: {"id","name","sha256","path","size","order","bottom","fs_bottom","margin_bottom"}
+
+if "ingested_uploads" not in st.session_state:
+    st.session_state["ingested_uploads"] = set()  # 取り込み済みアップロードの file_id
 
 def rebuild_from_uploads():
+    """まだ取り込んでいないアップロード（file_id で判別）だけをディスクへ書き出す"""
+    ingested = st.session_state["ingested_uploads"]
+    fresh = [f for f in uploads or [] if f.file_id not in ingested]
+    if not fresh:
+        return
+    store = get_clip_store()
     existing = st.session_state["clips"]
-    new_items = []
-    existing_keys = {(c["name"], len(c["data"])) for c in existing}
-    if uploads:
-        start_order = len(existing) + 1
-        for f in uploads:
-            data_bytes = f.getvalue()
-            key = (f.name, len(data_bytes))
-            if key not in existing_keys:
-                new_items.append({
-                    "name": f.name,
-                    "data": data_bytes,
-                    "order": start_order,
-                    "bottom": Path(f.name).stem,
-                    "fs_bottom": fs_bottom_default,
-                    "margin_bottom": margin_bottom_default,
-                })
-                start_order += 1
-    st.session_state["clips"].extend(new_items)
-
+    existing_digests = {c["sha256"] for c in existing}
+    start_order = len(existing) + 1
+    for f in fresh:
+        ingested.add(f.file_id)
+        # ディスクへ書き出しつつハッシュ計算（中身が同じなら1本にまとめる）
+        digest, path, size = store.put(f, Path(f.name).suffix)
+        if digest in existing_digests:
+            store.release(digest)
+            continue
+        existing_digests.add(digest)
+        existing.append({
+            "id": uuid.uuid4().hex,
+            "name": f.name,
+            "sha256": digest,
+            "upload_id": f.file_id,
+            "path": str(path),
+            "size": size,
+            "meta": get_media_meta(digest, str(path)),
+            "order": start_order,
+            "bottom": Path(f.name).stem,
+            "fs_bottom": cfg.fs_bottom_default,
+            "margin_bottom": cfg.margin_bottom_default,
+        })
+        start_order += 1
+
+def keep_clips():
+    """
+    セッションのクリップに使用中の印を付ける（閉じたセッションの分だけが期限で消える）。
+    期限切れで消えていた行は外し、アップロード欄に残っていれば次の取り込みで入れ直す
+    """
+    clips = st.session_state["clips"]
+    alive = get_clip_store().touch(c["sha256"] for c in clips)
+    lost = [c for c in clips if c["sha256"] not in alive]
+    if lost:
+        st.warning("保存期限を過ぎて削除されたクリップを外しました: " + ", ".join(c["name"] for c in lost))
+        clips[:] = [c for c in clips if c["sha256"] in alive]
+        st.session_state["ingested_uploads"] -= {c.get("upload_id") for c in lost}
+
+def remove_clip(clip_id: str):
+    clips = st.session_state["clips"]
+    for c in clips:
+        if c["id"] == clip_id:
+            get_clip_store().release(c["sha256"])
+            clips.remove(c)
+            break
+
+def engine_clip(c: dict) -> Clip:
+    """行の内容からエンジンの Clip を作る。字幕・サイズ・余白が変わるまで同じものを使い回す"""
+    key = (c["bottom"] or "", float(c["fs_bottom"]), int(c["margin_bottom"]))
+    if c.get("clip_key") != key:
+        c["clip"] = Clip(path=c["path"], bottom=key[0], fs_bottom=key[1], margin_bottom=key[2],
+                         name=c["name"], sha256=c["sha256"], meta=c.get("meta"))
+        c["clip_key"] = key
+    return c["clip"]
+
+# 1行ずつフラグメントにして、字幕を打ち込んでもその行だけを再実行する
+@st.fragment
+def clip_row(i: int, c: dict):
+    cols = st.columns([3,1,3,1,1,0.6])
+    with cols[0]:
+        st.text(c["name"])
+        st.caption(format_meta(c.get("meta")))
+    with cols[1]:
+        c["order"] = st.number_input(f"order_{i}", value=int(c["order"]), min_value=1, step=1, key=f"ord_{c['id']}")
+    with cols[2]:
+        c["bottom"] = st.text_area(f"bottom_{i}", value=c["bottom"], key=f"bot_{c['id']}", height=90, help="改行可（そのまま反映されます）")
+    with cols[3]:
+        c["fs_bottom"] = st.number_input(f"fsb_{i}", value=float(c["fs_bottom"]), min_value=0.01, max_value=0.5, step=0.01, key=f"fsbkey_{c['id']}")
+    with cols[4]:
+        c["margin_bottom"] = st.number_input(f"mb_{i}", value=int(c["margin_bottom"]), min_value=0, step=2, key=f"mbkey_{c['id']}")
+    with cols[5]:
+        if st.button("🗑", key=f"del_{c['id']}", help="このクリップを外す"):
+            remove_clip(c["id"])
+            st.rerun()  # 行が減るので表全体を作り直す
+    engine_clip(c)
+
+keep_clips()
 rebuild_from_uploads()
 
 clips = st.session_state["clips"]
 if clips:
     st.caption("順序・各字幕を編集してから下のボタンでプレビュー／書き出ししてください。")
-    cols = st.columns([3,1,3,1,1])
+    cols = st.columns([3,1,3,1,1,0.6])
     with cols[0]: st.markdown("**ファイル名**")
     with cols[1]: st.markdown("**順序**")
     with cols[2]: st.markdown("**下部字幕（複数行OK）**")
@@ -123,239 +295,121 @@ if clips:
     with cols[4]: st.markdown("**余白**")
 
     for i, c in enumerate(clips):
-        cols = st.columns([3,1,3,1,1])
-        with cols[0]:
-            st.text(c["name"])
-        with cols[1]:
-            c["order"] = st.number_input(f"order_{i}", value=int(c["order"]), min_value=1, step=1, key=f"ord_{i}")
-        with cols[2]:
-            c["bottom"] = st.text_area(f"bottom_{i}", value=c["bottom"], key=f"bot_{i}", height=90, help="改行可（そのまま反映されます）")
-        with cols[3]:
-            c["fs_bottom"] = st.number_input(f"fsb_{i}", value=float(c["fs_bottom"]), min_value=0.01, max_value=0.5, step=0.01, key=f"fsbkey_{i}")
-        with cols[4]:
-            c["margin_bottom"] = st.number_input(f"mb_{i}", value=int(c["margin_bottom"]), min_value=0, step=2, key=f"mbkey_{i}")
+        clip_row(i, c)
 else:
     st.info("動画を選択してください。")
 
-from pathlib import Path
-
-def _escape_single_quotes(p: str) -> str:
-    # concat.txt と同様、ffmpeg 引数での単一引用符エスケープ
-    return p.replace("'", "'\\''")
-
-def _write_textfile(tmpdir: Path, name: str, text: str) -> Path:
-    path = tmpdir / name
-    # LFで保存（UTF-8）。Windows/ macOS どちらでもOK
-    path.write_text(text or "", encoding="utf-8", newline="\n")
-    return path
-
-def build_font_opt(tmpdir: Path) -> str:
-    """優先順位:
-    1) サイドバーでアップロードされたフォント
-    2) リポジトリ同梱 assets/fonts/LightNovelPOPv2.otf
-    3) それ以外（無指定）
-    """
-    # 1) アップロードフォント
-    if 'font_file' in globals() and font_file is not None:
-        p = tmpdir / font_file.name
-        with open(p, "wb") as f:
-            f.write(font_file.getvalue())
-        return f":fontfile='{p.as_posix()}'"
-
-    # 2) 同梱フォント（絶対パスで探索）
-    try:
-        here = Path(__file__).resolve()
-        for up in [here, *list(here.parents)]:
-            # up がファイルなら .parent、ディレクトリならそのまま扱う
-            base = up.parent if up.is_file() else up
-            cand = base / "assets" / "fonts" / "LanobePOPv2" / "LightNovelPOPv2.otf"
-            if cand.exists():
-                return f":fontfile='{cand.as_posix()}'"
-    except Exception:
-        pass
-
-    # 3) 無指定（最後の手段）
-    return ""
-
-
-def build_vf_chain(top_text: str, bottom_text: str, margin_bottom: int, fs_bottom: float, margin_top_px: int, tmpdir: Path) -> str:
-    vf_elems = []
-    # 1) SARを正規化
-    vf_elems.append("setsar=1")
-    # 2) 縦横比維持で短辺合わせ（1080×1920の枠内に収める）
-    vf_elems.append(
-        "scale=w=trunc(iw*min(1080/iw\\,1920/ih)/2)*2:"
-        "h=trunc(ih*min(1080/iw\\,1920/ih)/2)*2"
+# --------------- Job ---------------
+def build_job(clips_sorted: List[dict]) -> Job:
+    """サイドバーとクリップ表の内容からエンジンのジョブを作る"""
+    font_path = store_font(cfg.font_file.getvalue(), cfg.font_file.name) if cfg.font_file is not None else None
+    return Job(
+        layout="shorts",
+        clips=[engine_clip(c) for c in clips_sorted],
+        captions=CaptionStyle(top=cfg.global_top_text, fs_top=cfg.fs_top, margin_top=int(cfg.margin_top),
+                              box_opacity=cfg.box_opacity, font_path=str(font_path or ""), overlay=cfg.use_caption_overlay),
+        encode=EncodeSettings(crf=int(cfg.crf), preset=cfg.preset, render_mode=cfg.render_mode, encoder=cfg.encoder,
+                              time_budget=float(cfg.budget_minutes) * 60, budget_encoders=cfg.budget_encoders or [cfg.encoder]),
+        preview=PreviewSettings(seconds=float(cfg.preview_seconds), downscale=cfg.preview_half_res and cfg.use_vertical_canvas,
+                                stream=cfg.preview_stream and start_output_server()),
+        output=Path(cfg.output_name).name or "output_joined.mp4",
     )
-    # 3) 出力色空間（H.264の互換性向上）
-    vf_elems.append("format=yuv420p")
-    # 4) キャンバスにパディング（中央寄せ。上寄せしたいなら y を調整）
-    vf_elems.append("pad=1080:1920:(1080-iw)/2:(1920-ih)/2:black")
-    # 5) 以降に drawtext（字幕）
-    font_opt = build_font_opt(tmpdir)
-
-    # 上部字幕：行ごとに drawtext（各行を個別に中央寄せ）
-    if top_text:
-        lines = top_text.splitlines()
-        line_spacing_ratio = 1.2  # 行間（フォントサイズ比）
-
-        for i, line in enumerate(lines):
-            # 行テキストを1行だけの textfile として保存（UTF-8 / LF）
-            top_i_path = _write_textfile(tmpdir, f"top_line_{i}.txt", line)
-            top_i_arg = _escape_single_quotes(top_i_path.as_posix())
-
-            # 各行について、tw/th は「その行」の幅・高さになる
-            # → x を (w - tw)/2 にすれば行ごとに厳密にセンタリングできる
-            y_expr = f"{int(margin_top_px)} + {i}*(h*{float(fs_top)}*{line_spacing_ratio})"
-
-            vf_elems.append(
-                f"drawtext=textfile='{top_i_arg}'{font_opt}:"
-                f"x=(w-tw)/2:"
-                f"y={y_expr}:"
-                f"fontsize=h*{float(fs_top)}:"
-                f"fontcolor=white:box=1:boxcolor=black@{box_opacity}:boxborderw=10:"
-                f"fix_bounds=1:text_shaping=1"
-            )
-
-
-    # ▼ 下部字幕：textfile= を使う（複数行OK）
-    if bottom_text:
-        bottom_path = _write_textfile(tmpdir, "bottom.txt", bottom_text)
-        bottom_arg = _escape_single_quotes(bottom_path.as_posix())
-        vf_elems.append(
-        f"drawtext=textfile='{bottom_arg}'{font_opt}:"
-        f"x=(w-tw)/2:y=h-th-{int(margin_bottom)}:"
-        f"fontsize=h*{float(fs_bottom)}:fontcolor=white:"
-        f"box=1:boxcolor=black@{box_opacity}:boxborderw=10:fix_bounds=1:text_shaping=1"
-        )
-
-    return ",".join(vf_elems)
+
+def ready() -> bool:
+    if not has_ffmpeg():
+        st.error("FFmpeg が見つかりません。ローカルにインストールし、PATH を通してください。")
+        return False
+    if not clips:
+        st.warning("動画が選択されていません。")
+        return False
+    return True
 
 # --------------- Buttons ---------------
-col_run1, col_run2 = st.columns(2)
+col_run0, col_run1, col_run2 = st.columns(3)
+still_btn   = col_run0.button("🖼 字幕レイアウトを静止画で確認", use_container_width=True)
 preview_btn = col_run1.button("▶ プレビューを生成（結合）", use_container_width=True)
 export_btn  = col_run2.button("🎬 結合して書き出す", use_container_width=True)
 
+# --------------- Still preview (caption layout) ---------------
+# 静止画はクリップの行に控えておき、入力（共通字幕・行の内容・位置）が変わるまで表示し続ける
+def still_key(job: Job, c: dict) -> tuple:
+    return astuple(job.captions), c["clip_key"], float(cfg.still_seconds)
+
+def cached_still(job: Job, c: dict) -> Optional[tuple]:
+    """入力が前回と同じならそのときの (JPEG, 失敗時のログ)。変わった・JPEG が消えたときは None"""
+    still = c.get("still")
+    if still is None or still[0] != still_key(job, c):
+        return None
+    img, log = still[1:]
+    return None if img is not None and not img.exists() else (img, log)
+
+if still_btn and ready():
+    clips_sorted = sorted(clips, key=lambda x: x["order"])
+    job = build_job(clips_sorted)
+    # 前回から変わったクリップ（と失敗したもの）だけを作り直す
+    stale = [c for c in clips_sorted if (cached_still(job, c) or (None,))[0] is None]
+    if stale:
+        results, timer = render_stills(replace(job, clips=[engine_clip(c) for c in stale]), cfg.still_seconds,
+                                       workers=cfg.workers)
+        for c, (img, log) in zip(stale, results):
+            c["still"] = (still_key(job, c), img, log)
+        show_timings(timer)
+
+if any("still" in c for c in clips):
+    clips_sorted = sorted(clips, key=lambda x: x["order"])
+    job = build_job(clips_sorted)
+    cols = st.columns(4)
+    for idx, c in enumerate(clips_sorted):
+        cached = cached_still(job, c)
+        if cached is None:
+            continue
+        img, log = cached
+        with cols[idx % 4]:
+            if img is not None:
+                st.image(str(img), caption=f"{idx + 1}. {c['name']}")
+            else:
+                st.error(f"{idx + 1}. {c['name']}: 静止画の作成に失敗しました。\n\n{log}")
+
 # --------------- Preview ---------------
-if preview_btn:
-    if not has_ffmpeg():
-        st.error("FFmpeg が見つかりません。ローカルにインストールし、PATH を通してください。")
-    elif not clips:
-        st.warning("動画が選択されていません。")
-    else:
-        clips_sorted = sorted(clips, key=lambda x: x["order"])
-        with st.spinner("プレビューを生成中..."):
-            with tempfile.TemporaryDirectory(prefix="st_join_preview_") as tmpd:
-                tmpdir = Path(tmpd)
-                parts = []
-                for idx, c in enumerate(clips_sorted):
-                    in_path = tmpdir / f"in_{idx:03d}{Path(c['name']).suffix}"
-                    with open(in_path, "wb") as f:
-                        f.write(c["data"])
-                    vf = build_vf_chain(global_top_text, c["bottom"] or "", c["margin_bottom"], c["fs_bottom"], margin_top, tmpdir)
-                    out_i = tmpdir / f"part_prev_{idx:03d}.mp4"
-                    # プレビューは解像度半分＆高CRFで軽量化
-                    vf_prev = vf
-                    if preview_half_res and use_vertical_canvas:
-                        vf_prev = vf + ",scale=540:960"
-                    cmd = [
-                        get_ffmpeg_exe(), "-y",
-                        "-i", str(in_path),
-                        "-t", str(preview_seconds),
-                        "-vf", vf_prev,
-                        "-c:v", "libx264",
-                        "-crf", "28",
-                        "-preset", "veryfast",
-                        "-c:a", "aac",
-                        "-movflags", "+faststart",
-                        str(out_i)
-                    ]
-                    ok, log = run_ffmpeg(cmd)
-                    if not ok:
-                        st.error(f"プレビュー用クリップ {idx+1} の処理に失敗しました。ログ:\n\n{log}")
-                        st.stop()
-                    parts.append(out_i)
-
-                # concat previews
-                listfile = tmpdir / "concat_prev.txt"
-                with open(listfile, "w", encoding="utf-8") as f:
-                    for p in parts:
-                        sp = str(p).replace("'", "'\\''")
-                        f.write(f"file '{sp}'\n")
-
-                out_prev = tmpdir / "preview_joined.mp4"
-                cmd_concat = [
-                    get_ffmpeg_exe(), "-y",
-                    "-f", "concat", "-safe", "0",
-                    "-i", str(listfile),
-                    "-c", "copy",
-                    str(out_prev)
-                ]
-                ok, log = run_ffmpeg(cmd_concat)
-                if not ok:
-                    st.error(f"プレビューの結合に失敗しました。ログ:\n\n{log}")
-                    st.stop()
-
-                with open(out_prev, "rb") as f:
-                    prev_bytes = f.read()
-                st.success("プレビューの準備ができました。下で再生できます。")
-                st.video(prev_bytes)
+if preview_btn and ready():
+    clips_sorted = sorted(clips, key=lambda x: x["order"])
+    submit_job("preview", build_job(clips_sorted), new_output_dir() / "preview_joined.mp4")
+
+def show_preview(res: RenderResult):
+    st.success("プレビューの準備ができました。下で再生できます。")
+    # 配信サーバがあればブラウザにディスクから直接読ませる（メモリに載せない）
+    st.video(output_url(res.output) if start_output_server() else str(res.output))
+    if res.cache_stats:
+        st.caption(res.cache_stats)
+    show_timings(res.timer, res.usage)
+
+job_panel("preview", show_preview)
 
 # --------------- Export ---------------
-if export_btn:
-    if not has_ffmpeg():
-        st.error("FFmpeg が見つかりません。ローカルにインストールし、PATH を通してください。")
-    elif not clips:
-        st.warning("動画が選択されていません。")
-    else:
-        clips_sorted = sorted(clips, key=lambda x: x["order"])
-        with st.spinner("書き出し中...（時間がかかる場合があります）"):
-            with tempfile.TemporaryDirectory(prefix="st_join_subs_") as tmpd:
-                tmpdir = Path(tmpd)
-                parts = []
-                for idx, c in enumerate(clips_sorted):
-                    in_path = tmpdir / f"in_{idx:03d}{Path(c['name']).suffix}"
-                    with open(in_path, "wb") as f:
-                        f.write(c["data"])
-                    vf = build_vf_chain(global_top_text, c["bottom"] or "", c["margin_bottom"], c["fs_bottom"], margin_top, tmpdir)
-                    out_i = tmpdir / f"part_{idx:03d}.mp4"
-                    cmd = [
-                        get_ffmpeg_exe(), "-y",
-                        "-i", str(in_path),
-                        "-vf", vf,
-                        "-c:v", "libx264",
-                        "-crf", str(crf),
-                        "-preset", preset,
-                        "-c:a", "aac",
-                        "-movflags", "+faststart",
-                        str(out_i)
-                    ]
-                    ok, log = run_ffmpeg(cmd)
-                    if not ok:
-                        st.error(f"クリップ {idx+1} の処理に失敗しました。ログ:\n\n{log}")
-                        st.stop()
-                    parts.append(out_i)
-
-                listfile = tmpdir / "concat.txt"
-                with open(listfile, "w", encoding="utf-8") as f:
-                    for p in parts:
-                        sp = str(p).replace("'", "'\\''")
-                        f.write(f"file '{sp}'\n")
-
-                out_path = tmpdir / (output_name or "output_joined.mp4")
-                cmd_concat = [
-                    get_ffmpeg_exe(), "-y",
-                    "-f", "concat", "-safe", "0",
-                    "-i", str(listfile),
-                    "-c", "copy",
-                    str(out_path)
-                ]
-                ok, log = run_ffmpeg(cmd_concat)
-                if not ok:
-                    st.error(f"結合に失敗しました。ログ:\n\n{log}")
-                    st.stop()
-
-                with open(out_path, "rb") as f:
-                    data = f.read()
-                st.success("完了しました。下のボタンからダウンロードできます。")
-                st.download_button("📥 ダウンロード", data=data, file_name=Path(output_name).name or "output_joined.mp4", mime="video/mp4")
+if export_btn and ready():
+    clips_sorted = sorted(clips, key=lambda x: x["order"])
+    job = build_job(clips_sorted)
+    out_dir = new_output_dir()
+    renditions = []
+    if cfg.also_horizontal:
+        other = job.as_layout("horizontal")
+        renditions.append((other, out_dir / other.output))
+    submit_job("export", job, out_dir / job.output, renditions=renditions)
+
+def show_export(res: RenderResult):
+    if res.cache_stats:
+        st.caption(res.cache_stats)
+    st.success("完了しました。下のボタンからダウンロードできます。")
+    for r in [res, *res.renditions]:
+        # 同時書き出しのときはファイル名でボタンを分ける
+        label = f"📥 {r.output.name}" if res.renditions else "📥 ダウンロード"
+        if start_output_server():
+            st.link_button(label, output_url(r.output, download=True))
+        else:
+            with open(r.output, "rb") as f:
+                st.download_button(label, data=f, file_name=r.output.name, mime="video/mp4", key=f"dl_{r.output.name}")
+    if start_output_server():
+        st.caption(f"リンクの有効期限: 約 {OUTPUT_TTL_SECONDS / 3600:g} 時間")
+    show_timings(res.timer, res.usage)
+
+job_panel("export", show_export)
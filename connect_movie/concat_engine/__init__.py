@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+動画結合（字幕焼き込み）のエンジン。Streamlit に依存せず、アプリ・CLI・バッチから同じ処理を使う。
+
+    from concat_engine import Job, Clip, render_export
+    job = Job(layout="shorts", clips=[Clip("a.mp4", bottom="字幕")])
+    render_export(job, Path("out.mp4"))
+"""
+from .cache import CACHE_ROOT, PART_CACHE_MAX_BYTES, PartCache, file_sha256, normalize_vf_for_key, part_key
+from .captions import caption_vf, find_bundled_font
+from .checkpoint import JOBS_ROOT, ExportCheckpoint, has_checkpoint, sweep_checkpoints
+from .encoders import (DEFAULT_ENCODER, ENCODER_SPECS, BudgetPlan, EncoderRegistry, EncoderSpec, encoder_args,
+                       encoder_registry, plan_budget)
+from .ffmpeg import (CancelToken, JobProgress, LogTail, StageTimer, default_workers, get_ffmpeg_exe, has_ffmpeg,
+                     run_ffmpeg, run_ffmpeg_parallel, x264_threads_for)
+from .hls import HlsPreview
+from .jobs import LAYOUT_DEFAULTS, LAYOUTS, CaptionStyle, Clip, EncodeSettings, Job, PreviewSettings, load_manifest
+from .outputs import (DL_SERVER_ENABLED, OUTPUT_ROOT, OUTPUT_TTL_SECONDS, hls_player_html, new_output_dir, output_url,
+                      serve_outputs, sweep_outputs)
+from .probe import display_size, format_meta, get_media_meta, meta_duration, probe_media
+from .remote import WORKER_PORT, RemotePool, default_pool, encode_request, portable_args, serve_worker
+from .render import (CHUNK_MIN_CLIP_SECONDS, PREVIEW_ANCHORS, RENDER_MODES, RenderCancelled, RenderError, RenderResult,
+                     Reporter, encode_pixels, keyframe_times, plan_chunks, plan_export_budget, preview_segments,
+                     render_export, render_preview, render_stills)
+from .scheduler import CPU_BUDGET, JOB_KINDS, MAX_JOBS, JobStatus, Scheduler
+from .store import CLIP_TTL_SECONDS, ClipStore, store_font
+from .telemetry import TELEMETRY_PATH, JobUsage, ProcessUsage, format_usage, job_span, prometheus_text
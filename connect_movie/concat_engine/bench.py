@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+ベンチマーク: 合成クリップ（lavfi の testsrc2 + sine）でプレビュー・区間プレビュー・書き出しを走らせ、
+所要時間・CPU 時間・ピークメモリ・書き込み量を JSON に残す。出力の尺・ストリーム構成・
+字幕入りフレームの framemd5 をゴールデンと比べて、高速化で出力が変わっていないかも確かめる。
+
+    python -m concat_engine bench --out bench.json --golden golden.json
+    python -m concat_engine bench --compare before.json --out after.json
+
+シナリオごとに子プロセス（fork）で実行するので、CPU 時間・ピークメモリはそのシナリオの ffmpeg だけの値になる。
+"""
+import hashlib, multiprocessing, os, platform, subprocess, sys, tempfile, time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from .cache import CACHE_ROOT
+from .ffmpeg import default_workers, get_ffmpeg_exe, run_ffmpeg
+from .jobs import CaptionStyle, Clip, EncodeSettings, Job, LAYOUT_DEFAULTS, PreviewSettings
+from .probe import probe_media
+from .render import RenderError, render_export, render_preview
+
+BENCH_ROOT = CACHE_ROOT / "bench"
+CLIP_VERSION = 1  # 合成クリップの作り方を変えたら上げる
+
+# 解像度プロファイル: (幅, 高さ, fps, 1本の秒数)
+PROFILES: Dict[str, Tuple[int, int, int, float]] = {
+    "360p": (640, 360, 30, 4.0),
+    "720p": (1280, 720, 30, 6.0),
+    "1080p": (1920, 1080, 30, 8.0),
+    "vertical": (1080, 1920, 30, 6.0),
+}
+GOP_SECONDS = 2             # 合成クリップのキーフレーム間隔
+GOLDEN_FRAME_STEP = 30      # framemd5 を取るフレームの間隔
+DURATION_TOLERANCE = 0.05   # 尺の比較の許容差（秒）
+WINDOW_TOLERANCE = 0.15     # 区間プレビューの尺と指定の秒数の許容差（パーツごとの AAC のフレーム境界の分）
+
+@dataclass
+class Scenario:
+    layout: str     # horizontal / shorts
+    kind: str       # preview / window（つなぎ目の前後だけの区間プレビュー）/ export
+    profile: str
+    clips: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.layout}/{self.kind}/{self.profile}/x{self.clips}"
+
+# ---------------- Synthetic clips ----------------
+def synthetic_clip(profile: str, index: int) -> Path:
+    """
+    決定的な合成クリップ（同じ ffmpeg なら毎回同じバイト列）。index ごとに絵柄の開始位置と音の高さを変える。
+    BENCH_ROOT/clips にキャッシュする。
+    """
+    w, h, fps, seconds = PROFILES[profile]
+    out = BENCH_ROOT / "clips" / f"v{CLIP_VERSION}_{profile}_{index:02d}.mp4"
+    if out.exists():
+        return out
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_suffix(".tmp.mp4")
+    ok, log = run_ffmpeg([
+        get_ffmpeg_exe(), "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={w}x{h}:rate={fps}:duration={seconds + index}",
+        "-f", "lavfi", "-i", f"sine=frequency={220 * (index + 1)}:sample_rate=48000:duration={seconds + index}",
+        "-vf", f"trim=start={index},setpts=PTS-STARTPTS", "-af", f"atrim=start={index},asetpts=PTS-STARTPTS",
+        "-map", "0:v", "-map", "1:a",
+        "-c:v", "libx264", "-preset", "ultrafast", "-crf", "23", "-g", str(fps * GOP_SECONDS), "-pix_fmt", "yuv420p", "-threads", "1",
+        "-c:a", "aac", "-b:a", "96k", "-ac", "2",
+        "-fflags", "+bitexact", "-flags:v", "+bitexact", "-flags:a", "+bitexact", "-map_metadata", "-1",
+        "-movflags", "+faststart",
+        str(tmp)
+    ])
+    if not ok:
+        tmp.unlink(missing_ok=True)
+        raise RenderError(f"合成クリップの生成に失敗しました: {out.name}", log)
+    os.replace(tmp, out)
+    return out
+
+def scenario_job(sc: Scenario) -> Job:
+    defaults = LAYOUT_DEFAULTS[sc.layout]
+    clips = [Clip(str(synthetic_clip(sc.profile, i)), bottom=f"クリップ {i + 1}\n下部字幕",
+                  fs_bottom=defaults["fs_bottom"], margin_bottom=defaults["margin_bottom"])
+             for i in range(sc.clips)]
+    return Job(
+        layout=sc.layout,
+        clips=clips,
+        captions=CaptionStyle(top="ベンチマーク 上部字幕", fs_top=defaults["fs_top"], margin_top=defaults["margin_top"]),
+        encode=EncodeSettings(crf=23, preset="veryfast"),
+        preview=window_preview() if sc.kind == "window" else PreviewSettings(seconds=defaults["preview_seconds"]),
+        output=f"{sc.layout}_{sc.kind}_{sc.profile}_x{sc.clips}.mp4",
+        name=sc.name,
+    )
+
+def window_preview() -> PreviewSettings:
+    """
+    1本目と2本目のつなぎ目の前後 GOP_SECONDS / 2 秒ずつのプレビュー。
+    どちらのクリップも -ss/-t で切り出し、1本目はキーフレームの間（GOP の途中）から始まる
+    """
+    return PreviewSettings(seconds=GOP_SECONDS, anchor="join", join=1)
+
+# ---------------- Output checks ----------------
+def output_checks(path: Path) -> dict:
+    """出力の尺・ストリーム構成と、GOLDEN_FRAME_STEP フレームおきの映像の framemd5 をまとめたもの"""
+    meta = probe_media(str(path)) or {}
+    v, a = meta.get("video"), meta.get("audio")
+    lines = []
+    ok, _ = run_ffmpeg([get_ffmpeg_exe(), "-v", "error", "-i", str(path), "-map", "0:v:0",
+                        "-vf", f"select=not(mod(n\\,{GOLDEN_FRAME_STEP}))", "-vsync", "0", "-f", "framemd5", "-"],
+                       on_line=lines.append)
+    frames = [line.rsplit(",", 1)[-1].strip() for line in lines if line.strip() and not line.startswith("#")] if ok else []
+    return {
+        "duration": round(float(meta.get("duration") or 0.0), 2),
+        "video": f"{v['codec']} {v['width']}x{v['height']} {v['pix_fmt']} {v['fps']:g}fps" if v else "",
+        "audio": f"{a['codec']} {a['sample_rate']}Hz {a['channels']}ch" if a else "",
+        "frames": len(frames),
+        "framemd5": hashlib.sha256("\n".join(frames).encode("utf-8")).hexdigest() if frames else "",
+    }
+
+def compare_checks(golden: dict, checks: dict) -> List[str]:
+    """ゴールデンとの違い（無ければ空）"""
+    diffs = []
+    if abs(golden.get("duration", 0.0) - checks["duration"]) > DURATION_TOLERANCE:
+        diffs.append(f"尺 {golden.get('duration')} → {checks['duration']}")
+    for key in ("video", "audio", "frames", "framemd5"):
+        if golden.get(key) != checks[key]:
+            diffs.append(f"{key} {golden.get(key)} → {checks[key]}")
+    return diffs
+
+# ---------------- Runner ----------------
+def _rusage() -> Tuple[float, float, int, int]:
+    """(自プロセスの CPU 秒, 子プロセスの CPU 秒, 子プロセスのピーク RSS バイト, 書き込みブロック数)"""
+    if resource is None:
+        return 0.0, 0.0, 0, 0
+    me, kids = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss は Linux が KB、macOS がバイト
+    rss = kids.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return me.ru_utime + me.ru_stime, kids.ru_utime + kids.ru_stime, rss, me.ru_oublock + kids.ru_oublock
+
+def _run_one(sc: Scenario, workers: int, out_dir: str) -> dict:
+    job = scenario_job(sc)
+    out_path = Path(out_dir) / job.output
+    render = render_export if sc.kind == "export" else render_preview
+    self0, kids0, _, blocks0 = _rusage()
+    t0 = time.perf_counter()
+    try:
+        res = render(job, out_path, workers=workers, use_part_cache=False)
+    except RenderError as e:
+        return {"ok": False, "error": str(e), "log_tail": e.log[-2000:]}
+    wall = time.perf_counter() - t0
+    self1, kids1, rss, blocks1 = _rusage()
+    checks = output_checks(out_path)
+    if sc.kind == "window" and abs(checks["duration"] - job.preview.seconds) > WINDOW_TOLERANCE:
+        # ゴールデンが無くても、区間の長さと合わない出力は失敗にする
+        return {"ok": False, "error": f"区間プレビューの尺が {checks['duration']} 秒（指定 {job.preview.seconds:g} 秒）"}
+    return {
+        "ok": True,
+        "engine": res.engine,
+        "wall_s": round(wall, 3),
+        "cpu_s": round((self1 - self0) + (kids1 - kids0), 3),
+        "peak_rss_mb": round(rss / 1024 ** 2, 1),
+        "written_bytes": (blocks1 - blocks0) * 512,   # ブロック層への書き込み（tmpfs では 0）
+        "output_bytes": out_path.stat().st_size,
+        "timings": {name: round(sec, 3) for name, sec in res.timer.rows},
+        "checks": checks,
+    }
+
+def _child(sc: Scenario, workers: int, out_dir: str, conn):
+    try:
+        conn.send(_run_one(sc, workers, out_dir))
+    except Exception as e:
+        conn.send({"ok": False, "error": f"予期しないエラー: {e}"})
+    finally:
+        conn.close()
+
+def run_scenario(sc: Scenario, workers: int) -> dict:
+    """
+    1シナリオを実行して計測値と出力のチェック結果を返す。
+    fork できる環境では子プロセスで実行する（RUSAGE_CHILDREN がそのシナリオの ffmpeg だけになる）。
+    """
+    for i in range(sc.clips):
+        synthetic_clip(sc.profile, i)  # 生成時間は計測に含めない
+    with tempfile.TemporaryDirectory(prefix="concat_bench_") as out_dir:
+        if "fork" not in multiprocessing.get_all_start_methods():
+            return _run_one(sc, workers, out_dir)
+        ctx = multiprocessing.get_context("fork")
+        recv, send = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_child, args=(sc, workers, out_dir, send))
+        proc.start()
+        send.close()
+        try:
+            result = recv.recv()
+        except EOFError:
+            result = {"ok": False, "error": f"ベンチマークのプロセスが異常終了しました（終了コード {proc.exitcode}）"}
+        proc.join()
+        return result
+
+def scenarios(layouts: List[str], kinds: List[str], profiles: List[str], clip_counts: List[int]) -> List[Scenario]:
+    """区間プレビュー（window）はつなぎ目のある横動画（2本以上）だけ"""
+    return [Scenario(layout, kind, profile, n)
+            for layout in layouts for kind in kinds for profile in profiles for n in clip_counts
+            if kind != "window" or (layout == "horizontal" and n >= 2)]
+
+def environment() -> dict:
+    """結果を比べるときに揃っているべき実行環境"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).resolve().parent,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = ""
+    _, log = run_ffmpeg([get_ffmpeg_exe(), "-version"])
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": log.splitlines()[0] if log else "",
+    }
+
+def run_bench(items: List[Scenario], workers: Optional[int] = None, repeat: int = 1,
+              golden: Optional[dict] = None, log=sys.stderr) -> dict:
+    """
+    シナリオを順に実行する。repeat 回のうち wall_s がいちばん短い回を採用。
+    golden（シナリオ名 → checks）があれば出力を比べ、results の golden に ok / mismatch / new を入れる。
+    """
+    workers = int(workers or default_workers())
+    results = []
+    for n, sc in enumerate(items, 1):
+        runs = [run_scenario(sc, workers) for _ in range(max(1, repeat))]
+        ok_runs = [r for r in runs if r["ok"]]
+        best = min(ok_runs, key=lambda r: r["wall_s"]) if ok_runs else runs[0]
+        entry = {"scenario": sc.name, **asdict(sc), "workers": workers, **best}
+        if best["ok"] and golden is not None:
+            expected = golden.get(sc.name)
+            entry["golden_diffs"] = compare_checks(expected, best["checks"]) if expected else []
+            entry["golden"] = "new" if expected is None else ("mismatch" if entry["golden_diffs"] else "ok")
+        results.append(entry)
+        status = f"{best['wall_s']:.2f}s cpu {best['cpu_s']:.2f}s rss {best['peak_rss_mb']}MB" if best["ok"] else f"失敗: {best['error']}"
+        log.write(f"[{n}/{len(items)} {sc.name}] {status}{' ' + entry['golden'] if 'golden' in entry else ''}\n")
+        log.flush()
+    return {"env": environment(), "results": results}
+
+def golden_from(report: dict) -> dict:
+    return {r["scenario"]: r["checks"] for r in report["results"] if r["ok"]}
+
+def compare_reports(base: dict, head: dict) -> List[str]:
+    """2つの結果の wall_s / cpu_s / peak_rss_mb をシナリオごとに並べた表（Markdown）"""
+    before = {r["scenario"]: r for r in base["results"] if r["ok"]}
+    rows = ["| シナリオ | wall 秒 | CPU 秒 | ピーク RSS MB | 出力 |", "|---|---|---|---|---|"]
+    for r in head["results"]:
+        b = before.get(r["scenario"])
+        if not r["ok"] or b is None:
+            rows.append(f"| {r['scenario']} | {'失敗' if not r['ok'] else '（比較対象なし）'} | | | |")
+            continue
+
+        def _cell(key: str) -> str:
+            old, new = b[key], r[key]
+            pct = f" ({(new - old) / old * 100:+.0f}%)" if old else ""
+            return f"{old:g} → {new:g}{pct}"
+        same = "同じ" if not compare_checks(b["checks"], r["checks"]) else "**変化あり**"
+        rows.append(f"| {r['scenario']} | {_cell('wall_s')} | {_cell('cpu_s')} | {_cell('peak_rss_mb')} | {same} |")
+    return rows
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""キャッシュの置き場所と、エンコード済みパーツの永続キャッシュ"""
+import functools, hashlib, os, re, tempfile, uuid
+from pathlib import Path
+from typing import List, Optional
+
+CACHE_ROOT = Path(os.environ.get("MOVIE_CONNECTER_CACHE_DIR") or (Path(tempfile.gettempdir()) / "movie_connecter"))
+PART_CACHE_MAX_BYTES = int(float(os.environ.get("MOVIE_CONNECTER_PART_CACHE_GB", "5")) * 1024 ** 3)
+
+_FILE_REF_RE = re.compile(r"(textfile|fontfile)='((?:[^'\\]|\\.|'\\'')*)'")
+
+@functools.lru_cache(maxsize=256)
+def _file_digest(path: str, size: int, mtime_ns: int) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_sha256(path: str) -> str:
+    """ファイル本体の SHA-256（サイズと更新時刻が同じ間はメモリにキャッシュ）"""
+    stt = os.stat(path)
+    return _file_digest(path, stt.st_size, stt.st_mtime_ns)
+
+def normalize_vf_for_key(vf: str) -> str:
+    """
+    vf 内の textfile / fontfile のパスを中身のハッシュに置き換える。
+    パスは一時ディレクトリごとに変わるので、そのままではキーにならない。
+    """
+    def _sub(m):
+        path = m.group(2).replace("'\\''", "'")
+        try:
+            digest = file_sha256(path)
+        except OSError:
+            digest = "missing"
+        return f"{m.group(1)}=sha256:{digest}"
+    return _FILE_REF_RE.sub(_sub, vf)
+
+def part_key(digest: str, vf: str, enc_args: List[str]) -> str:
+    """パーツのキー = クリップ本体のハッシュ + 正規化した vf + エンコード設定"""
+    h = hashlib.sha256()
+    for item in (digest, normalize_vf_for_key(vf), *enc_args):
+        h.update(item.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+class PartCache:
+    """
+    エンコード済みパーツの永続キャッシュ。
+    キー = クリップ本体のハッシュ + 正規化した vf + エンコード設定。
+    容量上限を超えたら最終利用（mtime）の古い順に削除する。
+    """
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, digest: str, vf: str, enc_args: List[str]) -> str:
+        return part_key(digest, vf, enc_args)
+
+    def lookup(self, key: str) -> Optional[Path]:
+        p = self.root / f"{key}.mp4"
+        if p.exists():
+            os.utime(p)  # LRU 用に最終利用時刻を更新
+            self.hits += 1
+            return p
+        self.misses += 1
+        return None
+
+    def tmp_path(self, key: str) -> Path:
+        # 書き込み途中のファイルは .tmp 付き。commit で原子的に差し替える
+        return self.root / f"{key}.{uuid.uuid4().hex}.tmp.mp4"
+
+    def commit(self, key: str, tmp: Path) -> Path:
+        final = self.root / f"{key}.mp4"
+        os.replace(tmp, final)
+        return final
+
+    def discard(self, tmp: Path):
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+
+    def evict(self, protect: Optional[set] = None) -> int:
+        """上限を超えた分を古い順に削除。protect のキーは残す。削除数を返す"""
+        protect = protect or set()
+        entries = []
+        for p in self.root.glob("*.mp4"):
+            if p.name.endswith(".tmp.mp4"):
+                continue
+            try:
+                stt = p.stat()
+            except OSError:
+                continue
+            entries.append((stt.st_mtime, stt.st_size, p))
+        total = sum(e[1] for e in entries)
+        removed = 0
+        for _, size, p in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if p.stem in protect:
+                continue
+            try:
+                p.unlink()
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def size_bytes(self) -> int:
+        return sum(p.stat().st_size for p in self.root.glob("*.mp4") if not p.name.endswith(".tmp.mp4"))
+
+    def stats_text(self) -> str:
+        return (f"パーツキャッシュ: ヒット {self.hits} / ミス {self.misses}"
+                f"（{self.size_bytes() / 1024 ** 2:.0f} MB / 上限 {self.max_bytes / 1024 ** 3:.1f} GB）")
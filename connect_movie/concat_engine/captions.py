@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""字幕フィルタの組み立て（drawtext / 透明PNGの overlay）とキャンバス"""
+import hashlib, json, os, uuid
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+from .cache import CACHE_ROOT, normalize_vf_for_key
+from .ffmpeg import get_ffmpeg_exe, run_ffmpeg
+from .jobs import CaptionStyle, Clip
+from .probe import display_size
+
+SHORTS_SIZE = (1080, 1920)
+
+def ff_esc_basic(text: str) -> str:
+    if text is None:
+        return ""
+    return text.replace("\\", r"\\")
+
+def write_utf8_text(path: Path, text: str):
+    # LFで保存（UTF-8）。Windows/ macOS どちらでもOK
+    path.write_text(text or "", encoding="utf-8", newline="\n")
+
+def find_bundled_font() -> Optional[Path]:
+    """
+    リポジトリ同梱フォントを上位ディレクトリへ遡って探索。
+    見つかれば Path を返す。無ければ None。
+    """
+    try:
+        here = Path(__file__).resolve()
+        candidate_relpaths = [
+            Path("assets/fonts/LanobePOPv2/LightNovelPOPv2.otf"),
+            Path("assets/fonts/NotoSansCJKjp/NotoSansCJKjp-Regular.otf"),
+            Path("assets/fonts/NotoSansJP/NotoSansJP-Regular.ttf"),
+        ]
+        for up in [here, *list(here.parents)]:
+            base = up.parent if up.is_file() else up
+            for rel in candidate_relpaths:
+                cand = base / rel
+                if cand.exists():
+                    return cand
+    except Exception:
+        pass
+    return None
+
+def font_option(font_path: Optional[str], font_name: Optional[str]) -> str:
+    """フォント解決：指定ファイル → システム名（fontconfig） → 同梱フォント → 無指定"""
+    if font_path and Path(font_path).exists():
+        return f":fontfile='{Path(font_path).as_posix()}'"
+    if font_name and font_name.strip():
+        return f":font='{font_name.strip()}'"
+    bundled = find_bundled_font()
+    if bundled:
+        return f":fontfile='{bundled.as_posix()}'"
+    return ""
+
+# ---------------- Drawtext (horizontal) ----------------
+BOX_BORDER_PX = 10  # 書き出し解像度でのボックス枠
+
+def _scaled_px(px, scale: float) -> int:
+    return int(round(int(px) * scale))
+
+def _box_border(scale: float) -> int:
+    return max(1, int(round(BOX_BORDER_PX * scale)))
+
+def _even(x: float) -> int:
+    return max(2, int(round(x / 2)) * 2)
+
+def horizontal_drawtexts(
+    workdir: Path,
+    top_text: str,
+    fs_top_val: float,
+    bottom_text: str,
+    fs_bottom_val: float,
+    margin_top_px: int,
+    margin_bottom_px: int,
+    box_alpha: float,
+    font_opt: str,
+    scale: float = 1.0
+) -> str:
+    """
+    元映像の上に行ごとの textfile で drawtext を並べる。字幕が無ければ null。
+    scale は書き出し解像度に対する描画先の倍率（余白・ボックス枠の px をこれに合わせる）
+    """
+    margin_top_px, margin_bottom_px = _scaled_px(margin_top_px, scale), _scaled_px(margin_bottom_px, scale)
+    border = _box_border(scale)
+    filters = []
+    if top_text:
+        for i, line in enumerate(top_text.split("\n")):
+            tfile = workdir / f"top_{i}.txt"
+            write_utf8_text(tfile, ff_esc_basic(line))
+            y = f"{margin_top_px}+{i}*(h*{fs_top_val}*1.25)"
+            filters.append(
+                f"drawtext=textfile='{tfile.as_posix()}'{font_opt}:"
+                f"x=(w-text_w)/2:y={y}:fontsize=h*{fs_top_val}:"
+                f"fontcolor=white:box=1:boxcolor=black@{box_alpha}:boxborderw={border}:"
+                f"fix_bounds=1:text_shaping=1"
+            )
+    if bottom_text:
+        lines = bottom_text.split("\n")
+        N = len(lines)
+        for i, line in enumerate(lines):
+            tfile = workdir / f"bottom_{i}.txt"
+            write_utf8_text(tfile, ff_esc_basic(line))
+            y = f"h-( {N}-{i} )*(h*{fs_bottom_val}*1.25)-{margin_bottom_px}"
+            filters.append(
+                f"drawtext=textfile='{tfile.as_posix()}'{font_opt}:"
+                f"x=(w-text_w)/2:y={y}:fontsize=h*{fs_bottom_val}:"
+                f"fontcolor=white:box=1:boxcolor=black@{box_alpha}:boxborderw={border}:"
+                f"fix_bounds=1:text_shaping=1"
+            )
+    return ",".join(filters) if filters else "null"
+
+# ---------------- Drawtext (shorts) ----------------
+def _escape_single_quotes(p: str) -> str:
+    # concat.txt と同様、ffmpeg 引数での単一引用符エスケープ
+    return p.replace("'", "'\\''")
+
+def shorts_canvas_chain(size: Tuple[int, int] = SHORTS_SIZE) -> str:
+    """縦キャンバス（既定 1080×1920。プレビューでは縮小したサイズ）に収めて中央へパディング"""
+    cw, ch = size
+    vf_elems = []
+    # 1) SARを正規化
+    vf_elems.append("setsar=1")
+    # 2) 縦横比維持で短辺合わせ（キャンバスの枠内に収める）
+    vf_elems.append(
+        f"scale=w=trunc(iw*min({cw}/iw\\,{ch}/ih)/2)*2:"
+        f"h=trunc(ih*min({cw}/iw\\,{ch}/ih)/2)*2"
+    )
+    # 3) 出力色空間（H.264の互換性向上）
+    vf_elems.append("format=yuv420p")
+    # 4) キャンバスにパディング（中央寄せ。上寄せしたいなら y を調整）
+    vf_elems.append(f"pad={cw}:{ch}:({cw}-iw)/2:({ch}-ih)/2:black")
+    return ",".join(vf_elems)
+
+def shorts_drawtexts(top_text: str, fs_top: float, bottom_text: str, fs_bottom: float,
+                     margin_top_px: int, margin_bottom: int, box_alpha: float, font_opt: str, tmpdir: Path,
+                     scale: float = 1.0) -> List[str]:
+    """字幕の drawtext を 1 行ずつ並べたリスト（1080×1920 を scale 倍したキャンバス座標）"""
+    margin_top_px, margin_bottom = _scaled_px(margin_top_px, scale), _scaled_px(margin_bottom, scale)
+    border = _box_border(scale)
+    vf_elems = []
+    # 上部字幕：行ごとに drawtext（各行を個別に中央寄せ）
+    if top_text:
+        lines = top_text.splitlines()
+        line_spacing_ratio = 1.2  # 行間（フォントサイズ比）
+
+        for i, line in enumerate(lines):
+            # 行テキストを1行だけの textfile として保存（UTF-8 / LF）
+            top_i_path = tmpdir / f"top_line_{i}.txt"
+            write_utf8_text(top_i_path, line)
+            top_i_arg = _escape_single_quotes(top_i_path.as_posix())
+
+            # 各行について、tw/th は「その行」の幅・高さになる
+            # → x を (w - tw)/2 にすれば行ごとに厳密にセンタリングできる
+            y_expr = f"{int(margin_top_px)} + {i}*(h*{float(fs_top)}*{line_spacing_ratio})"
+
+            vf_elems.append(
+                f"drawtext=textfile='{top_i_arg}'{font_opt}:"
+                f"x=(w-tw)/2:"
+                f"y={y_expr}:"
+                f"fontsize=h*{float(fs_top)}:"
+                f"fontcolor=white:box=1:boxcolor=black@{box_alpha}:boxborderw={border}:"
+                f"fix_bounds=1:text_shaping=1"
+            )
+
+    # ▼ 下部字幕：textfile= を使う（複数行OK）
+    if bottom_text:
+        bottom_path = tmpdir / "bottom.txt"
+        write_utf8_text(bottom_path, bottom_text)
+        bottom_arg = _escape_single_quotes(bottom_path.as_posix())
+        vf_elems.append(
+        f"drawtext=textfile='{bottom_arg}'{font_opt}:"
+        f"x=(w-tw)/2:y=h-th-{int(margin_bottom)}:"
+        f"fontsize=h*{float(fs_bottom)}:fontcolor=white:"
+        f"box=1:boxcolor=black@{box_alpha}:boxborderw={border}:fix_bounds=1:text_shaping=1"
+        )
+    return vf_elems
+
+# ---------------- Caption overlays ----------------
+OVERLAY_VERSION = 1  # 描画方法を変えたら上げる（キャッシュを作り直す）
+
+def overlay_box_alpha(box_alpha: float) -> float:
+    """
+    透明キャンバス（rgba）に drawtext すると背景ボックスの α が二乗で効くので、
+    合成後に元の不透明度になるよう平方根を渡す。
+    """
+    return round(max(0.0, min(1.0, float(box_alpha))) ** 0.5, 4)
+
+def render_caption_overlay(drawtexts: str, width: int, height: int) -> Tuple[bool, Optional[Tuple[Path, int, int]]]:
+    """
+    drawtext チェーンを透明キャンバスに 1 回だけ描き、描画範囲だけを切り出した PNG にする。
+    戻り値: (成功, (PNG, x, y))。何も描かれなければ (True, None)。
+    テキスト・フォントの中身とキャンバスサイズでキャッシュし、同じ字幕はクリップ間で使い回す。
+    """
+    key = hashlib.sha256(
+        f"{OVERLAY_VERSION}|{width}x{height}|{normalize_vf_for_key(drawtexts)}".encode("utf-8")
+    ).hexdigest()
+    root = CACHE_ROOT / "overlays"
+    png, info = root / f"{key}.png", root / f"{key}.json"
+    try:
+        pos = json.loads(info.read_text(encoding="utf-8"))
+        if pos is None:
+            return True, None
+        if png.exists():
+            return True, (png, pos["x"], pos["y"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    root.mkdir(parents=True, exist_ok=True)
+    full = root / f"{key}.{uuid.uuid4().hex}.full.png"
+    ok, _ = run_ffmpeg([
+        get_ffmpeg_exe(), "-y",
+        "-f", "lavfi", "-i", f"color=c=black@0.0:s={width}x{height},format=rgba",
+        "-vf", drawtexts,
+        "-frames:v", "1",
+        str(full)
+    ])
+    if not ok:
+        full.unlink(missing_ok=True)
+        return False, None
+    try:
+        with Image.open(full) as im:
+            bbox = im.getchannel("A").getbbox()
+            if bbox is None:
+                pos = None
+            else:
+                tmp = root / f"{key}.{uuid.uuid4().hex}.tmp.png"
+                im.crop(bbox).save(tmp)
+                os.replace(tmp, png)
+                pos = {"x": bbox[0], "y": bbox[1]}
+    finally:
+        full.unlink(missing_ok=True)
+    tmp = root / f"{key}.{uuid.uuid4().hex}.tmp.json"
+    tmp.write_text(json.dumps(pos), encoding="utf-8")
+    os.replace(tmp, info)
+    return True, (png, pos["x"], pos["y"]) if pos else None
+
+def overlay_vf(pre: str, overlays: List[Tuple[Path, int, int]]) -> str:
+    """
+    pre（無ければ null）の後ろに字幕 PNG を順に overlay する vf。
+    PNG は movie= で 1 枚だけ読み、最後のフレームを繰り返して全フレームに重ねる。
+    """
+    if not overlays:
+        return pre
+    chains = [f"{pre}[base0]"]
+    for k, (png, x, y) in enumerate(overlays):
+        chains.append(f"movie='{png.as_posix()}'[ov{k}]")
+        out = "" if k == len(overlays) - 1 else f"[base{k + 1}]"
+        chains.append(f"[base{k}][ov{k}]overlay={x}:{y}{out}")
+    return ";".join(chains)
+
+# ---------------- Per-clip caption filter ----------------
+def _block_drawtexts(layout: str, style: CaptionStyle, clip: Clip, top: str, bottom: str,
+                     box_alpha: float, workdir: Path, scale: float = 1.0) -> str:
+    """上部・下部どちらか（または両方）の字幕ブロックの drawtext チェーン。無ければ空文字"""
+    font_opt = font_option(style.font_path, style.font_name)
+    if layout == "shorts":
+        return ",".join(shorts_drawtexts(top, style.fs_top, bottom, clip.fs_bottom,
+                                         style.margin_top, clip.margin_bottom, box_alpha, font_opt, workdir, scale))
+    dt = horizontal_drawtexts(workdir, top, style.fs_top, bottom, clip.fs_bottom,
+                              int(style.margin_top), int(clip.margin_bottom), box_alpha, font_opt, scale)
+    return "" if dt == "null" else dt
+
+def caption_canvas(layout: str, clip: Clip, height: Optional[int] = None) -> Tuple[str, Optional[Tuple[int, int]], float]:
+    """
+    字幕を描く前のチェーン・描画先サイズ・書き出しに対する倍率。
+    height を渡すと最初にその高さまで縮小し、以降（パディング・字幕）は縮小後の解像度で処理する。
+    横動画でサイズが分からないときは (None, None, 1.0)（呼び出し側で字幕のあとに縮小する）。
+    """
+    if layout == "shorts":
+        if not height:
+            return shorts_canvas_chain(), SHORTS_SIZE, 1.0
+        scale = height / SHORTS_SIZE[1]
+        size = (_even(SHORTS_SIZE[0] * scale), int(height))
+        return shorts_canvas_chain(size), size, scale
+    size = display_size(clip.meta)
+    if not height:
+        return "null", size, 1.0
+    if not size:
+        return None, None, 1.0
+    scale = height / size[1]
+    size = (_even(size[0] * scale), int(height))
+    return f"scale={size[0]}:{size[1]}", size, scale
+
+def caption_vf(layout: str, style: CaptionStyle, clip: Clip, workdir: Path, height: Optional[int] = None) -> str:
+    """
+    クリップ1本分の vf（shorts は 1080×1920 キャンバスへのパディング込み）。
+    height（プレビュー・静止画用）を渡すと先に縮小してから、文字サイズ・余白・枠も同じ倍率で描く。
+    画像化オンで字幕を描く解像度が分かれば、上部・下部ブロックをそれぞれ PNG にして overlay。
+    それ以外（または PNG の描画に失敗したとき）は毎フレーム drawtext。
+    """
+    workdir.mkdir(parents=True, exist_ok=True)
+    pre, size, scale = caption_canvas(layout, clip, height)
+    if pre is None:
+        # 元の解像度が分からない横動画は書き出しと同じ字幕を描いてから縮小
+        vf = caption_vf(layout, style, clip, workdir)
+        return f"scale=-2:{int(height)}" if vf == "null" else f"{vf},scale=-2:{int(height)}"
+    if style.overlay and size:
+        overlays = []
+        for name, top, bottom in (("top", style.top, ""), ("bottom", "", clip.bottom or "")):
+            block_dir = workdir / name
+            block_dir.mkdir(parents=True, exist_ok=True)
+            dt = _block_drawtexts(layout, style, clip, top, bottom, overlay_box_alpha(style.box_opacity),
+                                  block_dir, scale)
+            if not dt:
+                continue
+            ok, ov = render_caption_overlay(dt, *size)
+            if not ok:
+                overlays = None
+                break
+            if ov:
+                overlays.append(ov)
+        if overlays is not None:
+            return overlay_vf(pre, overlays)
+    dt = _block_drawtexts(layout, style, clip, style.top, clip.bottom or "", style.box_opacity, workdir, scale)
+    return ",".join(x for x in (pre, dt) if x and x != "null") or "null"
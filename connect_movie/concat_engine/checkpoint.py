@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+書き出しのチェックポイント。2段階方式のパーツごとの完了状態を
+CACHE_ROOT/jobs/<キー>/manifest.json に残し、落ちた書き出しを再実行したときは
+完了・検証済みのパーツを飛ばして続きからエンコードする。
+同じ内容の書き出しが同時に走るとディレクトリを共有するので、実行ごとに runs/<実行ID> を登録（fcntl があれば
+ロックを持ち続ける）し、ディレクトリは実行中の書き出しが残っていないときだけ消す。
+"""
+import hashlib, json, os, shutil, threading, time, uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from .cache import CACHE_ROOT
+from .probe import meta_duration, probe_media
+
+JOBS_ROOT = CACHE_ROOT / "jobs"
+JOB_TTL_SECONDS = float(os.environ.get("MOVIE_CONNECTER_JOB_TTL_H", "24")) * 3600
+MANIFEST_VERSION = 1
+RUNS_DIR = "runs"              # ジョブディレクトリ内の、実行中の書き出しの登録先
+
+_jobs_lock = threading.Lock()
+
+@contextmanager
+def _locked_jobs():
+    """ジョブディレクトリの作成・登録・削除を直列にする（fcntl があればプロセスもまたいで）"""
+    with _jobs_lock:
+        if fcntl is None:
+            yield
+            return
+        JOBS_ROOT.mkdir(parents=True, exist_ok=True)
+        with (JOBS_ROOT / ".lock").open("a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _run_alive(path: Path) -> bool:
+    """
+    実行中の書き出しの登録なら True。持ち主はロックを持ち続けるので、ロックが取れれば落ちた実行の残骸。
+    fcntl が無ければ期限内に更新されているかで判断する
+    """
+    if fcntl is None:
+        try:
+            return path.stat().st_mtime >= time.time() - JOB_TTL_SECONDS
+        except OSError:
+            return False
+    try:
+        with path.open("a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return False
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+def _has_live_run(d: Path) -> bool:
+    try:
+        return any(_run_alive(p) for p in (d / RUNS_DIR).iterdir())
+    except OSError:
+        return False
+
+def sweep_checkpoints():
+    """更新されないまま期限を過ぎたジョブディレクトリ（再実行されなかった失敗分）を消す。実行中のものは残す"""
+    if not JOBS_ROOT.exists():
+        return
+    limit = time.time() - JOB_TTL_SECONDS
+    with _locked_jobs():
+        for d in JOBS_ROOT.iterdir():
+            try:
+                if d.is_dir() and (d / "manifest.json").stat().st_mtime < limit and not _has_live_run(d):
+                    shutil.rmtree(d, ignore_errors=True)
+            except OSError:
+                pass
+
+def checkpoint_key(part_keys: List[str]) -> str:
+    return hashlib.sha256("\n".join(part_keys).encode("utf-8")).hexdigest()[:32]
+
+def has_checkpoint(part_keys: List[str]) -> bool:
+    """同じパーツ構成の書き出しが途中で止まっていれば True"""
+    return (JOBS_ROOT / checkpoint_key(part_keys) / "manifest.json").exists()
+
+class ExportCheckpoint:
+    """
+    1回の書き出し（＝パーツキーの並び）に対応するジョブディレクトリとマニフェスト。
+    パーツキーにはクリップのハッシュ・字幕・エンコード設定が入っているので、
+    同じ内容で書き出し直したときだけ同じディレクトリになる。
+    同時に同じ内容を書き出すとディレクトリを共有するので、実行ごとの run_id で登録し、
+    終わったら release（成功時は remove）で登録を外す。
+    """
+    def __init__(self, part_keys: List[str], params: dict):
+        self.key = checkpoint_key(part_keys)
+        self.dir = JOBS_ROOT / self.key
+        self.path = self.dir / "manifest.json"
+        self.lock = threading.Lock()
+        self.run_id = uuid.uuid4().hex
+        self.run_path = self.dir / RUNS_DIR / self.run_id
+        with _locked_jobs():
+            self.run_path.parent.mkdir(parents=True, exist_ok=True)
+            self._run_file = self.run_path.open("w")
+            if fcntl is not None:
+                fcntl.flock(self._run_file, fcntl.LOCK_EX)
+            self.data = self._load(part_keys)
+            self.data["params"] = params
+            self.resumed = sum(p["state"] == "done" for p in self.data["parts"])
+            self._save()
+
+    def _load(self, part_keys: List[str]) -> dict:
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            if data.get("version") == MANIFEST_VERSION and [p["key"] for p in data["parts"]] == part_keys:
+                data["attempts"] = data.get("attempts", 0) + 1
+                return data
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return {
+            "version": MANIFEST_VERSION,
+            "key": self.key,
+            "created": time.time(),
+            "attempts": 1,
+            "state": "encoding",  # encoding / concat / done
+            "parts": [{"key": k, "state": "pending"} for k in part_keys],
+        }
+
+    def _save(self):
+        self.data["updated"] = time.time()
+        tmp = self.path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp.write_text(json.dumps(self.data, ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, self.path)
+        if fcntl is None:
+            os.utime(self.run_path)  # 実行中の印（期限内に更新されていれば実行中とみなす）
+
+    def finished(self, pos: int) -> Optional[Path]:
+        """完了済みで、ファイルが記録どおり残っていて読めるパーツのパス。そうでなければ未完了に戻して None"""
+        with self.lock:
+            part = self.data["parts"][pos]
+            if part["state"] != "done":
+                return None
+            path = Path(part["path"])
+            try:
+                ok = path.stat().st_size == part["size"] and meta_duration(probe_media(str(path))) > 0
+            except OSError:
+                ok = False
+            if ok:
+                return path
+            part.update(state="pending", path="", size=0)
+            self._save()
+            return None
+
+    def mark_done(self, pos: int, path: Path):
+        """パーツ1本の完了を記録（ワーカースレッドから呼ばれる）"""
+        with self.lock:
+            self.data["parts"][pos].update(state="done", path=str(path), size=path.stat().st_size, finished=time.time())
+            self._save()
+
+    def set_state(self, state: str):
+        with self.lock:
+            self.data["state"] = state
+            self._save()
+
+    def missing(self) -> List[int]:
+        with self.lock:
+            return [i for i, p in enumerate(self.data["parts"]) if p["state"] != "done"]
+
+    def release(self):
+        """この実行の登録を外す（何度呼んでもよい）。ジョブディレクトリは続きから再開できるように残す"""
+        if self._run_file is None:
+            return
+        try:
+            self.run_path.unlink()
+        except OSError:
+            pass
+        self._run_file.close()
+        self._run_file = None
+
+    def remove(self) -> bool:
+        """
+        書き出しが終わったら登録を外し、ほかに実行中の書き出しが無ければジョブディレクトリごと消す
+        （共有のパーツキャッシュは残る）。消したら True
+        """
+        with _locked_jobs():
+            self.release()
+            if _has_live_run(self.dir):
+                return False
+            shutil.rmtree(self.dir, ignore_errors=True)
+            return True
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+コマンドライン: マニフェスト（JSON / JSONL）に並べたジョブをまとめてレンダリングする。
+
+    python -m concat_engine render jobs.jsonl --out-dir out
+    python -m concat_engine probe clip.mp4
+    python -m concat_engine encoders [--refresh]
+    python -m concat_engine bench --out bench.json --golden golden.json
+    MOVIE_CONNECTER_WORKER_TOKEN=… python -m concat_engine worker --host 0.0.0.0 --port 8610
+    python -m concat_engine render jobs.jsonl --remote host1:8610,host2:8610
+
+render はジョブごとに結果を1行の JSON で標準出力へ、進捗は標準エラーへ出す。
+1件でも失敗すれば終了コードは 1（bench は出力がゴールデンと違うときも 1）。
+"""
+import argparse, json, sys, time
+from pathlib import Path
+from typing import List, Optional
+
+from .encoders import encoder_registry
+from .ffmpeg import default_workers, has_ffmpeg
+from .jobs import Job, load_manifest
+from .probe import probe_media
+from .remote import WORKER_PORT, WORKER_TOKEN, RemotePool, serve_worker
+from .render import RenderError, Reporter, render_export, render_preview
+
+class CliReporter(Reporter):
+    """標準エラーに進捗を出す（端末なら1行を書き換え、それ以外は数秒おき）"""
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.tty = sys.stderr.isatty()
+        self.t_last = 0.0
+
+    def progress(self, fraction: float, text: str):
+        now = time.monotonic()
+        if not self.tty and now - self.t_last < 5:
+            return
+        self.t_last = now
+        line = f"{self.prefix} {fraction * 100:5.1f}% {text}"
+        sys.stderr.write(f"\r{line[:160]:<160}" if self.tty else line + "\n")
+        sys.stderr.flush()
+
+    def clear(self):
+        if self.tty:
+            sys.stderr.write("\r" + " " * 160 + "\r")
+            sys.stderr.flush()
+
+    def notice(self, text: str):
+        self.clear()
+        sys.stderr.write(f"{self.prefix} {text}\n")
+
+def group_renditions(jobs: List[Job]) -> List[List[Job]]:
+    """クリップの並びが同じジョブをまとめる（マニフェストでの順番は最初に出てきた位置のまま）"""
+    groups = {}
+    for job in jobs:
+        groups.setdefault(tuple(str(Path(c.path).resolve()) for c in job.clips), []).append(job)
+    return list(groups.values())
+
+def cmd_render(args) -> int:
+    if not has_ffmpeg():
+        sys.stderr.write("FFmpeg が見つかりません。\n")
+        return 2
+    try:
+        jobs = load_manifest(Path(args.manifest))
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"{e}\n")
+        return 2
+    out_dir = Path(args.out_dir)
+    # --remote が無ければ MOVIE_CONNECTER_WORKERS（render_export の既定）
+    remote = RemotePool(_csv(args.remote)) if args.remote else None
+    # --multi-output: 同じクリップ並びのジョブ（横動画とショートなど）はクリップを1回ずつデコードして同時に書き出す
+    groups = group_renditions(jobs) if args.multi_output and not args.preview else [[job] for job in jobs]
+    failed = 0
+    n = 0
+    for group in groups:
+        outs = []
+        for job in group:
+            out_path = out_dir / (f"preview_{Path(job.output).name}" if args.preview else job.output)
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            outs.append(out_path)
+        n += len(group)
+        prefix = f"[{n}/{len(jobs)} {' + '.join(job.name for job in group)}]"
+        t0 = time.perf_counter()
+        results = [{"name": job.name, "output": str(out_path)} for job, out_path in zip(group, outs)]
+        try:
+            if args.preview:
+                res = [render_preview(group[0], outs[0], workers=args.workers, use_part_cache=not args.no_part_cache,
+                                      reporter=CliReporter(prefix))]
+            else:
+                first = render_export(group[0], outs[0], workers=args.workers, use_part_cache=not args.no_part_cache,
+                                      reporter=CliReporter(prefix), renditions=list(zip(group[1:], outs[1:])),
+                                      remote=remote)
+                res = [first, *first.renditions]
+            for result, r in zip(results, res):
+                result.update(ok=True, engine=r.engine, timings={name: round(sec, 2) for name, sec in r.timer.rows},
+                              usage=r.usage)
+            sys.stderr.write(f"{prefix} 完了 {', '.join(str(p) for p in outs)}\n")
+        except RenderError as e:
+            failed += len(group)
+            for result in results:
+                result.update(ok=False, error=str(e), log_tail=e.log[-2000:])
+            sys.stderr.write(f"{prefix} 失敗: {e}\n")
+        for result in results:
+            result["seconds"] = round(time.perf_counter() - t0, 2)
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+        if failed and args.fail_fast:
+            break
+    return 1 if failed else 0
+
+def cmd_bench(args) -> int:
+    from . import bench
+    if not has_ffmpeg():
+        sys.stderr.write("FFmpeg が見つかりません。\n")
+        return 2
+    try:
+        items = bench.scenarios(_csv(args.layouts), _csv(args.kinds), _csv(args.profiles),
+                                [int(n) for n in _csv(args.clips)])
+        unknown = {sc.profile for sc in items} - set(bench.PROFILES)
+        if unknown:
+            raise ValueError(f"不明なプロファイル: {', '.join(sorted(unknown))}（{' / '.join(bench.PROFILES)}）")
+        golden_path = Path(args.golden) if args.golden else None
+        golden = json.loads(golden_path.read_text(encoding="utf-8")) if golden_path and golden_path.exists() else None
+        base = json.loads(Path(args.compare).read_text(encoding="utf-8")) if args.compare else None
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"{e}\n")
+        return 2
+    # --golden を指定したときだけ出力を比べる（ファイルがまだ無ければ全部 new）
+    report = bench.run_bench(items, workers=args.workers, repeat=args.repeat,
+                             golden=(golden or {}) if golden_path else None)
+    Path(args.out).write_text(json.dumps(report, ensure_ascii=False, indent=1), encoding="utf-8")
+    sys.stderr.write(f"結果: {args.out}\n")
+    if golden_path and (args.update_golden or golden is None):
+        golden_path.write_text(json.dumps({**(golden or {}), **bench.golden_from(report)}, ensure_ascii=False, indent=1),
+                               encoding="utf-8")
+        sys.stderr.write(f"ゴールデンを書き出しました: {golden_path}\n")
+    if base is not None:
+        print("\n".join(bench.compare_reports(base, report)))
+    failed = [r for r in report["results"] if not r["ok"]]
+    mismatched = [r for r in report["results"] if r.get("golden") == "mismatch" and not args.update_golden]
+    for r in mismatched:
+        sys.stderr.write(f"出力がゴールデンと違います: {r['scenario']}: {'; '.join(r['golden_diffs'])}\n")
+    return 1 if failed or mismatched else 0
+
+def _csv(value: str) -> List[str]:
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+def cmd_worker(args) -> int:
+    if not has_ffmpeg():
+        sys.stderr.write("FFmpeg が見つかりません。\n")
+        return 2
+    try:
+        srv = serve_worker(args.host, args.port, slots=args.slots, token=args.token or WORKER_TOKEN)
+    except ValueError as e:
+        sys.stderr.write(f"{e}\n")
+        return 2
+    except OSError as e:
+        sys.stderr.write(f"{args.host}:{args.port} で待ち受けできません: {e}\n")
+        return 2
+    sys.stderr.write(f"ワーカー起動: {args.host}:{args.port}（同時 {srv.RequestHandlerClass.state.slots} 本）\n")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+    return 0
+
+def cmd_encoders(args) -> int:
+    if not has_ffmpeg():
+        sys.stderr.write("FFmpeg が見つかりません。\n")
+        return 2
+    registry = encoder_registry(refresh=args.refresh)
+    if not registry.done.is_set():
+        sys.stderr.write("エンコーダの速さを計測しています（このマシンで最初の1回だけ）…\n")
+    registry.wait()
+    print(json.dumps(registry.to_dict(), ensure_ascii=False, indent=1))
+    return 0
+
+def cmd_probe(args) -> int:
+    for path in args.files:
+        print(json.dumps({"path": path, "meta": probe_media(path)}, ensure_ascii=False))
+    return 0
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m concat_engine", description="動画結合（字幕焼き込み）のヘッドレス実行")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("render", help="マニフェストのジョブをレンダリング")
+    p.add_argument("manifest", help="ジョブのマニフェスト（.json / .jsonl）")
+    p.add_argument("--out-dir", default="out", help="出力先ディレクトリ（既定: ./out）")
+    p.add_argument("--workers", type=int, default=default_workers(), help="クリップの同時エンコード数")
+    p.add_argument("--no-part-cache", action="store_true", help="パーツキャッシュを使わない")
+    p.add_argument("--preview", action="store_true", help="本番ではなくプレビュー設定で書き出す")
+    p.add_argument("--fail-fast", action="store_true", help="失敗したジョブがあればそこで止める")
+    p.add_argument("--multi-output", action="store_true",
+                   help="クリップの並びが同じジョブ（横動画とショートなど）を1回のデコードで同時に書き出す")
+    p.add_argument("--remote", help="クリップのエンコードを任せるワーカー（host:port のカンマ区切り。"
+                                    "既定: MOVIE_CONNECTER_WORKERS）")
+    p.set_defaults(func=cmd_render)
+
+    p = sub.add_parser("bench", help="合成クリップでプレビュー・書き出しの速度を計測し、出力をゴールデンと比べる")
+    p.add_argument("--out", default="bench.json", help="結果の JSON（既定: ./bench.json）")
+    p.add_argument("--layouts", default="horizontal,shorts", help="カンマ区切り（既定: horizontal,shorts）")
+    p.add_argument("--kinds", default="preview,window,export",
+                   help="カンマ区切り（既定: preview,window,export。window はつなぎ目の前後だけの区間プレビュー）")
+    p.add_argument("--profiles", default="360p,720p", help="カンマ区切りの解像度プロファイル（360p / 720p / 1080p / vertical）")
+    p.add_argument("--clips", default="1,3", help="カンマ区切りのクリップ本数（既定: 1,3）")
+    p.add_argument("--workers", type=int, default=default_workers(), help="クリップの同時エンコード数")
+    p.add_argument("--repeat", type=int, default=1, help="シナリオごとの実行回数（いちばん速い回を採用）")
+    p.add_argument("--golden", help="出力のチェック値の JSON。無ければ今回の結果で作る")
+    p.add_argument("--update-golden", action="store_true", help="ゴールデンを今回の結果で上書きする")
+    p.add_argument("--compare", help="前回の結果の JSON。シナリオごとの差を表で出す")
+    p.set_defaults(func=cmd_bench)
+
+    p = sub.add_parser("worker", help="他のマシンから送られたクリップをエンコードするワーカーを起動")
+    p.add_argument("--host", default="127.0.0.1", help="待ち受けるアドレス（既定: 127.0.0.1。LAN から使うなら 0.0.0.0 とトークン）")
+    p.add_argument("--port", type=int, default=WORKER_PORT, help=f"ポート（既定: {WORKER_PORT}）")
+    p.add_argument("--slots", type=int, default=default_workers(), help="同時に走らせる ffmpeg の数")
+    p.add_argument("--token", help="共有トークン（既定: MOVIE_CONNECTER_WORKER_TOKEN）")
+    p.set_defaults(func=cmd_worker)
+
+    p = sub.add_parser("encoders", help="使えるエンコーダと preset ごとの速さ（fps）を表示")
+    p.add_argument("--refresh", action="store_true", help="保存した計測結果を使わずに計り直す")
+    p.set_defaults(func=cmd_encoders)
+
+    p = sub.add_parser("probe", help="クリップのメタデータを JSON で表示")
+    p.add_argument("files", nargs="+")
+    p.set_defaults(func=cmd_probe)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+使える映像エンコーダと、このマシンでの速さ（preset ごとの fps）。
+起動時に1回だけ調べてディスクに保存し、同じ ffmpeg・同じマシンなら次からはそれを読む。
+「N 分以内に書き出す」ときは、クリップの尺と解像度から所要時間を見積もって、間に合う中で画質（圧縮効率）の
+いちばん良い preset・エンコーダを選ぶ。
+"""
+import json, os, platform, re, subprocess, threading, time
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .cache import CACHE_ROOT
+from .ffmpeg import CancelToken, get_ffmpeg_exe, run_ffmpeg
+
+REGISTRY_PATH = CACHE_ROOT / "encoders.json"
+REGISTRY_VERSION = 2               # 計測方法を変えたら上げる（計り直す）
+BENCH_SIZE = (1280, 720)
+BENCH_FRAMES = 60
+BENCH_MAX_SECONDS = 15.0           # 1回がこれより遅い preset（とそれより遅いもの）は計らない
+BUDGET_SAFETY = 0.85               # 見積もりは予算のこの割合に収める（デコード・連結・見積もりの誤差の分）
+DECODE_OVERHEAD = 1.15             # 実クリップのデコードと字幕の分、合成映像での計測より遅くなる
+MAX_REGISTRY_SECONDS = 300         # 計測全体の上限
+# 計測はスケジューラの外で走るので、スレッドはジョブ1件分くらい（全コアは使わない）に抑える
+BENCH_THREADS = max(1, min(4, os.cpu_count() or 1))
+BUDGET_WAIT_SECONDS = 5.0          # 書き出しが計測の終わりを待つ上限（過ぎたら指定の preset で書き出す）
+
+@dataclass(frozen=True)
+class EncoderSpec:
+    """エンコーダごとの引数の作り方。presets は速い順、ranks は圧縮効率の目安（大きいほど同じ画質で小さい）"""
+    name: str
+    codec: str
+    label: str
+    presets: Tuple[str, ...]
+    ranks: Tuple[float, ...]
+    default_preset: str
+    preset_opt: str = "-preset"
+    crf_scale: float = 1.0          # x264 の CRF から換算（見た目が同じくらいになるように）
+    crf_offset: float = 0.0
+    crf_max: int = 51
+    extra: Tuple[str, ...] = ()
+
+    def crf(self, x264_crf: int) -> int:
+        return max(0, min(self.crf_max, int(round(x264_crf * self.crf_scale + self.crf_offset))))
+
+    def args(self, crf: int, preset: str) -> List[str]:
+        preset = preset if preset in self.presets else self.default_preset
+        return ["-c:v", self.name, "-crf", str(self.crf(crf)), self.preset_opt, preset, *self.extra]
+
+X264_PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow")
+ENCODER_SPECS: Dict[str, EncoderSpec] = {s.name: s for s in (
+    EncoderSpec("libx264", "h264", "H.264（x264）", X264_PRESETS, tuple(float(i) for i in range(9)), "medium"),
+    # HEVC・AV1 は再生できないブラウザ・端末がある。MP4 で Apple 系にも通るよう hvc1 タグを付ける
+    EncoderSpec("libx265", "hevc", "HEVC（x265）", X264_PRESETS, (4.5, 5.5, 6.5, 7.0, 7.5, 8.5, 9.0, 9.5, 10.0),
+                "medium", crf_offset=4, extra=("-tag:v", "hvc1", "-x265-params", "log-level=error")),
+    EncoderSpec("libsvtav1", "av1", "AV1（SVT-AV1）", ("12", "10", "8", "6", "4"), (6.0, 7.5, 9.0, 10.0, 11.0), "8",
+                crf_scale=1.4, crf_offset=2, crf_max=63),
+    EncoderSpec("libaom-av1", "av1", "AV1（libaom）", ("8", "6", "5", "4"), (8.0, 9.5, 10.5, 11.0), "6",
+                preset_opt="-cpu-used", crf_scale=1.4, crf_offset=2, crf_max=63, extra=("-b:v", "0", "-row-mt", "1", "-strict", "experimental")),
+)}
+DEFAULT_ENCODER = "libx264"
+_ENCODER_LINE_RE = re.compile(r"^\s*V\S{5}\s+(\S+)\s+(.*?)(?:\s+\(codec (\w+)\))?\s*$")
+_VIDEO_CODECS = {"h264", "hevc", "av1"}
+
+def encoder_args(name: str, crf: int, preset: str) -> List[str]:
+    """映像のエンコード引数（知らないエンコーダ名は x264 として扱う）"""
+    return ENCODER_SPECS.get(name, ENCODER_SPECS[DEFAULT_ENCODER]).args(crf, preset)
+
+# ---------------- Registry ----------------
+class EncoderRegistry:
+    """
+    ffmpeg の版・検出したエンコーダ・preset ごとの fps（BENCH_SIZE・BENCH_THREADS スレッドでの値）。
+    encoders は ffmpeg -encoders に出た H.264 / HEVC / AV1 のもの全部（ハードウェアも含む。使えるとは限らない）、
+    speeds は計れたものだけ（＝ このマシンで実際にエンコードできたもの）。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.version = ""
+        self.encoders: Dict[str, str] = {}
+        self.speeds: Dict[str, Dict[str, float]] = {}
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def key(self) -> dict:
+        return {"registry": REGISTRY_VERSION, "ffmpeg": get_ffmpeg_exe(), "version": self.version,
+                "host": platform.node(), "cpus": os.cpu_count() or 1, "threads": BENCH_THREADS}
+
+    def selectable(self) -> List[str]:
+        """アプリで選べるエンコーダ（引数の作り方を知っていて、ffmpeg に入っているもの）"""
+        names = [n for n in ENCODER_SPECS if n in self.encoders]
+        return names or [DEFAULT_ENCODER]
+
+    def fps(self, encoder: str, preset: str) -> Optional[float]:
+        with self.lock:
+            return self.speeds.get(encoder, {}).get(preset)
+
+    def detect(self) -> bool:
+        """版とエンコーダの一覧（速い。ffmpeg が無ければ False）"""
+        try:
+            proc = subprocess.run([get_ffmpeg_exe(), "-hide_banner", "-encoders"], stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT, universal_newlines=True)
+            ver = subprocess.run([get_ffmpeg_exe(), "-version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 universal_newlines=True)
+        except OSError:
+            return False
+        encoders = {}
+        for line in proc.stdout.splitlines():
+            m = _ENCODER_LINE_RE.match(line)
+            if m and (m.group(3) or m.group(1)) in _VIDEO_CODECS:
+                encoders[m.group(1)] = m.group(3) or m.group(1)
+        with self.lock:
+            self.version = (ver.stdout.splitlines() or [""])[0]
+            self.encoders = encoders
+        return proc.returncode == 0
+
+    def load(self) -> bool:
+        """ディスクの計測結果が今の ffmpeg・マシンのものなら読む"""
+        try:
+            data = json.loads(REGISTRY_PATH.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return False
+        if data.get("key") != self.key:
+            return False
+        with self.lock:
+            self.speeds = {k: dict(v) for k, v in data.get("speeds", {}).items()}
+        self.done.set()
+        return True
+
+    def save(self):
+        with self.lock:
+            data = {"key": self.key, "encoders": self.encoders, "speeds": self.speeds, "measured": round(time.time())}
+        try:
+            REGISTRY_PATH.parent.mkdir(parents=True, exist_ok=True)
+            tmp = REGISTRY_PATH.with_suffix(".tmp")
+            tmp.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding="utf-8")
+            os.replace(tmp, REGISTRY_PATH)
+        except OSError:
+            pass
+
+    def benchmark(self):
+        """選べるエンコーダの preset を速い順に計る。遅すぎる preset に達したらそのエンコーダは打ち切る"""
+        t_start = time.perf_counter()
+        speeds: Dict[str, Dict[str, float]] = {}
+        for name in self.selectable():
+            spec = ENCODER_SPECS[name]
+            speeds[name] = {}
+            for preset in spec.presets:
+                if time.perf_counter() - t_start > MAX_REGISTRY_SECONDS:
+                    break
+                fps = _bench_one(spec, preset)
+                if fps is None:
+                    break
+                speeds[name][preset] = fps
+                with self.lock:
+                    self.speeds[name] = dict(speeds[name])  # 計れた分から見えるようにする
+                if BENCH_FRAMES / fps > BENCH_MAX_SECONDS:
+                    break
+            if not speeds[name]:
+                speeds.pop(name)
+        with self.lock:
+            self.speeds = speeds
+        self.save()
+        self.done.set()
+
+    def start(self):
+        """計測結果が無ければ裏で計り始める（何度呼んでもよい）"""
+        with self.lock:
+            if self.done.is_set() or self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.benchmark, name="encoder-benchmark", daemon=True)
+            self.thread.start()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        self.start()
+        return self.done.wait(timeout)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {"version": self.version, "encoders": dict(self.encoders), "selectable": self.selectable(),
+                    "speeds": {k: dict(v) for k, v in self.speeds.items()}, "ready": self.done.is_set()}
+
+def _bench_one(spec: EncoderSpec, preset: str) -> Optional[float]:
+    """合成映像 BENCH_FRAMES 枚をエンコードする速さ（fps）。失敗・時間切れなら None"""
+    w, h = BENCH_SIZE
+    cmd = [get_ffmpeg_exe(), "-y", "-f", "lavfi", "-i", f"testsrc2=size={w}x{h}:rate=30",
+           "-frames:v", str(BENCH_FRAMES), *spec.args(23, preset), "-threads", str(BENCH_THREADS), "-f", "null", "-"]
+    cancel = CancelToken()
+    timer = threading.Timer(BENCH_MAX_SECONDS * 2, cancel.cancel)
+    timer.start()
+    t0 = time.perf_counter()
+    try:
+        ok, _ = run_ffmpeg(cmd, cancel=cancel)
+    finally:
+        timer.cancel()
+    wall = time.perf_counter() - t0
+    return round(BENCH_FRAMES / wall, 2) if ok and wall > 0 else None
+
+_registry: Optional[EncoderRegistry] = None
+_registry_lock = threading.Lock()
+
+def encoder_registry(refresh: bool = False) -> EncoderRegistry:
+    """
+    プロセスで1つのレジストリ。最初の呼び出しでエンコーダを検出し、ディスクに今のマシンの計測結果が無ければ
+    裏で計り始める（refresh なら計り直す）。計測を待つときは wait()。
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None or refresh:
+            reg = EncoderRegistry()
+            reg.detect()
+            if refresh or not reg.load():
+                reg.start()
+            _registry = reg
+        return _registry
+
+# ---------------- Time budget ----------------
+@dataclass
+class BudgetPlan:
+    encoder: str
+    preset: str
+    estimate: float                # 見積もりの所要時間（秒）
+    fits: bool                     # 予算に収まる見込みか（False なら候補の中でいちばん速い設定）
+    pixels: float = 0.0            # エンコードする総画素数（フレーム数 × 解像度）
+    candidates: List[Tuple[str, str, float]] = field(default_factory=list)  # 計れた全設定の (エンコーダ, preset, 秒)
+
+    def apply(self, job):
+        """encoder / preset を置き換えたジョブ（time_budget は使い終わったので 0 に）"""
+        return replace(job, encode=replace(job.encode, encoder=self.encoder, preset=self.preset, time_budget=0.0))
+
+    def text(self) -> str:
+        spec = ENCODER_SPECS.get(self.encoder)
+        label = spec.label if spec is not None else self.encoder
+        est = f"見積もり 約 {_fmt_seconds(self.estimate)}"
+        if self.fits:
+            return f"時間内に収まる中でいちばん画質の良い {label} / preset {self.preset} で書き出します（{est}）。"
+        return f"時間内に収まる設定がないため、いちばん速い {label} / preset {self.preset} で書き出します（{est}）。"
+
+def _fmt_seconds(s: float) -> str:
+    return f"{s / 60:.1f} 分" if s >= 90 else f"{s:.0f} 秒"
+
+def plan_budget(pixels: float, budget_seconds: float, encoders: Sequence[str], registry: EncoderRegistry,
+                threads: Optional[int] = None) -> Optional[BudgetPlan]:
+    """
+    総画素数 pixels をエンコードする設定を選ぶ。encoders は候補（並びは問わない）。
+    threads はこのジョブが使える CPU スレッド数（既定は全コア）。計測の BENCH_THREADS との比で速さを見積もる。
+    総画素数が分からない（0 以下）・計測結果が1つも無ければ None（予算なしとして指定の設定で書き出す）。
+    """
+    if pixels <= 0:
+        return None
+    bench_pixels = BENCH_SIZE[0] * BENCH_SIZE[1]
+    speedup = (threads or os.cpu_count() or 1) / BENCH_THREADS
+    options = []  # (画質の目安, 秒, エンコーダ, preset)
+    with registry.lock:
+        speeds = {k: dict(v) for k, v in registry.speeds.items()}
+    for name in encoders:
+        spec = ENCODER_SPECS.get(name)
+        if spec is None:
+            continue
+        for preset, fps in speeds.get(name, {}).items():
+            if fps <= 0 or preset not in spec.presets:
+                continue
+            seconds = pixels / (fps * bench_pixels * speedup) * DECODE_OVERHEAD
+            options.append((spec.ranks[spec.presets.index(preset)], seconds, name, preset))
+    if not options:
+        return None
+    candidates = [(name, preset, round(sec, 1)) for _, sec, name, preset in sorted(options, key=lambda o: o[1])]
+    fitting = [o for o in options if o[1] <= budget_seconds * BUDGET_SAFETY]
+    if fitting:
+        rank, seconds, name, preset = max(fitting, key=lambda o: (o[0], -o[1]))
+        return BudgetPlan(name, preset, seconds, True, pixels, candidates)
+    rank, seconds, name, preset = min(options, key=lambda o: o[1])
+    return BudgetPlan(name, preset, seconds, False, pixels, candidates)
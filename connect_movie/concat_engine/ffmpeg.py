@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""ffmpeg の実行（進捗つき・並列）と進捗・所要時間の集計"""
+import contextvars, os, re, subprocess, sys, threading, time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+import imageio_ffmpeg
+
+from .telemetry import ProcessUsage, record_process
+
+# --- FFmpeg path via imageio-ffmpeg ---
+def get_ffmpeg_exe() -> str:
+    try:
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return "ffmpeg"
+
+_ffmpeg_found = False
+
+def has_ffmpeg() -> bool:
+    """ffmpeg が起動できるか。見つかったらプロセス内で覚えておき、2回目からは起動しない"""
+    global _ffmpeg_found
+    if _ffmpeg_found:
+        return True
+    try:
+        ff = get_ffmpeg_exe()
+        subprocess.run([ff, "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    except Exception:
+        return False
+    _ffmpeg_found = True
+    return True
+
+# -progress の出力行（ログには残さない）
+_PROGRESS_LINE_RE = re.compile(
+    r"^(frame|fps|stream_\d+_\d+_\w+|bitrate|total_size|out_time(?:_us|_ms)?|dup_frames|drop_frames|speed|progress)=(.*)$"
+)
+_DURATION_RE = re.compile(r"^\s*Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+# -nostats なしの統計行（\r 区切りで1行ずつ届く）
+_STATS_LINE_RE = re.compile(r"^frame=\s*(\d+)\s+fps=")
+
+# ---------------- Log capture ----------------
+LOG_TAIL_LINES = 200   # 返すログの末尾の行数
+LOG_ERROR_LINES = 20   # それとは別に残すエラーらしい行の数
+# ffmpeg のエラー文の書き出し（showinfo などの "unknown" のような値とは区別するため大文字小文字は区別する）
+_ERROR_LINE_RE = re.compile(r"\b(?:Error|error while|Invalid|[Ff]ailed|Cannot|[Cc]ould not|Unable|No such|not found|"
+                            r"Unknown|Unrecognized|does not|mismatch)")
+_FILTER_ERROR_RES = (
+    re.compile(r"Error initializing filter '(\w+)'"),
+    re.compile(r"No such filter: '(\w+)'"),
+    re.compile(r"^\[Parsed_(\w+?)_\d+ @ "),
+)
+
+class LogTail:
+    """
+    ffmpeg の出力を全部は持たず、末尾 max_lines 行・エラーらしい行（最大 max_errors 行）・失敗したフィルタ名・
+    最後の統計行（frame=…）だけを残す。長いエンコードでもメモリとエラー表示が膨らまない。
+    """
+    def __init__(self, max_lines: int = LOG_TAIL_LINES, max_errors: int = LOG_ERROR_LINES):
+        self.lines = deque(maxlen=max_lines)
+        self.errors = deque(maxlen=max_errors)
+        self.failed_filter = ""
+        self.dropped = 0
+        self.stats = ""
+        self.frames = 0
+
+    def add(self, line: str):
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            return
+        m = _STATS_LINE_RE.match(line.strip())
+        if m:
+            self.stats, self.frames = line.strip(), int(m.group(1))
+            return
+        if _ERROR_LINE_RE.search(line):
+            self.errors.append(line)
+            for r in _FILTER_ERROR_RES:
+                fm = r.search(line)
+                if fm:
+                    self.failed_filter = fm.group(1)
+                    break
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+
+    def text(self) -> str:
+        """失敗したフィルタ → 末尾から押し出されたエラー行 → 末尾の行 → 最後の統計行"""
+        head = [f"失敗したフィルタ: {self.failed_filter}"] if self.failed_filter else []
+        if self.dropped:
+            kept = set(self.lines)
+            lost = [e for e in self.errors if e not in kept]
+            head += [*lost, f"…（{self.dropped} 行省略）…"]
+        return "\n".join([*head, *self.lines, *([self.stats] if self.stats else [])]) + "\n"
+
+# ---------------- Resource usage ----------------
+def _proc_io(pid: int) -> Tuple[Optional[int], Optional[int]]:
+    """/proc/<pid>/io の読み書きバイト数（Linux 以外・読めなければ None）"""
+    try:
+        with open(f"/proc/{pid}/io", encoding="ascii") as f:
+            io = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(io["rchar"]), int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def _reap(proc: subprocess.Popen):
+    """終了を待って回収し、取れれば rusage を返す（wait4 の無い環境・別スレッドが先に回収したときは None）"""
+    if hasattr(os, "wait4"):
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return usage
+        except ChildProcessError:
+            pass
+    proc.wait()
+    return None
+
+class CancelToken:
+    """実行中の ffmpeg を登録しておき、cancel() で全部止める（別スレッドから呼んでよい）"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.procs: List[subprocess.Popen] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def register(self, proc: subprocess.Popen):
+        with self.lock:
+            self.procs = [p for p in self.procs if p.poll() is None]
+            self.procs.append(proc)
+            if self.event.is_set():
+                proc.kill()
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            for p in self.procs:
+                if p.poll() is None:
+                    p.kill()
+
+def _parse_speed(v: str) -> float:
+    try:
+        return float(v.strip().rstrip("x"))
+    except ValueError:
+        return 0.0
+
+def run_ffmpeg(cmd: List[str],
+               on_start: Optional[Callable[[subprocess.Popen], None]] = None,
+               on_progress: Optional[Callable[[dict], None]] = None,
+               cancel: Optional[CancelToken] = None,
+               on_line: Optional[Callable[[str], None]] = None) -> Tuple[bool, str]:
+    """
+    on_progress を渡すと -progress pipe:1 を付けて実行し、進捗を逐次通知する。
+    通知内容: {"out_time": 秒, "duration": 入力の長さ(秒・不明なら0), "fps", "speed", "done"}
+    cancel を渡すとプロセスを登録し、キャンセルされたら止める（失敗として返る）。
+    返すログは LogTail で末尾とエラー行だけ。全行を解析したいときは on_line(行) で受け取る。
+    1回ごとのリソース使用量は telemetry に記録する。
+    """
+    if cancel is not None and cancel.cancelled:
+        return False, "Cancelled"
+    if on_progress is not None:
+        cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+    try:
+        t0 = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        if cancel is not None:
+            cancel.register(proc)
+        if on_start is not None:
+            on_start(proc)
+        logs = LogTail()
+        duration = 0.0
+        in_inputs = True
+        state = {}
+        for line in proc.stdout:
+            if on_progress is not None:
+                pm = _PROGRESS_LINE_RE.match(line.strip())
+                if pm:
+                    key, value = pm.group(1), pm.group(2)
+                    state[key] = value
+                    if key == "progress":
+                        us = state.get("out_time_us") or state.get("out_time_ms") or "0"
+                        on_progress({
+                            "out_time": max(0.0, int(us) / 1e6) if us.lstrip("-").isdigit() else 0.0,
+                            "duration": duration,
+                            "fps": _parse_speed(state.get("fps", "0")),
+                            "speed": _parse_speed(state.get("speed", "0")),
+                            "done": value == "end",
+                        })
+                    continue
+                # 入力ごとの Duration を合計（出力セクションに入ったら止める）
+                if line.startswith("Output #"):
+                    in_inputs = False
+                m = _DURATION_RE.match(line) if in_inputs else None
+                if m:
+                    duration += int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+            if on_line is not None:
+                on_line(line)
+            logs.add(line)
+        read_bytes, written_bytes = _proc_io(proc.pid)  # 回収する前（ゾンビの間）に読む
+        usage = _reap(proc)
+        ok = proc.returncode == 0
+        _record(cmd, ok, time.perf_counter() - t0, usage, read_bytes, written_bytes,
+                int(state["frame"]) if state.get("frame", "").isdigit() else logs.frames, logs)
+        return ok, logs.text()
+    except Exception as e:
+        return False, f"Exception: {e}"
+
+def _record(cmd: List[str], ok: bool, wall: float, usage, read_bytes: Optional[int], written_bytes: Optional[int],
+            frames: int, logs: LogTail):
+    cpu = peak = None
+    if usage is not None:
+        cpu = usage.ru_utime + usage.ru_stime
+        # ru_maxrss は Linux では KB、macOS ではバイト
+        peak = usage.ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+        if read_bytes is None:
+            read_bytes, written_bytes = usage.ru_inblock * 512, usage.ru_oublock * 512
+    record_process(ProcessUsage(
+        output=Path(cmd[-1]).name or cmd[-1],
+        ok=ok,
+        wall_s=round(wall, 3),
+        cpu_s=round(cpu, 3) if cpu is not None else None,
+        peak_rss_mb=round(peak, 1) if peak is not None else None,
+        read_bytes=read_bytes,
+        written_bytes=written_bytes,
+        frames=frames,
+        fps=round(frames / wall, 1) if wall > 0 else 0.0,
+        errors=[] if ok else list(logs.errors),
+        failed_filter="" if ok else logs.failed_filter,
+    ))
+
+def default_workers() -> int:
+    return max(1, min(4, os.cpu_count() or 1))
+
+def x264_threads_for(workers: int, cpus: Optional[int] = None) -> int:
+    """CPUコア数（cpus を渡せばその数）を並列数で割った x264 のスレッド数（最低1）"""
+    return max(1, (cpus or os.cpu_count() or 1) // max(1, int(workers)))
+
+def run_ffmpeg_parallel(cmds: List[List[str]], workers: int,
+                        on_progress: Optional[Callable[[int, dict], None]] = None,
+                        on_finish: Optional[Callable[[int, float], None]] = None,
+                        poll: Optional[Callable[[], None]] = None,
+                        cancel: Optional[CancelToken] = None,
+                        runner: Optional[Callable[..., Tuple[bool, str]]] = None) -> Tuple[bool, int, str]:
+    """
+    複数の ffmpeg コマンドを最大 workers 本まで同時実行する。
+    runner を渡すと run_ffmpeg の代わりにそれで実行する（同じ引数・戻り値。RemotePool.run など）。
+    1本でも失敗したら未着手分を取り消し、実行中のプロセスも止める。
+    on_progress(添字, 進捗) / on_finish(添字, 秒) はワーカースレッドから、
+    poll() は呼び出し元スレッドから約0.5秒ごとに呼ばれる（Streamlit の表示更新用）。
+    cancel がキャンセルされると実行中のプロセスが止まり、失敗として扱われる。
+    戻り値: (全成功か, 失敗したコマンドの添字 or -1, 失敗時のログ)
+    """
+    lock = threading.Lock()
+    abort = threading.Event()
+    procs: List[subprocess.Popen] = []
+
+    def _register(proc: subprocess.Popen):
+        with lock:
+            procs.append(proc)
+            if abort.is_set():
+                proc.kill()
+
+    def _run(i: int, cmd: List[str]) -> Tuple[bool, str]:
+        if abort.is_set():
+            return False, "Cancelled"
+        t0 = time.perf_counter()
+        cb = (lambda info: on_progress(i, info)) if on_progress is not None else None
+        ok, log = (runner or run_ffmpeg)(cmd, on_start=_register, on_progress=cb, cancel=cancel)
+        if ok and on_finish is not None:
+            on_finish(i, time.perf_counter() - t0)
+        return ok, log
+
+    failed_idx, failed_log = -1, ""
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as ex:
+        # ジョブの記録（telemetry）がワーカースレッドにも引き継がれるよう、コンテキストごと渡す
+        futures = {ex.submit(contextvars.copy_context().run, _run, i, cmd): i for i, cmd in enumerate(cmds)}
+        not_done = set(futures)
+        while not_done:
+            done, not_done = wait(not_done, timeout=0.5, return_when=FIRST_COMPLETED)
+            if poll is not None:
+                poll()
+            for fut in done:
+                if fut.cancelled():
+                    continue
+                ok, log = fut.result()
+                if ok or abort.is_set():
+                    continue
+                failed_idx, failed_log = futures[fut], log
+                with lock:
+                    abort.set()
+                    for p in procs:
+                        if p.poll() is None:
+                            p.kill()
+                for f in futures:
+                    f.cancel()
+    return failed_idx < 0, failed_idx, failed_log
+
+class JobProgress:
+    """
+    クリップごとの進捗を長さ（秒）で重み付けして全体の割合を出す。
+    長さが分からないクリップは、分かっているクリップの平均の長さとみなす。
+    """
+    def __init__(self, n: int, caps: Optional[List[float]] = None, durations: Optional[List[float]] = None):
+        self.lock = threading.Lock()
+        self.caps = caps or [0.0] * n  # -t などで長さに上限がある場合
+        self.durations = [self._cap(i, d) for i, d in enumerate(durations or [0.0] * n)]
+        self.done = [0.0] * n
+        self.finished = [False] * n
+        self.fps = 0.0
+        self.speed = 0.0
+
+    def _cap(self, i: int, dur: float) -> float:
+        if self.caps[i] > 0:
+            return min(dur, self.caps[i]) if dur > 0 else self.caps[i]
+        return dur
+
+    def update(self, i: int, info: dict):
+        with self.lock:
+            if info["duration"] > 0:
+                self.durations[i] = self._cap(i, info["duration"])
+            self.done[i] = info["out_time"]
+            self.finished[i] = info["done"]
+            self.fps, self.speed = info["fps"], info["speed"]
+
+    def finish(self, i: int):
+        with self.lock:
+            self.finished[i] = True
+
+    def fraction(self) -> float:
+        with self.lock:
+            known = [d for d in self.durations if d > 0]
+            avg = sum(known) / len(known) if known else 1.0
+            total = done = 0.0
+            for d, t, fin in zip(self.durations, self.done, self.finished):
+                w = d if d > 0 else avg
+                total += w
+                done += w if fin else min(w, t)
+            return done / total if total > 0 else 0.0
+
+    def text(self) -> str:
+        with self.lock:
+            n_done = sum(self.finished)
+            n = len(self.finished)
+        return f"エンコード中… {n_done}/{n} クリップ完了（{self.fraction() * 100:.0f}%・{self.fps:.0f} fps・{self.speed:.2f}x）"
+
+class StageTimer:
+    """工程ごとの所要時間を記録する（表示は呼び出し側で rows を使う）"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows: List[Tuple[str, float]] = []
+        self.t_last = time.perf_counter()
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            self.rows.append((name, seconds))
+
+    def lap(self, name: str):
+        """前回の lap（または開始）からの経過時間を name として記録"""
+        now = time.perf_counter()
+        self.add(name, now - self.t_last)
+        self.t_last = now
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+段階再生のプレビュー。エンコードが終わったパーツから順に HLS のセグメント（MPEG-TS）へ詰め替えて
+プレイリストに足していくので、残りのクリップをエンコードしている間に先頭から再生できる。
+"""
+import math, os, threading, uuid
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from .ffmpeg import CancelToken, get_ffmpeg_exe, run_ffmpeg
+from .probe import meta_duration, probe_media
+
+class HlsPreview:
+    """
+    playlist（.m3u8）と同じディレクトリに <名前>_000.ts, _001.ts … を書く。
+    パーツは仕上がった順に add() で渡してよい。先頭から途切れずに揃った分だけをセグメントにし、
+    最初のセグメントができたら on_ready(playlist) を1回だけ呼ぶ。全部渡したら finish() で ENDLIST を付ける。
+    durations はパーツの予定の秒数（TARGETDURATION と、尺が読めなかったときに使う）。
+    """
+    def __init__(self, playlist: Path, durations: List[float], cancel: Optional[CancelToken] = None,
+                 on_ready: Optional[Callable[[Path], None]] = None):
+        self.playlist = Path(playlist)
+        self.durations = list(durations)
+        self.cancel = cancel
+        self.on_ready = on_ready
+        self.target = max(1, math.ceil(max(self.durations, default=1.0)))
+        self.lock = threading.Lock()
+        self.pending: Dict[int, Path] = {}
+        self.entries: List[tuple] = []  # (セグメント名, 秒数)
+        self.offset = 0.0               # 次のセグメントの開始時刻（結合後の秒）
+        self.failed = False
+
+    def add(self, pos: int, part: Path):
+        """pos 番目のパーツができた（エンコードのワーカースレッドから呼ばれる）"""
+        with self.lock:
+            self.pending[pos] = Path(part)
+            while not self.failed and len(self.entries) in self.pending:
+                n = len(self.entries)
+                if not self._segment(n, self.pending.pop(n)):
+                    self.failed = True  # 詰め替えに失敗したら段階再生だけあきらめる（完成版はそのまま作る）
+                    return
+                self._write()
+                if n == 0 and self.on_ready is not None:
+                    self.on_ready(self.playlist)
+
+    def finish(self):
+        with self.lock:
+            if not self.failed and self.entries:
+                self._write(ended=True)
+
+    def _segment(self, n: int, part: Path) -> bool:
+        seg = self.playlist.with_name(f"{self.playlist.stem}_{n:03d}.ts")
+        tmp = seg.with_name(f"{seg.stem}.{uuid.uuid4().hex}.tmp.ts")
+        # 各セグメントのタイムスタンプを結合後の時刻にずらし、プレイヤーが続けて再生できるようにする
+        ok, _ = run_ffmpeg([
+            get_ffmpeg_exe(), "-y",
+            "-i", str(part),
+            "-map", "0", "-c", "copy",
+            "-output_ts_offset", f"{self.offset:.3f}",
+            "-f", "mpegts", str(tmp)
+        ], cancel=self.cancel)
+        if not ok:
+            tmp.unlink(missing_ok=True)
+            return False
+        os.replace(tmp, seg)
+        seconds = meta_duration(probe_media(str(part))) or self.durations[n]
+        self.entries.append((seg.name, seconds))
+        self.offset += seconds
+        return True
+
+    def _write(self, ended: bool = False):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-PLAYLIST-TYPE:EVENT",
+                 f"#EXT-X-TARGETDURATION:{max([self.target, *(math.ceil(s) for _, s in self.entries)])}",
+                 "#EXT-X-MEDIA-SEQUENCE:0"]
+        for name, seconds in self.entries:
+            lines += [f"#EXTINF:{seconds:.3f},", name]
+        if ended:
+            lines.append("#EXT-X-ENDLIST")
+        tmp = self.playlist.with_name(f"{self.playlist.stem}.{uuid.uuid4().hex}.tmp.m3u8")
+        tmp.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        os.replace(tmp, self.playlist)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""ジョブの記述（クリップ・字幕・フォント・エンコード設定）とマニフェストの読み込み"""
+import json
+from dataclasses import asdict, dataclass, field, fields, replace
+from pathlib import Path
+from typing import List, Optional
+
+from .encoders import DEFAULT_ENCODER, encoder_args
+
+LAYOUTS = ("horizontal", "shorts")
+
+# レイアウトごとの既定値（各アプリのサイドバーの初期値と同じ）
+LAYOUT_DEFAULTS = {
+    "horizontal": {"fs_top": 0.06, "margin_top": 40, "fs_bottom": 0.06, "margin_bottom": 40, "preview_seconds": 12.0},
+    "shorts": {"fs_top": 0.04, "margin_top": 300, "fs_bottom": 0.06, "margin_bottom": 500, "preview_seconds": 3.0},
+}
+
+@dataclass
+class Clip:
+    path: str
+    bottom: str = ""            # 下部字幕（改行可）
+    fs_bottom: float = 0.06     # 映像高さ×
+    margin_bottom: int = 40     # px
+    name: str = ""
+    sha256: str = ""            # 空ならファイルから計算
+    meta: Optional[dict] = None  # 空ならプローブ
+
+@dataclass
+class CaptionStyle:
+    top: str = ""               # 上部字幕（全クリップ共通・改行可）
+    fs_top: float = 0.06
+    margin_top: int = 40
+    box_opacity: float = 0.55
+    font_path: str = ""         # TTF/OTF。空ならシステム名 → 同梱フォント
+    font_name: str = ""         # fontconfig のフォント名
+    overlay: bool = True        # 字幕を透明PNGにして重ねる（False で毎フレーム drawtext）
+
+@dataclass
+class EncodeSettings:
+    crf: int = 18
+    preset: str = "medium"
+    render_mode: str = "auto"   # auto / single / two_stage
+    split_long: bool = True     # コアが余るとき長いクリップをキーフレームで分割して並列エンコード
+    encoder: str = DEFAULT_ENCODER  # libx264 / libx265 / libsvtav1 / libaom-av1（crf は x264 の値から換算）
+    time_budget: float = 0.0    # 秒。0 より大きければ、この時間に収まる中でいちばん画質の良い encoder / preset を選ぶ
+    budget_encoders: List[str] = field(default_factory=lambda: [DEFAULT_ENCODER])  # time_budget で選んでよいエンコーダ
+
+    def args(self) -> List[str]:
+        return [*self.video_args(), "-c:a", "aac"]
+
+    def video_args(self) -> List[str]:
+        """映像だけのエンコード設定（パーツの音声は書き出し側の音声プランで決める）"""
+        return encoder_args(self.encoder, self.crf, self.preset)
+
+@dataclass
+class PreviewSettings:
+    seconds: float = 12.0       # horizontal: 結合後の秒数 / shorts: 各クリップの秒数
+    anchor: str = "head"        # horizontal のみ: head / offset / join
+    offset: float = 0.0         # anchor=offset の開始秒
+    join: int = 1               # anchor=join のつなぎ目（クリップ k と k+1 の間）
+    downscale: bool = True      # horizontal: 縦480px / shorts: 540×960
+    fast: bool = True           # horizontal のみ: CRF=28 / ultrafast
+    stream: bool = False        # 仕上がったクリップから HLS（出力と同じ場所の .m3u8）に足して、完成前から再生できるようにする
+
+@dataclass
+class Job:
+    layout: str = "horizontal"
+    clips: List[Clip] = field(default_factory=list)
+    captions: CaptionStyle = field(default_factory=CaptionStyle)
+    encode: EncodeSettings = field(default_factory=EncodeSettings)
+    preview: PreviewSettings = field(default_factory=PreviewSettings)
+    output: str = "output_joined.mp4"
+    name: str = ""
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def as_layout(self, layout: str) -> "Job":
+        """
+        同じクリップ・字幕テキスト・フォント・エンコード設定で別レイアウトにしたジョブ（同時書き出し用）。
+        文字サイズ・余白・プレビュー秒数はそのレイアウトの既定値、出力名は <元の名前>_<layout>.mp4。
+        """
+        if layout not in LAYOUTS:
+            raise ValueError(f"layout は {' / '.join(LAYOUTS)} のどれかです: {layout!r}")
+        defaults = LAYOUT_DEFAULTS[layout]
+        output = Path(self.output)
+        return replace(
+            self,
+            layout=layout,
+            clips=[replace(c, fs_bottom=defaults["fs_bottom"], margin_bottom=defaults["margin_bottom"]) for c in self.clips],
+            captions=replace(self.captions, fs_top=defaults["fs_top"], margin_top=defaults["margin_top"]),
+            encode=replace(self.encode),
+            preview=replace(self.preview, seconds=defaults["preview_seconds"]),
+            output=str(output.with_name(f"{output.stem}_{layout}{output.suffix or '.mp4'}")),
+            name=f"{self.name}_{layout}" if self.name else "",
+        )
+
+    @classmethod
+    def from_dict(cls, d: dict, base_dir: Optional[Path] = None) -> "Job":
+        """
+        マニフェストの1ジョブ分から作る。省略した項目はレイアウトの既定値。
+        clips は {"path": ...} のほか、パス文字列だけでもよい。相対パスは base_dir から解決する。
+        """
+        layout = d.get("layout", "horizontal")
+        if layout not in LAYOUTS:
+            raise ValueError(f"layout は {' / '.join(LAYOUTS)} のどれかです: {layout!r}")
+        defaults = LAYOUT_DEFAULTS[layout]
+
+        def _path(p: str) -> str:
+            if not p:
+                return ""
+            p = Path(p).expanduser()
+            return str(p if p.is_absolute() or base_dir is None else base_dir / p)
+
+        clips = []
+        for c in d.get("clips") or []:
+            c = {"path": c} if isinstance(c, str) else dict(c)
+            c.setdefault("fs_bottom", defaults["fs_bottom"])
+            c.setdefault("margin_bottom", defaults["margin_bottom"])
+            c["path"] = _path(c["path"])
+            c.setdefault("name", Path(c["path"]).name)
+            clips.append(Clip(**_known(Clip, c)))
+        if not clips:
+            raise ValueError("clips が空です")
+
+        cap = {"fs_top": defaults["fs_top"], "margin_top": defaults["margin_top"], **(d.get("captions") or {})}
+        cap["font_path"] = _path(cap.get("font_path", ""))
+        preview = {"seconds": defaults["preview_seconds"], **(d.get("preview") or {})}
+        return cls(
+            layout=layout,
+            clips=clips,
+            captions=CaptionStyle(**_known(CaptionStyle, cap)),
+            encode=EncodeSettings(**_known(EncodeSettings, d.get("encode") or {})),
+            preview=PreviewSettings(**_known(PreviewSettings, preview)),
+            output=d.get("output") or "output_joined.mp4",
+            name=d.get("name") or Path(d.get("output") or "output_joined.mp4").stem,
+        )
+
+def _known(cls, d: dict) -> dict:
+    """dataclass に無いキーはエラーにする（綴り間違いを黙って無視しない）"""
+    names = {f.name for f in fields(cls)}
+    unknown = set(d) - names
+    if unknown:
+        raise ValueError(f"{cls.__name__} に不明な項目があります: {', '.join(sorted(unknown))}")
+    return d
+
+def load_manifest(path: Path) -> List[Job]:
+    """
+    マニフェストを読む。形式は拡張子で判断:
+    .jsonl … 1行1ジョブ / .json … ジョブ1つのオブジェクト、またはジョブの配列。
+    クリップやフォントの相対パスはマニフェストのあるディレクトリから解決する。
+    """
+    path = Path(path)
+    text = path.read_text(encoding="utf-8")
+    if path.suffix.lower() == ".jsonl":
+        items = [json.loads(line) for line in text.splitlines() if line.strip() and not line.lstrip().startswith("#")]
+    else:
+        data = json.loads(text)
+        items = data if isinstance(data, list) else [data]
+    jobs = []
+    for n, item in enumerate(items, 1):
+        try:
+            jobs.append(Job.from_dict(item, base_dir=path.resolve().parent))
+        except (TypeError, ValueError, KeyError) as e:
+            raise ValueError(f"{path.name}: {n} 件目のジョブが不正です: {e}") from e
+    return jobs
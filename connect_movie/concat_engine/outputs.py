@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""書き出し結果の置き場所と、ディスクから直接配信する HTTP サーバ（/metrics はこのマシンの中だけに出す別のサーバ）"""
+import json, os, re, secrets, shutil, threading, time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+from urllib.parse import quote, unquote, urlparse
+
+from .cache import CACHE_ROOT
+from .telemetry import prometheus_text
+
+OUTPUT_ROOT = CACHE_ROOT / "outputs"
+OUTPUT_TTL_SECONDS = float(os.environ.get("MOVIE_CONNECTER_OUTPUT_TTL_H", "6")) * 3600
+DL_PORT = int(os.environ.get("MOVIE_CONNECTER_DL_PORT", "8502"))
+# ブラウザから届く公開 URL。設定されていなければ配信サーバは立てない（リンクが使えないため）
+DL_BASE_URL = os.environ.get("MOVIE_CONNECTER_DL_BASE_URL", "").rstrip("/")
+DL_SERVER_ENABLED = os.environ.get("MOVIE_CONNECTER_DL_SERVER", "1") != "0" and bool(DL_BASE_URL)
+METRICS_PORT = int(os.environ.get("MOVIE_CONNECTER_METRICS_PORT", str(DL_PORT + 1)))
+_TOKEN_RE = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+CONTENT_TYPES = {".mp4": "video/mp4", ".m3u8": "application/vnd.apple.mpegurl", ".ts": "video/mp2t"}
+HLS_JS_URL = "https://cdn.jsdelivr.net/npm/hls.js@1"
+
+def sweep_outputs():
+    """期限切れの出力ディレクトリを削除"""
+    now = time.time()
+    if not OUTPUT_ROOT.exists():
+        return
+    for d in OUTPUT_ROOT.iterdir():
+        try:
+            if d.is_dir() and now - d.stat().st_mtime > OUTPUT_TTL_SECONDS:
+                shutil.rmtree(d, ignore_errors=True)
+        except OSError:
+            pass
+
+def new_output_dir() -> Path:
+    """書き出し先（TemporaryDirectory の外）。ディレクトリ名がそのままリンクのトークンになる"""
+    sweep_outputs()
+    d = OUTPUT_ROOT / secrets.token_urlsafe(24)
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """/metrics（このサーバを持っているプロセスの累計。Prometheus のテキスト形式）"""
+    def log_message(self, format, *args):
+        pass
+
+    def _serve(self, send_body: bool):
+        path = urlparse(self.path).path
+        if path not in ("/healthz", "/metrics"):
+            self.send_error(404)
+            return
+        body = b"movie_connecter" if path == "/healthz" else prometheus_text().encode("utf-8")
+        self.send_response(200)
+        if path == "/metrics":
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self._serve(True)
+
+    def do_HEAD(self):
+        self._serve(False)
+
+class _OutputHandler(BaseHTTPRequestHandler):
+    """/dl/<token>/<ファイル名> をディスクからチャンク単位で返す（Range 対応）"""
+    CHUNK = 1024 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def _resolve(self) -> Optional[Path]:
+        parts = urlparse(self.path).path.split("/")
+        if len(parts) != 4 or parts[1] != "dl" or not _TOKEN_RE.match(parts[2]):
+            self.send_error(404)
+            return None
+        d = OUTPUT_ROOT / parts[2]
+        p = d / unquote(parts[3])
+        if p.parent != d or not p.is_file():
+            self.send_error(404)
+            return None
+        if time.time() - d.stat().st_mtime > OUTPUT_TTL_SECONDS:
+            self.send_error(410, "Link expired")
+            return None
+        return p
+
+    def _serve(self, send_body: bool):
+        if urlparse(self.path).path == "/healthz":
+            body = b"movie_connecter"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+            return
+        p = self._resolve()
+        if p is None:
+            return
+        size = p.stat().st_size
+        start, end = 0, size - 1
+        m = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+        if m and (m.group(1) or m.group(2)):
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            else:
+                start = max(0, size - int(m.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES.get(p.suffix.lower(), "application/octet-stream"))
+        if p.suffix.lower() == ".m3u8":
+            self.send_header("Cache-Control", "no-store")  # 段階再生中はセグメントが増えていく
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if "download=1" in urlparse(self.path).query:
+            self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(p.name)}")
+        self.end_headers()
+        if not send_body:
+            return
+        with open(p, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    chunk = f.read(min(self.CHUNK, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    def do_GET(self):
+        self._serve(True)
+
+    def do_HEAD(self):
+        self._serve(False)
+
+def _start_server(host: str, port: int, handler, name: str) -> bool:
+    try:
+        srv = ThreadingHTTPServer((host, port), handler)
+    except OSError:
+        # もう一方のアプリが同じポートで配信中なら、それを使う（出力ディレクトリは共通）
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz", timeout=2) as r:
+                return r.read() == b"movie_connecter"
+        except Exception:
+            return False
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name=name, daemon=True).start()
+    return True
+
+def serve_metrics() -> bool:
+    """/metrics を 127.0.0.1:METRICS_PORT で待ち受ける（外には出さない）"""
+    return _start_server("127.0.0.1", METRICS_PORT, _MetricsHandler, "metrics-server")
+
+def serve_outputs() -> bool:
+    """
+    出力配信用の HTTP サーバをデーモンスレッドで起動し、リンクを渡せるなら True。
+    MOVIE_CONNECTER_DL_BASE_URL が無い・配信を止めている・起動できないときは False（download_button にフォールバック）。
+    /metrics は配信とは別に serve_metrics で起動する。プロセスごとに1回だけ呼ぶ（アプリからは st.cache_resource 経由）。
+    """
+    serve_metrics()
+    if not DL_SERVER_ENABLED:
+        return False
+    return _start_server("0.0.0.0", DL_PORT, _OutputHandler, "output-server")
+
+def output_url(path: Path, download: bool = False) -> str:
+    url = f"{DL_BASE_URL}/dl/{path.parent.name}/{quote(path.name)}"
+    return url + "?download=1" if download else url
+
+def hls_player_html(url: str, max_height: int = 480) -> str:
+    """
+    段階再生（HLS）のプレイヤー。Safari などは <video> でそのまま、それ以外は hls.js で再生する。
+    セグメントが増えるたびにプレイリストを読み直すので、エンコード中でも先頭から再生できる。
+    """
+    return f"""
+<video id="v" controls autoplay muted playsinline style="width:100%;max-height:{int(max_height)}px;background:#000"></video>
+<script src="{HLS_JS_URL}"></script>
+<script>
+  const v = document.getElementById("v"), src = {json.dumps(url)};
+  if (v.canPlayType("application/vnd.apple.mpegurl")) {{
+    v.src = src;
+  }} else if (window.Hls && Hls.isSupported()) {{
+    const hls = new Hls();
+    hls.loadSource(src);
+    hls.attachMedia(v);
+  }} else {{
+    v.replaceWith("このブラウザでは完成前の再生ができません。完成後に再生できます。");
+  }}
+</script>
+"""
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""クリップのメタデータ（尺・コーデック・解像度・音声構成）の取得とキャッシュ"""
+import json, os, re, shutil, subprocess, uuid
+from typing import Optional, Tuple
+
+from .cache import CACHE_ROOT
+from .ffmpeg import _DURATION_RE, get_ffmpeg_exe
+
+PROBE_VERSION = 2  # 抽出項目を変えたら上げる（キャッシュを作り直す）
+_LAYOUT_CHANNELS = {"mono": 1, "stereo": 2, "2.1": 3, "quad": 4, "4.0": 4, "5.0": 5, "5.1": 6, "6.1": 7, "7.1": 8}
+
+def get_ffprobe_exe() -> Optional[str]:
+    """PATH 上の ffprobe、無ければ None（imageio-ffmpeg は ffprobe を同梱しない）"""
+    return shutil.which("ffprobe")
+
+def _parse_rate(v) -> float:
+    try:
+        if isinstance(v, str) and "/" in v:
+            num, den = v.split("/", 1)
+            return float(num) / float(den) if float(den) else 0.0
+        return float(v)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _parse_tbn(v: str) -> str:
+    """ffmpeg ログの tbn（例: 15360, 1k）を time_base 文字列（1/15360）に"""
+    v = v.strip()
+    n = float(v[:-1]) * 1000 if v.endswith("k") else float(v)
+    return f"1/{int(n)}"
+
+def _stream_rotation(s: dict) -> int:
+    """ffprobe の stream から回転角（0/90/180/270）を取り出す"""
+    rot = (s.get("tags") or {}).get("rotate")
+    for sd in s.get("side_data_list") or []:
+        if rot is None and "rotation" in sd:
+            rot = sd["rotation"]
+    try:
+        return int(round(float(rot or 0))) % 360
+    except (TypeError, ValueError):
+        return 0
+
+def _probe_with_ffprobe(exe: str, path: str) -> Optional[dict]:
+    proc = subprocess.run(
+        [exe, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+    if proc.returncode != 0:
+        return None
+    data = json.loads(proc.stdout or "{}")
+    meta = {"duration": _parse_rate(data.get("format", {}).get("duration")),
+            "format": data.get("format", {}).get("format_name", ""),
+            "video": None, "audio": None, "source": "ffprobe"}
+    for s in data.get("streams", []):
+        if s.get("codec_type") == "video" and meta["video"] is None and not s.get("disposition", {}).get("attached_pic"):
+            meta["video"] = {
+                "codec": s.get("codec_name", ""),
+                "profile": s.get("profile", ""),
+                "width": int(s.get("width") or 0),
+                "height": int(s.get("height") or 0),
+                "fps": round(_parse_rate(s.get("avg_frame_rate") or s.get("r_frame_rate")), 3),
+                "pix_fmt": s.get("pix_fmt", ""),
+                "time_base": s.get("time_base", ""),
+                "rotation": _stream_rotation(s),
+            }
+        elif s.get("codec_type") == "audio" and meta["audio"] is None:
+            meta["audio"] = {
+                "codec": s.get("codec_name", ""),
+                "profile": s.get("profile", ""),
+                "sample_rate": int(s.get("sample_rate") or 0),
+                "channels": int(s.get("channels") or 0),
+                "channel_layout": s.get("channel_layout", ""),
+            }
+    return meta
+
+_STREAM_RE = re.compile(r"^\s*Stream #\d+:\d+.*?: (Video|Audio): (.*)$")
+_ROTATE_RE = re.compile(r"^\s*rotate\s*: (-?\d+)")
+
+def _probe_with_ffmpeg(path: str) -> Optional[dict]:
+    """ffprobe が無い環境向け: ffmpeg -i のログから読み取る"""
+    proc = subprocess.run([get_ffmpeg_exe(), "-hide_banner", "-i", path],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    meta = {"duration": 0.0, "format": "", "video": None, "audio": None, "source": "ffmpeg"}
+    found = False
+    in_video = False  # 直前の Stream 行が採用した映像ストリームか（rotate はその下の Metadata に出る）
+    for line in proc.stdout.splitlines():
+        if line.startswith("Input #0"):
+            found = True
+            meta["format"] = line.split(",", 1)[1].rsplit(",", 1)[0].strip() if "," in line else ""
+        m = _DURATION_RE.match(line)
+        if m:
+            meta["duration"] = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+            continue
+        m = _ROTATE_RE.match(line)
+        if m and in_video:
+            meta["video"]["rotation"] = int(m.group(1)) % 360
+            continue
+        m = _STREAM_RE.match(line)
+        if not m:
+            continue
+        kind, desc = m.groups()
+        in_video = False
+        head = re.match(r"(\w+)(?: \(([^)]*)\))?", desc)
+        codec, profile = head.group(1), head.group(2) or ""
+        if kind == "Video" and meta["video"] is None and "attached pic" not in desc:
+            size = re.search(r"\b(\d{2,5})x(\d{2,5})\b", desc)
+            fps = re.search(r"([\d.]+k?) fps", desc)
+            tbn = re.search(r"([\d.]+k?) tbn", desc)
+            pix = re.search(r", ([a-z0-9_]+)(?:\([^)]*\))?, \d{2,5}x\d{2,5}", desc)
+            meta["video"] = {
+                "codec": codec,
+                "profile": profile if "/" not in profile else "",
+                "width": int(size.group(1)) if size else 0,
+                "height": int(size.group(2)) if size else 0,
+                "fps": round(_parse_rate(fps.group(1).replace("k", "e3")), 3) if fps else 0.0,
+                "pix_fmt": pix.group(1) if pix else "",
+                "time_base": _parse_tbn(tbn.group(1)) if tbn else "",
+                "rotation": 0,
+            }
+            in_video = True
+        elif kind == "Audio" and meta["audio"] is None:
+            rate = re.search(r"(\d+) Hz", desc)
+            fields = [f.strip() for f in desc.split(",")]
+            layout = fields[2] if len(fields) > 2 else ""
+            nch = re.match(r"(\d+) channels", layout)
+            meta["audio"] = {
+                "codec": codec,
+                "profile": profile if "/" not in profile else "",
+                "sample_rate": int(rate.group(1)) if rate else 0,
+                "channels": int(nch.group(1)) if nch else _LAYOUT_CHANNELS.get(layout.split("(")[0], 0),
+                "channel_layout": "" if nch else layout,
+            }
+    return meta if found else None
+
+def probe_media(path: str) -> Optional[dict]:
+    """尺・コーデック・解像度・fps・画素形式・音声構成を取得。読めなければ None"""
+    try:
+        exe = get_ffprobe_exe()
+        meta = _probe_with_ffprobe(exe, path) if exe else None
+        return meta or _probe_with_ffmpeg(path)
+    except Exception:
+        return None
+
+def get_media_meta(digest: str, path: str) -> Optional[dict]:
+    """クリップのハッシュ単位でプローブ結果をディスクにキャッシュ"""
+    cache_file = CACHE_ROOT / "probe" / f"{digest}.json"
+    try:
+        cached = json.loads(cache_file.read_text(encoding="utf-8"))
+        if cached.get("version") == PROBE_VERSION:
+            return cached["meta"]
+    except (OSError, ValueError, KeyError):
+        pass
+    meta = probe_media(path)
+    if meta is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_file.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp.write_text(json.dumps({"version": PROBE_VERSION, "meta": meta}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, cache_file)
+    return meta
+
+def meta_duration(meta: Optional[dict]) -> float:
+    return float((meta or {}).get("duration") or 0.0)
+
+def display_size(meta: Optional[dict]) -> Optional[Tuple[int, int]]:
+    """自動回転後（フィルタに入ってくるフレーム）の幅・高さ。不明なら None"""
+    v = (meta or {}).get("video")
+    if not v or not v["width"] or not v["height"]:
+        return None
+    if v.get("rotation", 0) % 180 == 90:
+        return v["height"], v["width"]
+    return v["width"], v["height"]
+
+def format_meta(meta: Optional[dict]) -> str:
+    """クリップ表に出す1行サマリ"""
+    if not meta:
+        return "（メタデータ取得失敗）"
+    m, s = divmod(meta["duration"], 60)
+    items = [f"{int(m):02d}:{s:04.1f}"]
+    v = meta.get("video")
+    if v:
+        items.append(f"{v['codec']} {v['width']}×{v['height']} {v['fps']:g}fps {v['pix_fmt']}".strip())
+    a = meta.get("audio")
+    items.append(f"{a['codec']} {a['sample_rate'] / 1000:g}kHz {a['channel_layout'] or str(a['channels']) + 'ch'}" if a else "音声なし")
+    return " · ".join(items)
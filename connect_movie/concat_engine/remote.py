@@ -0,0 +1,803 @@
+# -*- coding: utf-8 -*-
+"""
+別マシン（または同じマシンの別プロセス）のワーカーにクリップのエンコードを任せる。
+
+ワーカー: python -m concat_engine worker --port 8610
+    GET  /healthz          {"name": "movie_connecter_worker", "slots": 同時エンコード数, "busy": 実行中の数}
+    HEAD /blobs/<名前>      入力ファイル（クリップ・字幕テキスト・フォント・字幕 PNG）があるか
+    PUT  /blobs/<名前>      入力ファイルを送る。名前 = 中身の SHA-256 + 拡張子（届いた中身と照合する）
+    POST /encode           {"request": {...}}（encode_request の形）から ffmpeg の引数を組み立てて実行し、
+                           進捗を1行1件の JSON で流す。最後の行 {"done": true, "ok", "log", "part", "size", "usage"}
+    GET  /parts/<id>       できたパーツを返して消す
+リクエストに書けるのはクリップ1本の映像エンコードだけ（入力・vf の中のファイルはブロブ名、エンコーダ・preset は
+ENCODER_SPECS のもの、vf は字幕で使うフィルタだけ）。パスや任意の ffmpeg オプションは受け付けない。
+ループバック以外で待ち受けるときはトークンが必須。
+
+コーディネーター: RemotePool(["host1:8610", "host2:8610"]).run は run_ffmpeg と同じ形で呼べる。
+入力を送ってワーカーで実行し、パーツを元の出力先に受け取る。ワーカーが落ちた・失敗したときは別のワーカーでやり直し、
+どのワーカーにも繋がらなければこのマシンで実行する。リクエストの形にできないコマンド（音声だけのトラックなど）も
+このマシンで実行する。連結はこれまでどおり呼び出し側で行う。
+"""
+import hashlib, http.client, ipaddress, json, os, re, secrets, shutil, socket, threading, time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+from .cache import CACHE_ROOT, file_sha256
+from .encoders import ENCODER_SPECS, encoder_args
+from .ffmpeg import CancelToken, default_workers, get_ffmpeg_exe, run_ffmpeg
+from .telemetry import ProcessUsage, job_span, record_process
+
+WORKER_PORT = int(os.environ.get("MOVIE_CONNECTER_WORKER_PORT", "8610"))
+WORKER_TOKEN = os.environ.get("MOVIE_CONNECTER_WORKER_TOKEN", "")
+WORKER_ROOT = CACHE_ROOT / "worker"
+WORKER_CACHE_MAX_BYTES = int(float(os.environ.get("MOVIE_CONNECTER_WORKER_CACHE_GB", "20")) * 1024 ** 3)
+PART_TTL_SECONDS = 3600           # 受け取られなかったパーツを消すまでの時間
+CHUNK = 1024 * 1024
+CONNECT_TIMEOUT = 10              # 接続・応答待ちの上限（秒）。エンコード中は進捗か待機中の行が届く
+HEARTBEAT_SECONDS = 5             # 空きを待っている間に送る行の間隔
+DOWN_SECONDS = 30                 # 落ちたワーカーを候補から外しておく時間
+FFMPEG_ATTEMPTS = 2               # ffmpeg 自体が失敗したときに試すワーカーの数（同じ入力なら大抵どこでも失敗する）
+
+_BLOB_NAME_RE = re.compile(r"^[0-9a-f]{64}(\.[A-Za-z0-9]{1,8})?$")
+_BLOB_REF_RE = re.compile(r"\{blob:([0-9a-f]{64}(?:\.[A-Za-z0-9]{1,8})?)\}")
+_PART_ID_RE = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+# vf 内のファイル参照（captions が書くのは textfile / fontfile / movie）
+_FILTER_FILE_RE = re.compile(r"(textfile|fontfile|movie|filename)='((?:[^'\\]|\\.|'\\'')*)'")
+_FILTER_OPTS = {"-vf", "-af", "-filter:v", "-filter:a", "-filter_complex", "-lavfi"}
+_NUMBER_RE = re.compile(r"^\d{1,6}(\.\d{1,6})?$")
+_SILENCE_RE = re.compile(r"^anullsrc=r=(\d+):cl=(mono|stereo)$")
+# ワーカーで使える vf のフィルタ（captions が使うものだけ）と、ファイルを読む引数
+_VF_FILTERS = {"null", "setsar", "scale", "format", "pad", "drawtext", "movie", "overlay"}
+_VF_FILE_KEYS = {"textfile", "fontfile", "filename"}
+_VF_ITEM_RE = re.compile(r"^((?:\[\w+\])*)([a-z0-9_]+)(?:=(.*?))?((?:\[\w+\])*)$", re.DOTALL)
+_PATH_LIKE_RE = re.compile(r"^(/|~|\\|[A-Za-z]:[/\\])|(^|[/\\])\.\.?([/\\]|$)|://")
+# 入力のクリップとして開いてよい形式（HLS・concat などのプレイリストで別のファイルを読ませない）
+INPUT_FORMATS = "mov,mp4,m4a,3gp,3g2,mj2,matroska,webm,avi,mpeg,flv,asf,ogg"
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+# ---------------- Command translation ----------------
+def portable_args(cmd: List[str]) -> Tuple[List[str], Dict[str, str]]:
+    """
+    ffmpeg のコマンドをワーカーで実行できる形にする。
+    戻り値: (実行ファイルを除いた引数, {ブロブ名: ローカルのパス})。出力（最後の引数）は {out}
+    """
+    files: Dict[str, str] = {}
+
+    def _blob(path: str) -> str:
+        suffix = Path(path).suffix.lower()
+        name = file_sha256(path) + (suffix if re.fullmatch(r"\.[a-z0-9]{1,8}", suffix) else "")
+        files[name] = path
+        return "{blob:" + name + "}"
+
+    def _sub(m):
+        path = m.group(2).replace("'\\''", "'")
+        return f"{m.group(1)}='{_blob(path)}'" if os.path.isfile(path) else m.group(0)
+
+    args, prev = [], ""
+    for a in cmd[1:-1]:
+        if prev == "-i" and os.path.isfile(a):
+            a = _blob(a)
+        elif prev in _FILTER_OPTS:
+            a = _FILTER_FILE_RE.sub(_sub, a)
+        args.append(a)
+        prev = a
+    return [*args, "{out}"], files
+
+def encode_argv(req: dict, threads: Optional[int] = None) -> List[str]:
+    """
+    リクエストから ffmpeg の引数を組み立てる（実行ファイルと出力は除く。ファイルは {blob:…} のまま）。
+    形は render のパーツ（part_codec）・チャンク（chunk_cmd）と同じ。
+    """
+    argv = ["-y"]
+    if req.get("seek"):
+        argv += ["-ss", req["seek"]]
+    if req.get("duration"):
+        argv += ["-t", req["duration"]]
+    argv += ["-i", "{blob:" + req["input"] + "}"]
+    audio = req.get("audio")
+    if audio is None:
+        argv.append("-an")  # 映像だけ（長いクリップのチャンク）
+    elif audio["mode"] == "none":
+        argv += ["-map", "0:v:0"]
+    elif audio["source"] == "silence":
+        layout = "mono" if audio["channels"] == 1 else "stereo"
+        argv += ["-f", "lavfi", "-i", f"anullsrc=r={audio['sample_rate']}:cl={layout}",
+                 "-map", "0:v:0", "-map", "1:a:0", "-shortest"]
+    else:
+        argv += ["-map", "0:v:0", "-map", "0:a:0?" if audio["source"] == "clip?" else "0:a:0"]
+    video = req["video"]
+    argv += ["-vf", req["vf"], *encoder_args(video["encoder"], video["crf"], video["preset"])]
+    if threads:
+        argv += ["-threads", str(threads)]
+    if audio is not None:
+        if audio["mode"] == "none":
+            argv.append("-an")
+        elif audio["mode"] == "copy":
+            argv += ["-c:a", "copy"]
+        else:
+            argv += ["-c:a", "aac", "-ar", str(audio["sample_rate"]), "-ac", str(audio["channels"])]
+    return [*argv, "-movflags", "+faststart"]
+
+def encode_request(cmd: List[str]) -> Optional[Tuple[dict, Dict[str, str]]]:
+    """
+    ffmpeg のコマンドをワーカーへのリクエストにする。戻り値: (リクエスト, {ブロブ名: ローカルのパス})。
+    リクエストから組み立て直した引数が元のコマンドと同じにならない（ワーカーに任せられない）ときは None。
+    -threads はワーカーが決めるので含めない。
+    """
+    if not cmd[-1].endswith(".mp4"):
+        return None
+    portable, files = portable_args(cmd)
+    args, opts, flags, it = [], {}, set(), iter(portable[:-1])
+    for a in it:
+        if a == "-threads":
+            next(it, None)
+            continue
+        args.append(a)
+        if a in ("-y", "-an", "-shortest"):
+            flags.add(a)
+        elif a.startswith("-"):
+            v = next(it, "")
+            args.append(v)
+            opts.setdefault(a, []).append(v)
+        else:
+            return None
+    inputs = opts.get("-i", [])
+    m = _BLOB_REF_RE.fullmatch(inputs[0]) if inputs else None
+    spec = ENCODER_SPECS.get((opts.get("-c:v") or [""])[0])
+    if m is None or spec is None or "-vf" not in opts:
+        return None
+    crf = next((c for c in range(52) if str(spec.crf(c)) == (opts.get("-crf") or [""])[0]), None)
+    req = {"input": m.group(1), "vf": opts["-vf"][0],
+           "video": {"encoder": spec.name, "crf": crf, "preset": (opts.get(spec.preset_opt) or [""])[0]}}
+    for opt, key in (("-ss", "seek"), ("-t", "duration")):
+        if opt in opts:
+            req[key] = opts[opt][0]
+    if "-c:a" in opts or "-map" in opts:
+        codec = (opts.get("-c:a") or [""])[0]
+        silence = _SILENCE_RE.match(inputs[1]) if len(inputs) > 1 else None
+        audio = {"mode": "copy" if codec == "copy" else "encode" if codec else "none",
+                 "source": "silence" if silence else "clip?" if "0:a:0?" in opts["-map"] else "clip"}
+        if codec == "aac":
+            audio["sample_rate"] = int((opts.get("-ar") or ["0"])[0] or 0)
+            audio["channels"] = int((opts.get("-ac") or ["0"])[0] or 0)
+        req["audio"] = audio
+    try:
+        same = crf is not None and encode_argv(req) == args
+    except (KeyError, ValueError):
+        same = False
+    if not same:
+        return None
+    return req, {n: files[n] for n in request_blobs(req)}
+
+def request_blobs(req: dict) -> List[str]:
+    """リクエストが使うブロブ（入力と vf の中のファイル）"""
+    return sorted({req["input"], *_BLOB_REF_RE.findall(req["vf"])})
+
+def _split_filter_text(s: str, seps: str) -> List[str]:
+    """' で囲んだ部分と \\ でエスケープした文字を除いて、seps のどれかで分ける"""
+    parts, cur, quoted, i = [], "", False, 0
+    while i < len(s):
+        ch = s[i]
+        if quoted:
+            quoted = ch != "'"
+        elif ch == "'":
+            quoted = True
+        elif ch == "\\" and i + 1 < len(s):
+            cur += s[i:i + 2]
+            i += 2
+            continue
+        elif ch in seps:
+            parts.append(cur)
+            cur = ""
+            i += 1
+            continue
+        cur += ch
+        i += 1
+    if quoted:
+        raise ValueError("quote")
+    return [*parts, cur]
+
+def _unquote(s: str) -> str:
+    out, quoted, i = "", False, 0
+    while i < len(s):
+        ch = s[i]
+        if ch == "'":
+            quoted = not quoted
+        elif ch == "\\" and not quoted and i + 1 < len(s):
+            out += s[i + 1]
+            i += 1
+        else:
+            out += ch
+        i += 1
+    return out
+
+def check_vf(vf: str) -> List[str]:
+    """
+    ワーカーで実行する vf の検査。_VF_FILTERS のフィルタだけで、ファイルを読む引数（と drawtext・movie の
+    位置指定の引数）は {blob:…} だけ、ほかの値にもパスらしいものが無いこと。違反は ValueError。
+    戻り値: movie で読むブロブ（PNG か確かめる）
+    """
+    movies = []
+    for item in _split_filter_text(vf, ",;"):
+        m = _VF_ITEM_RE.match(item.strip())
+        if m is None or m.group(2) not in _VF_FILTERS:
+            raise ValueError(f"filter: {item[:40]}")
+        name = m.group(2)
+        for arg in _split_filter_text(m.group(3), ":") if m.group(3) else []:
+            key, eq, value = arg.partition("=")
+            if not eq:
+                key, value = "", arg
+            value = _unquote(value)
+            if key in _VF_FILE_KEYS or (not key and name in ("drawtext", "movie")):
+                ref = _BLOB_REF_RE.fullmatch(value)
+                if ref is None:
+                    raise ValueError(f"{name}: {key or 'file'}")
+                if name == "movie":
+                    movies.append(ref.group(1))
+            elif name == "movie" or _PATH_LIKE_RE.search(value):
+                raise ValueError(f"{name}: {key or value[:40]}")
+    return movies
+
+def check_request(req: dict):
+    """ワーカーが受け取ったリクエストの検査（形・値の範囲・vf）。違反は ValueError"""
+    if not isinstance(req, dict) or not _BLOB_NAME_RE.match(str(req.get("input"))):
+        raise ValueError("input")
+    for key in ("seek", "duration"):
+        if key in req and not _NUMBER_RE.match(str(req[key])):
+            raise ValueError(key)
+    video = req.get("video") or {}
+    spec = ENCODER_SPECS.get(video.get("encoder"))
+    if (spec is None or video.get("preset") not in spec.presets or not isinstance(video.get("crf"), int)
+            or not 0 <= video["crf"] <= 51):
+        raise ValueError("video")
+    audio = req.get("audio")
+    if audio is not None:
+        if audio.get("mode") not in ("none", "copy", "encode") or audio.get("source") not in ("clip", "clip?", "silence"):
+            raise ValueError("audio")
+        if audio["mode"] == "encode" and (audio.get("channels") not in (1, 2) or not isinstance(audio.get("sample_rate"), int)
+                                          or not 8000 <= audio["sample_rate"] <= 192000):
+            raise ValueError("audio")
+        if audio["source"] == "silence" and audio["mode"] != "encode":
+            raise ValueError("audio")
+    if not isinstance(req.get("vf"), str):
+        raise ValueError("vf")
+    return check_vf(req["vf"])
+
+# ---------------- Worker ----------------
+def _has_magic(path: Path, magic: bytes) -> bool:
+    try:
+        with path.open("rb") as f:
+            return f.read(len(magic)) == magic
+    except OSError:
+        return False
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class _WorkerState:
+    def __init__(self, root: Path, slots: int, token: str):
+        self.root = root
+        self.blobs = root / "blobs"
+        self.parts = root / "parts"
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        self.parts.mkdir(parents=True, exist_ok=True)
+        self.slots = max(1, int(slots))
+        self.sem = threading.Semaphore(self.slots)
+        self.token = token
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.in_use: Counter = Counter()  # 実行中のエンコードが使っているブロブ（削除しない）
+        # 1プロセスに slots 本の x264 が同時に走るので、スレッドはコア数をその本数で分ける
+        self.threads = max(1, (os.cpu_count() or 1) // self.slots)
+
+    def evict_blobs(self):
+        """上限を超えた分を最終利用の古い順に削除（使用中のものは残す）"""
+        entries = []
+        for p in self.blobs.iterdir():
+            try:
+                stt = p.stat()
+            except OSError:
+                continue
+            entries.append((stt.st_mtime, stt.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        with self.lock:
+            in_use = {name for name, n in self.in_use.items() if n > 0}
+        for _, size, p in sorted(entries):
+            if total <= WORKER_CACHE_MAX_BYTES:
+                break
+            if p.name in in_use or p.name.endswith(".tmp"):
+                continue
+            try:
+                p.unlink()
+                total -= size
+            except OSError:
+                pass
+
+    def sweep_parts(self):
+        now = time.time()
+        for p in self.parts.iterdir():
+            try:
+                if now - p.stat().st_mtime > PART_TTL_SECONDS:
+                    p.unlink()
+            except OSError:
+                pass
+
+class _WorkerHandler(BaseHTTPRequestHandler):
+    state: _WorkerState  # serve_worker で設定
+
+    def log_message(self, format, *args):
+        pass
+
+    def _authorized(self) -> bool:
+        if self.state.token and not secrets.compare_digest(self.headers.get("Authorization", ""),
+                                                           f"Bearer {self.state.token}"):
+            self.send_error(403)
+            return False
+        return True
+
+    def _send_json(self, code: int, obj: dict):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _blob_path(self) -> Optional[Path]:
+        parts = urlparse(self.path).path.split("/")
+        if len(parts) != 3 or parts[1] != "blobs" or not _BLOB_NAME_RE.match(parts[2]):
+            self.send_error(404)
+            return None
+        return self.state.blobs / parts[2]
+
+    def do_HEAD(self):
+        if not self._authorized():
+            return
+        p = self._blob_path()
+        if p is None:
+            return
+        self.send_response(200 if p.is_file() else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_PUT(self):
+        if not self._authorized():
+            return
+        p = self._blob_path()
+        if p is None:
+            return
+        remaining = int(self.headers.get("Content-Length") or 0)
+        tmp = p.with_name(f"{p.name}.{secrets.token_hex(8)}.tmp")
+        h = hashlib.sha256()
+        try:
+            with tmp.open("wb") as f:
+                while remaining > 0:
+                    chunk = self.rfile.read(min(CHUNK, remaining))
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if remaining or h.hexdigest() != p.name[:64]:
+                tmp.unlink()
+                self.send_error(400, "Digest mismatch")
+                return
+            os.replace(tmp, p)
+        except OSError as e:
+            tmp.unlink(missing_ok=True)
+            self.send_error(500, str(e))
+            return
+        self.state.evict_blobs()
+        self._send_json(201, {"blob": p.name})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/healthz":
+            with self.state.lock:
+                busy = self.state.busy
+            self._send_json(200, {"name": "movie_connecter_worker", "slots": self.state.slots, "busy": busy})
+            return
+        if not self._authorized():
+            return
+        parts = path.split("/")
+        if len(parts) != 3 or parts[1] != "parts" or not _PART_ID_RE.match(parts[2].split(".")[0]):
+            self.send_error(404)
+            return
+        p = self.state.parts / parts[2]
+        if p.parent != self.state.parts or not p.is_file():
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(p.stat().st_size))
+        self.end_headers()
+        try:
+            with p.open("rb") as f:
+                shutil.copyfileobj(f, self.wfile, CHUNK)
+        except (BrokenPipeError, ConnectionResetError):
+            return  # 受け取り損ねたらコーディネーターがやり直す（残りは sweep_parts で消える）
+        p.unlink(missing_ok=True)
+
+    def _event(self, obj: dict):
+        self.wfile.write((json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if urlparse(self.path).path != "/encode":
+            self.send_error(404)
+            return
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))["request"]
+            movies = check_request(req)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, f"Bad request: {e}")
+            return
+        st = self.state
+        names = request_blobs(req)
+        missing = [n for n in names if not (st.blobs / n).is_file()]
+        if missing:
+            self._send_json(409, {"missing": missing})
+            return
+        if any(not _has_magic(st.blobs / n, PNG_MAGIC) for n in movies):
+            self.send_error(400, "Bad request: movie")
+            return
+        with st.lock:
+            st.in_use.update(names)
+        part_id = secrets.token_urlsafe(16)
+        out_path = st.parts / f"{part_id}.mp4"
+        argv = encode_argv(req, st.threads)
+        # クリップは動画の形式としてだけ開く（プレイリストなどで別のファイルを読ませない）
+        clip_at = argv.index("-i")
+        argv[clip_at:clip_at] = ["-protocol_whitelist", "file", "-format_whitelist", INPUT_FORMATS]
+        cmd = [get_ffmpeg_exe()]
+        for a in argv:
+            ref = _BLOB_REF_RE.fullmatch(a)
+            cmd.append((st.blobs / ref.group(1)).as_posix() if ref else
+                       _BLOB_REF_RE.sub(lambda m: (st.blobs / m.group(1)).as_posix().replace("'", "'\\''"), a))
+        cmd.append(str(out_path))
+        for n in names:
+            os.utime(st.blobs / n)  # LRU 用
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        cancel = CancelToken()  # コーディネーターが接続を切ったら止める
+        keep = False
+        try:
+            # 空きを待つ間も行を送り、コーディネーター側の読み取りがタイムアウトしないようにする
+            while not st.sem.acquire(timeout=HEARTBEAT_SECONDS):
+                self._event({"queued": True})
+            try:
+                with st.lock:
+                    st.busy += 1
+
+                def _progress(info: dict):
+                    try:
+                        self._event({"progress": info})
+                    except OSError:
+                        cancel.cancel()
+
+                with job_span("remote", out_path.name) as span:
+                    ok, log = run_ffmpeg(cmd, on_progress=_progress, cancel=cancel)
+                    span.state = "done" if ok else "cancelled" if cancel.cancelled else "failed"
+                size = out_path.stat().st_size if ok and out_path.exists() else 0
+                keep = size > 0
+                self._event({"done": True, "ok": ok and size > 0, "log": log, "part": out_path.name, "size": size,
+                             "usage": span.record})
+            finally:
+                with st.lock:
+                    st.busy -= 1
+                st.sem.release()
+        except OSError:
+            cancel.cancel()
+        finally:
+            with st.lock:
+                st.in_use.subtract(names)
+            if not keep:
+                out_path.unlink(missing_ok=True)
+            st.sweep_parts()
+
+def serve_worker(host: str = "127.0.0.1", port: int = WORKER_PORT, slots: Optional[int] = None,
+                 token: str = WORKER_TOKEN, root: Path = WORKER_ROOT) -> ThreadingHTTPServer:
+    """
+    ワーカーの HTTP サーバを作る（serve_forever は呼び出し側で）。slots は同時に走らせる ffmpeg の数。
+    ループバック以外で待ち受けるのにトークンが無ければ ValueError。
+    """
+    if not token and not is_loopback(host):
+        raise ValueError("ループバック以外で待ち受けるときは MOVIE_CONNECTER_WORKER_TOKEN（--token）が必要です。")
+    state = _WorkerState(root, slots or default_workers(), token)
+    handler = type("WorkerHandler", (_WorkerHandler,), {"state": state})
+    srv = ThreadingHTTPServer((host, port), handler)
+    srv.daemon_threads = True
+    return srv
+
+# ---------------- Coordinator ----------------
+class _RemoteWorker:
+    def __init__(self, addr: str):
+        u = urlparse(addr if "//" in addr else f"http://{addr}")
+        self.addr = f"{u.hostname}:{u.port or WORKER_PORT}"
+        self.host, self.port = u.hostname or "127.0.0.1", u.port or WORKER_PORT
+        self.slots = 0                 # 0 = まだ繋がっていない
+        self.busy = 0                  # このプロセスから投げて実行中の数
+        self.down_until = 0.0
+        self.blobs = set()             # 送り済みのブロブ
+
+    def conn(self, timeout: Optional[float] = CONNECT_TIMEOUT) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    @property
+    def up(self) -> bool:
+        return self.slots > 0 and self.down_until <= time.monotonic()
+
+class _RemoteCall:
+    """実行中のリモートエンコード。CancelToken / run_ffmpeg_parallel からは Popen と同じように poll / kill される"""
+    def __init__(self):
+        self.sock = None  # 応答を読み始めると HTTPConnection からは外れるので、ソケットを直接持つ
+        self.returncode: Optional[int] = None
+        self.killed = False
+
+    def poll(self) -> Optional[int]:
+        return self.returncode
+
+    def kill(self):
+        # 接続を切ると、ワーカーは次の進捗を書けずに ffmpeg を止める
+        self.killed = True
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class _WorkerError(Exception):
+    """ワーカーとのやりとりの失敗（ffmpeg の失敗ではない）。別のワーカーでやり直す"""
+
+class RemotePool:
+    """
+    ワーカーの一覧。run() は run_ffmpeg の代わりに run_ffmpeg_parallel へ渡せる。
+    空きのあるワーカーのうち実行中の割合が小さいものに投げ、失敗したら試していないワーカーでやり直す。
+    local_fallback なら、どのワーカーにも繋がらないときはこのマシンで実行する（同時 local_slots 本まで）。
+    """
+    def __init__(self, addrs: Sequence[str], token: str = WORKER_TOKEN, local_fallback: bool = True,
+                 local_slots: Optional[int] = None):
+        self.workers = [_RemoteWorker(a) for a in addrs if a.strip()]
+        self.token = token
+        self.local_fallback = local_fallback
+        self.local = threading.Semaphore(local_slots or default_workers())
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.blob_locks: Dict[Tuple[str, str], threading.Lock] = {}
+
+    def _headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.token}"} if self.token else {}
+
+    def refresh(self) -> int:
+        """各ワーカーの /healthz を見て、繋がるワーカーの同時エンコード数の合計を返す"""
+        for w in self.workers:
+            try:
+                conn = w.conn(timeout=3)
+                conn.request("GET", "/healthz")
+                resp = conn.getresponse()
+                info = json.loads(resp.read()) if resp.status == 200 else {}
+                conn.close()
+            except (OSError, http.client.HTTPException, ValueError):
+                info = {}
+            with self.lock:
+                if info.get("name") == "movie_connecter_worker":
+                    w.slots, w.down_until = max(1, int(info.get("slots") or 1)), 0.0
+                else:
+                    w.slots = 0
+        return self.capacity
+
+    @property
+    def capacity(self) -> int:
+        with self.lock:
+            return sum(w.slots for w in self.workers if w.up)
+
+    def describe(self) -> str:
+        with self.lock:
+            up = [w for w in self.workers if w.up]
+        return f"{len(up)}/{len(self.workers)} 台（同時 {sum(w.slots for w in up)} 本）"
+
+    def _acquire(self, tried: set, cancel: Optional[CancelToken]) -> Optional[_RemoteWorker]:
+        """試していないワーカーの空きを1つ取る。候補が残っていなければ None"""
+        with self.cond:
+            while True:
+                if cancel is not None and cancel.cancelled:
+                    return None
+                cands = [w for w in self.workers if w.up and w.addr not in tried]
+                if not cands:
+                    return None
+                free = [w for w in cands if w.busy < w.slots]
+                if free:
+                    w = min(free, key=lambda w: w.busy / w.slots)
+                    w.busy += 1
+                    return w
+                self.cond.wait(timeout=0.5)
+
+    def _release(self, w: _RemoteWorker, failed: bool = False):
+        with self.cond:
+            w.busy -= 1
+            if failed:
+                w.down_until = time.monotonic() + DOWN_SECONDS
+                w.blobs.clear()  # 落ちている間に消えているかもしれない
+            self.cond.notify_all()
+
+    def _upload(self, w: _RemoteWorker, name: str, path: str, force: bool = False):
+        with self.lock:
+            lock = self.blob_locks.setdefault((w.addr, name), threading.Lock())
+        # 同じクリップのチャンクが同時に来ても、送るのは1回だけ
+        with lock:
+            if name in w.blobs and not force:
+                return
+            conn = w.conn()
+            try:
+                if not force:
+                    conn.request("HEAD", f"/blobs/{name}", headers=self._headers())
+                    resp = conn.getresponse()
+                    resp.read()
+                    if resp.status == 200:
+                        w.blobs.add(name)
+                        return
+                    if resp.status != 404:
+                        raise _WorkerError(f"HEAD /blobs: {resp.status}")
+                conn.putrequest("PUT", f"/blobs/{name}")
+                for k, v in self._headers().items():
+                    conn.putheader(k, v)
+                conn.putheader("Content-Length", str(os.path.getsize(path)))
+                conn.endheaders()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK), b""):
+                        conn.send(chunk)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status != 201:
+                    raise _WorkerError(f"PUT /blobs: {resp.status} {resp.reason}")
+                w.blobs.add(name)
+            finally:
+                conn.close()
+
+    def _encode(self, w: _RemoteWorker, req: dict, files: Dict[str, str], out_path: Path,
+                on_start: Optional[Callable], on_progress: Optional[Callable[[dict], None]],
+                cancel: Optional[CancelToken]) -> Tuple[bool, str, dict]:
+        """1台で実行してパーツを out_path に受け取る。戻り値: (成功か, ログ, 使用量)"""
+        for attempt in range(2):
+            for name, path in files.items():
+                self._upload(w, name, path, force=attempt > 0)
+            body = json.dumps({"request": req}).encode("utf-8")
+            conn = w.conn()
+            call = _RemoteCall()
+            try:
+                conn.request("POST", "/encode", body=body,
+                             headers={**self._headers(), "Content-Type": "application/json"})
+                call.sock = conn.sock
+                if cancel is not None:
+                    cancel.register(call)
+                if on_start is not None:
+                    on_start(call)
+                resp = conn.getresponse()
+                if resp.status == 409:
+                    # 送ったあとにワーカー側で消された入力がある → 送り直してもう1回
+                    missing = json.loads(resp.read()).get("missing", [])
+                    w.blobs.difference_update(missing)
+                    continue
+                if resp.status != 200:
+                    raise _WorkerError(f"POST /encode: {resp.status} {resp.reason}")
+                final = None
+                for line in resp:
+                    event = json.loads(line)
+                    if "progress" in event and on_progress is not None:
+                        on_progress(event["progress"])
+                    elif event.get("done"):
+                        final = event
+                if final is None:
+                    if call.killed:
+                        return False, "Cancelled", {}
+                    raise _WorkerError("接続が途中で切れました")
+                if not final["ok"]:
+                    return False, final.get("log", ""), final.get("usage") or {}
+                self._download(w, final["part"], final["size"], out_path)
+                return True, final.get("log", ""), final.get("usage") or {}
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                if call.killed:
+                    return False, "Cancelled", {}
+                raise _WorkerError(str(e)) from e
+            finally:
+                call.returncode = 0
+                conn.close()
+        raise _WorkerError("入力ファイルを送れませんでした")
+
+    def _download(self, w: _RemoteWorker, part: str, size: int, out_path: Path):
+        conn = w.conn()
+        try:
+            conn.request("GET", f"/parts/{part}", headers=self._headers())
+            resp = conn.getresponse()
+            if resp.status != 200:
+                raise _WorkerError(f"GET /parts: {resp.status}")
+            with out_path.open("wb") as f:
+                shutil.copyfileobj(resp, f, CHUNK)
+            if out_path.stat().st_size != size:
+                raise _WorkerError("パーツを最後まで受け取れませんでした")
+        finally:
+            conn.close()
+
+    def run(self, cmd: List[str], on_start: Optional[Callable] = None,
+            on_progress: Optional[Callable[[dict], None]] = None,
+            cancel: Optional[CancelToken] = None) -> Tuple[bool, str]:
+        """
+        run_ffmpeg と同じ呼び方・戻り値。出力はワーカーから cmd の最後の引数のパスに受け取る。
+        リクエストの形にできないコマンドは（local_fallback に関わらず）このマシンで実行する。
+        """
+        if cancel is not None and cancel.cancelled:
+            return False, "Cancelled"
+        translated = encode_request(cmd)
+        if translated is None:
+            with self.local:
+                return run_ffmpeg(cmd, on_start=on_start, on_progress=on_progress, cancel=cancel)
+        req, files = translated
+        out_path = Path(cmd[-1])
+        tried, errors, ffmpeg_failures, log = set(), [], 0, ""
+        while ffmpeg_failures < FFMPEG_ATTEMPTS:
+            w = self._acquire(tried, cancel)
+            if w is None:
+                break
+            tried.add(w.addr)
+            t0 = time.perf_counter()
+            try:
+                ok, log, usage = self._encode(w, req, files, out_path, on_start, on_progress, cancel)
+            except _WorkerError as e:
+                self._release(w, failed=True)
+                errors.append(f"ワーカー {w.addr}: {e}")
+                _record_remote(w.addr, out_path, False, time.perf_counter() - t0, {}, str(e))
+                continue
+            self._release(w)
+            _record_remote(w.addr, out_path, ok, time.perf_counter() - t0, usage, log)
+            if ok or (cancel is not None and cancel.cancelled) or log == "Cancelled":
+                return ok, log
+            ffmpeg_failures += 1
+            errors.append(f"ワーカー {w.addr}: ffmpeg が失敗しました")
+        if ffmpeg_failures or (cancel is not None and cancel.cancelled):
+            return False, "\n".join([*errors, log])
+        if not self.local_fallback:
+            return False, "\n".join(errors or ["使えるワーカーがありません"])
+        with self.local:
+            ok, log = run_ffmpeg(cmd, on_start=on_start, on_progress=on_progress, cancel=cancel)
+        return ok, "\n".join([*errors, log]) if errors else log
+
+def _record_remote(addr: str, out_path: Path, ok: bool, wall: float, usage: dict, log: str):
+    """ワーカーで動いた ffmpeg も telemetry に1回分として記録する（CPU・メモリはワーカー側の値）"""
+    record_process(ProcessUsage(
+        output=out_path.name,
+        ok=ok,
+        wall_s=round(wall, 3),
+        cpu_s=usage.get("cpu_s"),
+        peak_rss_mb=usage.get("peak_rss_mb"),
+        read_bytes=usage.get("read_bytes"),
+        written_bytes=usage.get("written_bytes"),
+        frames=usage.get("frames") or 0,
+        fps=round((usage.get("frames") or 0) / wall, 1) if wall > 0 else 0.0,
+        errors=[] if ok else [line for line in log.splitlines() if line.strip()][-5:],
+        worker=addr,
+    ))
+
+_default_pool: Optional[RemotePool] = None
+_default_lock = threading.Lock()
+
+def default_pool() -> Optional[RemotePool]:
+    """MOVIE_CONNECTER_WORKERS（host:port のカンマ区切り）のワーカー。未設定なら None"""
+    global _default_pool
+    addrs = [a.strip() for a in os.environ.get("MOVIE_CONNECTER_WORKERS", "").split(",") if a.strip()]
+    if not addrs:
+        return None
+    with _default_lock:
+        if _default_pool is None:
+            _default_pool = RemotePool(addrs)
+        return _default_pool
@@ -0,0 +1,1057 @@
+# -*- coding: utf-8 -*-
+"""レンダリングのパイプライン（書き出し・プレビュー・静止画）。Streamlit には依存しない"""
+import contextvars, functools, hashlib, json, os, re, tempfile, threading, uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from .cache import CACHE_ROOT, PART_CACHE_MAX_BYTES, PartCache, file_sha256, normalize_vf_for_key, part_key
+from .captions import SHORTS_SIZE, caption_vf
+from .checkpoint import ExportCheckpoint, has_checkpoint, sweep_checkpoints
+from .encoders import BUDGET_WAIT_SECONDS, BudgetPlan, encoder_registry, plan_budget
+from .ffmpeg import (CancelToken, JobProgress, StageTimer, default_workers, get_ffmpeg_exe, run_ffmpeg,
+                     run_ffmpeg_parallel, x264_threads_for)
+from .hls import HlsPreview
+from .jobs import Clip, Job
+from .probe import display_size, get_media_meta, meta_duration
+from .remote import RemotePool, default_pool
+from .telemetry import job_span
+
+class RenderError(Exception):
+    """ffmpeg が失敗したときの例外。log に ffmpeg のログ"""
+    def __init__(self, message: str, log: str = ""):
+        super().__init__(message)
+        self.log = log
+
+class RenderCancelled(RenderError):
+    """CancelToken でキャンセルされた"""
+    def __init__(self):
+        super().__init__("キャンセルしました。")
+
+def _check_cancel(cancel: Optional[CancelToken]):
+    if cancel is not None and cancel.cancelled:
+        raise RenderCancelled()
+
+def _tracked(kind: str):
+    """
+    render_* の中で動いた ffmpeg をジョブ1件として telemetry に記録する（done / failed / cancelled）。
+    戻り値が RenderResult ならまとめた使用量を usage に入れる。
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(job: Job, *args, **kwargs):
+            with job_span(kind, job.name or Path(job.output).name) as span:
+                try:
+                    result = fn(job, *args, **kwargs)
+                except RenderCancelled:
+                    span.state = "cancelled"
+                    raise
+                span.state = "done"
+            if isinstance(result, RenderResult):
+                result.usage = span.record
+            return result
+        return wrapper
+    return deco
+
+class Reporter:
+    """
+    進捗の通知先。既定は何もしない（Streamlit / CLI 側で上書きする）。
+    どのメソッドも render_* を呼んだスレッドから呼ばれる。
+    """
+    def progress(self, fraction: float, text: str):
+        pass
+
+    def clear(self):
+        pass
+
+    def notice(self, text: str):
+        pass
+
+    def stream(self, playlist: Path):
+        """段階再生のプレビューが再生できるようになった（エンコードのワーカースレッドから呼ばれる）"""
+        pass
+
+@dataclass
+class RenderResult:
+    output: Path
+    timer: StageTimer
+    engine: str = ""                 # single / two_stage / passthrough / multi / window / trim / per_clip
+    cache_stats: str = ""            # パーツキャッシュ無効なら空
+    start: float = 0.0               # プレビューの開始位置（結合後の秒）
+    window: List[Tuple[int, float, float]] = field(default_factory=list)  # プレビューでエンコードした (idx, 開始秒, 秒数)
+    renditions: List["RenderResult"] = field(default_factory=list)       # 同時に書き出した別レイアウト
+    usage: Optional[dict] = None     # ジョブ全体のリソース使用量（telemetry のジョブの記録）
+
+# ---------------- Single-pass render (filter_complex) ----------------
+SINGLE_PASS_MAX_CLIPS = 8             # 同時に開くデコーダ数の上限
+SINGLE_PASS_MAX_GRAPH_CHARS = 32000   # filter_complex 全体の文字数の上限
+
+RENDER_MODES = {
+    "auto": "自動（本数とグラフの大きさで選択）",
+    "single": "一括（filter_complex・中間ファイルなし）",
+    "two_stage": "2段階（クリップごと→連結）",
+}
+
+_LABEL_RE = re.compile(r"\[([A-Za-z_]\w*)\]")
+
+def build_concat_graph(vfs: List[str], audio: Optional["AudioPlan"] = None,
+                       metas: Optional[List[Optional[dict]]] = None) -> str:
+    """
+    各入力に個別の vf チェーンを掛け、concat フィルタで 1 本に繋ぐ filter_complex を作る。
+    audio（音声プラン）を渡すと、音声を共通のレート・チャンネルに揃え、音声のないクリップには無音を入れる。
+    """
+    # vf 内のラベル（字幕 overlay の [base0] など）はクリップごとに接頭辞を付けて衝突を避ける
+    chains = []
+    for i, vf in enumerate(vfs):
+        vf = _LABEL_RE.sub(lambda m: f"[c{i}_{m.group(1)}]", vf)
+        chains.append(f"[{i}:v]{vf}[v{i}]")
+    if audio is not None and audio.mode == "none":
+        pads = "".join(f"[v{i}]" for i in range(len(vfs)))
+        chains.append(f"{pads}concat=n={len(vfs)}:v=1:a=0[vout]")
+        return ";\n".join(chains)
+    if audio is not None and audio.mode == "encode":
+        for i, meta in enumerate(metas or [None] * len(vfs)):
+            chains.append(f"{audio.graph_source(i, meta)}[a{i}]")
+        pads = "".join(f"[v{i}][a{i}]" for i in range(len(vfs)))
+    else:
+        pads = "".join(f"[v{i}][{i}:a]" for i in range(len(vfs)))
+    chains.append(f"{pads}concat=n={len(vfs)}:v=1:a=1[vout][aout]")
+    return ";\n".join(chains)
+
+def choose_render_mode(mode: str, n_clips: int, graph: str, prefer_parts: bool = False) -> str:
+    if mode != "auto":
+        return mode
+    if prefer_parts:
+        # パーツを再利用する（キャッシュ有効）なら2段階の方が再書き出しが速い
+        return "two_stage"
+    if n_clips <= SINGLE_PASS_MAX_CLIPS and len(graph) <= SINGLE_PASS_MAX_GRAPH_CHARS:
+        return "single"
+    return "two_stage"
+
+def single_pass_cmd(in_paths: List[Path], graph_file: Path, enc_args: List[str], out_path: Path,
+                    with_audio: bool = True) -> List[str]:
+    cmd = [get_ffmpeg_exe(), "-y"]
+    for p in in_paths:
+        cmd += ["-i", str(p)]
+    cmd += [
+        "-filter_complex_script", str(graph_file),
+        "-map", "[vout]", *(["-map", "[aout]"] if with_audio else []),
+        *enc_args,
+        "-movflags", "+faststart",
+        str(out_path)
+    ]
+    return cmd
+
+# ---------------- Passthrough (stream copy) ----------------
+COPYABLE_VIDEO_CODECS = {"h264"}
+COPYABLE_AUDIO_CODECS = {"aac"}
+COPY_ARGS = ["-map", "0:v:0", "-map", "0:a:0?", "-c", "copy", "-avoid_negative_ts", "make_zero"]
+
+def copy_signature(meta: Optional[dict]) -> Optional[tuple]:
+    """
+    concat demuxer の -c copy でそのまま繋げるかを比べるための codec パラメータ。
+    mp4 にコピーできない codec / 画素形式なら None。
+    """
+    if not meta or not meta.get("video"):
+        return None
+    v, a = meta["video"], meta.get("audio")
+    if v["codec"] not in COPYABLE_VIDEO_CODECS or v["pix_fmt"] != "yuv420p":
+        return None
+    if a and a["codec"] not in COPYABLE_AUDIO_CODECS:
+        return None
+    return (
+        v["codec"], v["profile"], v["width"], v["height"], v["fps"], v["time_base"], v.get("rotation", 0),
+        (a["codec"], a["profile"], a["sample_rate"], a["channels"]) if a else None,
+    )
+
+def plan_passthrough(vfs: List[str], metas: List[Optional[dict]]) -> bool:
+    """
+    全クリップが字幕なし（vf が null）で、codec/プロファイル・解像度・fps・タイムベース・音声形式が
+    すべて一致するときだけ True。再エンコードしたパーツとコピーしたパーツは SPS/PPS が
+    揃わないので、混在はさせずにバッチ単位で判定する。
+    """
+    if not vfs or any(vf != "null" for vf in vfs):
+        return False
+    sigs = [copy_signature(m) for m in metas]
+    return sigs[0] is not None and all(sig == sigs[0] for sig in sigs)
+
+# ---------------- Audio plan ----------------
+AUDIO_FALLBACK_RATE = 48000
+
+@dataclass
+class AudioPlan:
+    """
+    パーツの音声をどう作るか。連結（concat demuxer の -c copy）は全パーツの音声の形式が同じでないと
+    音ずれ・欠落が起きるので、バッチ単位で1つに決める。
+    - copy: 全クリップが同じ形式の AAC → 音声は再エンコードしない
+    - encode: それ以外 → 共通のレート・チャンネル数の AAC に揃え、音声のないクリップには無音を入れる
+    - none: どのクリップにも音声がない → 音声なし
+    """
+    mode: str
+    sample_rate: int = AUDIO_FALLBACK_RATE
+    channels: int = 2
+
+    @property
+    def layout(self) -> str:
+        return "mono" if self.channels == 1 else "stereo"
+
+    def silence(self) -> str:
+        return f"anullsrc=r={self.sample_rate}:cl={self.layout}"
+
+    def silent(self, meta: Optional[dict]) -> bool:
+        """無音を足すクリップか（プローブできなかったクリップは音声ありとして扱う）"""
+        return self.mode == "encode" and bool(meta) and not meta.get("audio")
+
+    def maps(self, meta: Optional[dict], video: str = "0:v:0") -> List[str]:
+        """映像 video と音声の -map（無音は 2 番目の入力）"""
+        if self.mode == "none":
+            return ["-map", video]
+        if self.silent(meta):
+            return ["-map", video, "-map", "1:a:0", "-shortest"]
+        return ["-map", video, "-map", "0:a:0" if meta else "0:a:0?"]
+
+    def inputs(self, meta: Optional[dict]) -> List[str]:
+        """クリップの -i の直後に置く引数（無音の入力と -map）"""
+        silence = ["-f", "lavfi", "-i", self.silence()] if self.silent(meta) else []
+        return [*silence, *self.maps(meta)]
+
+    def outputs(self) -> List[str]:
+        if self.mode == "none":
+            return ["-an"]
+        if self.mode == "copy":
+            return ["-c:a", "copy"]
+        return ["-c:a", "aac", "-ar", str(self.sample_rate), "-ac", str(self.channels)]
+
+    def graph_source(self, i: int, meta: Optional[dict]) -> str:
+        """一括レンダリングの filter_complex で i 番目のクリップの音声になるチェーン（mode=encode 用）"""
+        if self.silent(meta) and meta_duration(meta) > 0:
+            return f"{self.silence()},atrim=duration={meta_duration(meta):.6f}"
+        return f"[{i}:a]aresample={self.sample_rate},aformat=channel_layouts={self.layout}"
+
+    def track_cmd(self, src: str, meta: Optional[dict], out_path: Path) -> List[str]:
+        """クリップ全体の音声だけのファイル（長いクリップを分割したとき用）"""
+        if self.silent(meta):
+            inputs = ["-f", "lavfi", "-t", f"{meta_duration(meta):.6f}", "-i", self.silence()]
+        else:
+            inputs = ["-i", src, "-map", "0:a:0", "-vn"]
+        return [get_ffmpeg_exe(), "-y", *inputs, *self.outputs(), "-f", "mp4", str(out_path)]
+
+def plan_audio(metas: List[Optional[dict]]) -> AudioPlan:
+    """プローブ結果から音声プランを決める。揃えるレートは多数派（同数なら高い方）、チャンネルはモノラルだけならモノラル"""
+    streams = [(m or {}).get("audio") for m in metas]
+    present = [a for a in streams if a]
+    if not present:
+        return AudioPlan("none") if all(metas) else AudioPlan("encode")
+    sigs = {(a["codec"], a["profile"], a["sample_rate"], a["channels"]) for a in present}
+    first = present[0]
+    if (len(present) == len(streams) and len(sigs) == 1 and first["codec"] in COPYABLE_AUDIO_CODECS
+            and first["sample_rate"] > 0 and first["channels"] > 0):
+        return AudioPlan("copy", first["sample_rate"], first["channels"])
+    rates = [a["sample_rate"] for a in present if a["sample_rate"] > 0] or [AUDIO_FALLBACK_RATE]
+    rate = max(sorted(set(rates), reverse=True), key=rates.count)
+    channels = 1 if all(a["channels"] == 1 for a in present) else 2
+    return AudioPlan("encode", rate, channels)
+
+def part_codec(codec: List[str], audio: Optional[AudioPlan], meta: Optional[dict]) -> List[str]:
+    """パーツ1本の -i 以降の引数: 映像の設定 codec の前後に音声の入力・対応付け・設定を足す（audio が None なら codec のまま）"""
+    if audio is None:
+        return codec
+    return [*audio.inputs(meta), *codec, *audio.outputs()]
+
+# ---------------- Preview window ----------------
+PREVIEW_ANCHORS = {
+    "head": "先頭から",
+    "offset": "指定した秒から",
+    "join": "つなぎ目の前後",
+}
+
+def preview_window_start(durations: List[float], anchor: str, length: float, offset: float, join_k: int) -> Optional[float]:
+    """
+    結合後のどこからプレビューするか（秒）。
+    つなぎ目指定（クリップ k と k+1 の間を中心に）は尺が分からないと決められないので None。
+    """
+    if anchor == "offset":
+        return max(0.0, float(offset))
+    if anchor == "join" and len(durations) > 1:
+        k = max(1, min(int(join_k), len(durations) - 1))
+        if any(d <= 0 for d in durations[:k]):
+            return None
+        return max(0.0, sum(durations[:k]) - length / 2)
+    return 0.0
+
+def plan_preview_window(durations: List[float], start: float, length: float) -> Optional[List[Tuple[int, float, float]]]:
+    """
+    結合後の [start, start+length) に掛かるクリップだけを選び、(idx, クリップ内の開始秒, 秒数) を返す。
+    尺が1本でも不明なら None（全体を作ってからトリムする従来の方式に戻す）。
+    開始位置が全体の尺を超えるときは末尾の length 秒にずらす。
+    """
+    if not durations or any(d <= 0 for d in durations):
+        return None
+    total = sum(durations)
+    start = max(0.0, min(start, total - length))
+    end = start + length
+    window = []
+    t = 0.0
+    for i, d in enumerate(durations):
+        s0, s1 = max(start, t), min(end, t + d)
+        if s1 - s0 > 0.01:
+            window.append((i, round(s0 - t, 3), round(s1 - s0, 3)))
+        t += d
+    return window
+
+# ---------------- Still preview ----------------
+STILL_CACHE_MAX_FILES = 2000
+
+def still_time(c: Clip, t: float) -> float:
+    """指定秒がクリップより長ければ中央のフレームにする"""
+    d = meta_duration(c.meta)
+    return min(float(t), d / 2) if d > 0 else float(t)
+
+def render_still(src: str, digest: str, vf: str, t: float) -> Tuple[Optional[Path], str]:
+    """
+    t 秒付近のキーフレームを 1 枚だけデコードし、vf（字幕）を掛けた JPEG を返す。戻り値: (JPEG, 失敗時のログ)
+    (クリップのハッシュ, 正規化した vf, 時刻) でキャッシュするので、字幕を変えたクリップだけ作り直しになる。
+    """
+    key = hashlib.sha256(f"{digest}|{t:.3f}|{normalize_vf_for_key(vf)}".encode("utf-8")).hexdigest()
+    root = CACHE_ROOT / "stills"
+    out = root / f"{key}.jpg"
+    if out.exists():
+        os.utime(out)
+        return out, ""
+    root.mkdir(parents=True, exist_ok=True)
+    tmp = root / f"{key}.{uuid.uuid4().hex}.tmp.jpg"
+    ok, log = run_ffmpeg([
+        get_ffmpeg_exe(), "-y",
+        "-ss", f"{t:g}", "-noaccurate_seek",
+        "-i", src,
+        "-frames:v", "1",
+        # キーフレーム位置のフレームは負の pts になるので 0 に揃える（字幕 overlay は pts 0 から重なる）
+        "-vf", f"setpts=PTS-STARTPTS,{vf}",
+        "-q:v", "3",
+        str(tmp)
+    ])
+    if not ok or not tmp.exists():
+        tmp.unlink(missing_ok=True)
+        return None, log
+    os.replace(tmp, out)
+    return out, ""
+
+def evict_stills(max_files: int = STILL_CACHE_MAX_FILES):
+    """最後に使われたのが古いものから消して、枚数を上限以内に保つ"""
+    files = [p for p in (CACHE_ROOT / "stills").glob("*.jpg") if ".tmp." not in p.name]
+    files.sort(key=lambda p: p.stat().st_mtime)
+    for p in files[:max(0, len(files) - max_files)]:
+        p.unlink(missing_ok=True)
+
+# ---------------- Chunked encode (long clips) ----------------
+CHUNK_MIN_CLIP_SECONDS = 120.0  # これより短いクリップは分割しない
+CHUNK_MIN_SECONDS = 30.0        # 1チャンクの最短の長さ
+KEYFRAME_CACHE_VERSION = 1
+_PTS_TIME_RE = re.compile(r"pts_time:(-?\d+(?:\.\d+)?)")
+
+def keyframe_times(digest: str, path: str) -> List[float]:
+    """映像のキーフレームの時刻（秒・昇順）。キーフレームだけをデコードして調べ、クリップのハッシュ単位でキャッシュ"""
+    cache_file = CACHE_ROOT / "probe" / f"{digest}.keyframes.json"
+    try:
+        cached = json.loads(cache_file.read_text(encoding="utf-8"))
+        if cached.get("version") == KEYFRAME_CACHE_VERSION:
+            return cached["times"]
+    except (OSError, ValueError, KeyError):
+        pass
+    found = set()  # キーフレームの数だけ行が出るので、ログ（末尾だけ）ではなく1行ずつ拾う
+    ok, _ = run_ffmpeg([get_ffmpeg_exe(), "-hide_banner", "-skip_frame", "nokey", "-i", path,
+                        "-map", "0:v:0", "-vf", "showinfo", "-f", "null", "-"],
+                       on_line=lambda line: found.update(float(t) for t in _PTS_TIME_RE.findall(line)))
+    if not ok:
+        return []
+    times = sorted(found)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache_file.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    tmp.write_text(json.dumps({"version": KEYFRAME_CACHE_VERSION, "times": times}), encoding="utf-8")
+    os.replace(tmp, cache_file)
+    return times
+
+def chunk_count(duration: float, workers: int, n_parts: int) -> int:
+    """
+    長いクリップを何分割するか。パーツ数だけで並列数を埋められるなら分割しない
+    （分割はチャンクの連結と音声の別エンコードが増えるので、コアが余るときだけ）。
+    """
+    if workers < 2 or n_parts >= workers or duration < CHUNK_MIN_CLIP_SECONDS:
+        return 1
+    return max(1, min(workers, int(duration // CHUNK_MIN_SECONDS)))
+
+def plan_chunks(duration: float, keyframes: List[float], n: int) -> List[Tuple[float, float]]:
+    """
+    [(開始秒, 秒数)] に分割する。境界は等分位置にいちばん近いキーフレーム
+    （入力側 -ss がキーフレームちょうどになり、チャンク間でフレームの重複・欠落が出ない）。
+    最後のチャンクの秒数は 0（終わりまで）。分割できなければ空。
+    """
+    if n < 2 or duration <= 0 or not keyframes:
+        return []
+    bounds = [0.0]
+    for k in range(1, n):
+        kf = min(keyframes, key=lambda t: abs(t - duration * k / n))
+        if kf - bounds[-1] >= CHUNK_MIN_SECONDS and duration - kf >= CHUNK_MIN_SECONDS:
+            bounds.append(kf)
+    if len(bounds) < 2:
+        return []
+    return [(a, b - a) for a, b in zip(bounds, bounds[1:])] + [(bounds[-1], 0.0)]
+
+def chunk_cmd(src: str, start: float, length: float, codec: List[str], out_path: Path) -> List[str]:
+    """映像だけのチャンク1本。字幕は静止しているので、同じ vf を掛ければチャンクをまたいでも途切れない"""
+    seek = ["-ss", f"{start:.6f}"] if start > 0 else []
+    dur = ["-t", f"{length:.6f}"] if length > 0 else []
+    return [get_ffmpeg_exe(), "-y", *seek, *dur, "-i", src, "-an", *codec, "-movflags", "+faststart", str(out_path)]
+
+def join_chunks(chunks: List[Path], audio: Optional[Path], out_path: Path,
+                cancel: Optional[CancelToken] = None) -> Tuple[bool, str]:
+    """チャンクを concat demuxer で -c copy 連結し、クリップ全体の音声を重ねて1パーツにする"""
+    listfile = out_path.with_suffix(".txt")
+    with listfile.open("w", encoding="utf-8") as f:
+        for p in chunks:
+            sp = str(p).replace("'", "'\\''")
+            f.write(f"file '{sp}'\n")
+    cmd = [get_ffmpeg_exe(), "-y", "-f", "concat", "-safe", "0", "-i", str(listfile)]
+    if audio is not None:
+        cmd += ["-i", str(audio), "-map", "0:v:0", "-map", "1:a:0"]
+    cmd += ["-c", "copy", "-movflags", "+faststart", "-f", "mp4", str(out_path)]
+    try:
+        return run_ffmpeg(cmd, cancel=cancel)
+    finally:
+        listfile.unlink(missing_ok=True)
+
+def _discard_chunks(part_cache: PartCache, chunks: List[Path], audio: Optional[Path]):
+    for p in [*chunks, *([audio] if audio else [])]:
+        part_cache.discard(p)
+
+# ---------------- Multi-output (one decode, several renditions) ----------------
+def split_graph(vfs: List[str]) -> str:
+    """1本の入力を split で分け、出力ごとの vf を掛ける filter_complex（出力ラベルは [v0] [v1] …）"""
+    if len(vfs) == 1:
+        heads = ["[0:v]"]
+        chains = []
+    else:
+        heads = [f"[in{k}]" for k in range(len(vfs))]
+        chains = [f"[0:v]split={len(vfs)}{''.join(heads)}"]
+    for k, (head, vf) in enumerate(zip(heads, vfs)):
+        # 字幕 overlay のラベル（[base0] など）は出力ごとに接頭辞を付けて衝突を避ける
+        vf = _LABEL_RE.sub(lambda m: f"[r{k}_{m.group(1)}]", vf)
+        chains.append(f"{head}{vf}[v{k}]")
+    return ";".join(chains)
+
+def multi_output_cmd(src: str, outputs: List[Tuple[Optional[str], List[str], Path]],
+                     audio: Optional[AudioPlan] = None, meta: Optional[dict] = None) -> List[str]:
+    """
+    クリップを1回だけデコードして複数のファイルに書き出すコマンド。
+    outputs は (vf, エンコード設定, 出力先)。vf が None の出力はストリームコピー（エンコード設定は COPY_ARGS）。
+    audio を渡すと、エンコードする出力の音声はプランどおり（エンコード設定は映像だけ）。
+    """
+    encoded = [vf for vf, _, _ in outputs if vf is not None]
+    cmd = [get_ffmpeg_exe(), "-y", "-i", src]
+    if audio is not None and audio.silent(meta):
+        cmd += ["-f", "lavfi", "-i", audio.silence()]
+    if encoded:
+        cmd += ["-filter_complex", split_graph(encoded)]
+    k = 0
+    for vf, codec, out in outputs:
+        if vf is None:
+            cmd += [*codec, "-movflags", "+faststart", str(out)]
+            continue
+        if audio is None:
+            cmd += ["-map", f"[v{k}]", "-map", "0:a:0?", *codec]
+        else:
+            cmd += [*audio.maps(meta, video=f"[v{k}]"), *codec, *audio.outputs()]
+        cmd += ["-movflags", "+faststart", str(out)]
+        k += 1
+    return cmd
+
+# ---------------- Pipeline ----------------
+def prepare_clips(job: Job) -> Job:
+    """ハッシュ・メタデータが未設定のクリップを埋める（アプリからは取り込み時に設定済み）"""
+    for c in job.clips:
+        try:
+            if not c.sha256:
+                c.sha256 = file_sha256(c.path)
+        except OSError as e:
+            raise RenderError(f"クリップを読めません: {c.path}", str(e)) from e
+        if c.meta is None:
+            c.meta = get_media_meta(c.sha256, c.path)
+        c.name = c.name or Path(c.path).name
+    return job
+
+def encode_pixels(job: Job) -> float:
+    """
+    書き出しでエンコードする総画素数（尺 × fps × 出力解像度）。fps・解像度が分からなければ 30fps・1920×1080 とみなすが、
+    尺の分からないクリップが1本でもあれば見積もれないので 0
+    """
+    total = 0.0
+    for c in job.clips:
+        duration = meta_duration(c.meta)
+        if duration <= 0:
+            return 0.0
+        fps = ((c.meta or {}).get("video") or {}).get("fps") or 30.0
+        w, h = SHORTS_SIZE if job.layout == "shorts" else display_size(c.meta) or (1920, 1080)
+        total += duration * fps * w * h
+    return total
+
+def plan_export_budget(jobs: List[Job], cpus: Optional[int] = None) -> Tuple[Optional[BudgetPlan], str]:
+    """
+    jobs[0].encode.time_budget に収まる encoder / preset を選ぶ（同時書き出しなら全レイアウトの合計で見積もる）。
+    エンコーダの計測中なら BUDGET_WAIT_SECONDS だけ待つ。戻り値: (プラン, 表示する文)。
+    見積もれないときのプランは None（指定の encoder / preset のまま書き出す）。
+    """
+    enc = jobs[0].encode
+    pixels = [encode_pixels(j) for j in jobs]
+    if not all(pixels):
+        return None, "クリップの尺が分からないため、指定の preset で書き出します。"
+    registry = encoder_registry()
+    if not registry.wait(BUDGET_WAIT_SECONDS):
+        return None, "エンコーダの速さを計測中のため、指定の preset で書き出します（次回から時間の目安で選びます）。"
+    plan = plan_budget(sum(pixels), enc.time_budget, enc.budget_encoders or [enc.encoder], registry, threads=cpus)
+    if plan is None:
+        return None, "エンコーダの速さを計れなかったため、指定の preset で書き出します。"
+    return plan, plan.text()
+
+def _open_part_cache(use_part_cache: bool, tmpdir: Path) -> PartCache:
+    # キャッシュ無効時は一時ディレクトリ内に置く（処理の流れは同じ）
+    return PartCache(CACHE_ROOT / "parts" if use_part_cache else tmpdir / "parts", PART_CACHE_MAX_BYTES)
+
+def _run_parts(cmds: List[List[str]], labels: List[str], workers: int, timer: StageTimer, reporter: Reporter,
+               durations: Optional[List[float]] = None, cancel: Optional[CancelToken] = None,
+               on_done: Optional[Callable[[int], None]] = None,
+               remote: Optional[RemotePool] = None) -> Tuple[bool, int, str]:
+    """
+    パーツを並列エンコードしつつ、全体の進捗とコマンドごとの所要時間（labels の名前で）を記録する。
+    durations は各コマンドが出力する長さ（秒）。-ss/-t で切り出す場合に入力全体の長さで重み付けしないよう上限にも使う。
+    on_done(添字) は成功したコマンドごとにワーカースレッドから呼ばれる。
+    remote を渡すとコマンドはワーカーで実行する。
+    """
+    progress = JobProgress(len(cmds), caps=list(durations) if durations else None, durations=durations)
+    reporter.progress(0.0, "エンコード準備中…")
+
+    def _finish(i: int, seconds: float):
+        if on_done is not None:
+            on_done(i)
+        progress.finish(i)
+        timer.add(labels[i], seconds)
+
+    ok, fail_idx, log = run_ffmpeg_parallel(
+        cmds, workers,
+        on_progress=progress.update,
+        on_finish=_finish,
+        poll=lambda: reporter.progress(min(1.0, progress.fraction()), progress.text()),
+        cancel=cancel,
+        runner=remote.run if remote is not None else None,
+    )
+    reporter.clear()
+    timer.lap("エンコード（全体）")
+    return ok, fail_idx, log
+
+def _run_with_progress(cmd: List[str], label: str, reporter: Reporter,
+                       cancel: Optional[CancelToken] = None) -> Tuple[bool, str]:
+    """単発の ffmpeg を進捗つきで実行"""
+    reporter.progress(0.0, label)
+
+    def _update(info: dict):
+        if info["duration"] > 0:
+            reporter.progress(min(1.0, info["out_time"] / info["duration"]), f"{label}（{info['speed']:.2f}x）")
+
+    ok, log = run_ffmpeg(cmd, on_progress=_update, cancel=cancel)
+    reporter.clear()
+    return ok, log
+
+def _concat_copy(parts: List[Path], listfile: Path, out_path: Path,
+                 cancel: Optional[CancelToken] = None) -> Tuple[bool, str]:
+    """concat demuxer で -c copy 連結"""
+    with listfile.open("w", encoding="utf-8") as f:
+        for p in parts:
+            sp = str(p).replace("'", "'\\''")
+            f.write(f"file '{sp}'\n")
+    return run_ffmpeg([
+        get_ffmpeg_exe(), "-y",
+        "-f", "concat", "-safe", "0",
+        "-i", str(listfile),
+        "-c", "copy",
+        "-movflags", "+faststart",
+        str(out_path)
+    ], cancel=cancel)
+
+def _encode_parts(job: Job, vfs: List[str], seg_args: List[List[str]], codec_args: List[List[str]],
+                  part_cache: PartCache, workers: int, timer: StageTimer, reporter: Reporter,
+                  clip_indices: List[int], durations: List[float], cancel: Optional[CancelToken] = None,
+                  checkpoint: Optional[ExportCheckpoint] = None, split_long: bool = False,
+                  audio: Optional[AudioPlan] = None,
+                  on_part: Optional[Callable[[int, Path], None]] = None,
+                  remote: Optional[RemotePool] = None, threads: Optional[int] = None) -> List[Path]:
+    """
+    キャッシュに無いパーツだけをエンコード（コマンドを揃えてから並列実行）して、全パーツのパスを返す。
+    audio を渡すと codec_args は映像の設定だけで、音声は part_codec でプランどおりに足す。
+    on_part(位置, パス) はパーツが使えるようになるたびに呼ぶ（キャッシュにあった分は最初に、エンコードした分は仕上がった順）。
+    checkpoint があれば完了済みパーツを使い、エンコードできたパーツは1本ずつ記録する（途中で落ちても残る）。
+    split_long なら、並列数に対してパーツが少ないとき長いクリップをキーフレームで分割してエンコードする。
+    remote を渡すとエンコードはワーカーで行う（チャンクの連結はこのマシンで）。
+    threads は実行時にだけ -threads として足す（パーツのキーには含めないので、並列数が変わってもキャッシュが効く）。
+    """
+    thread_args = ["-threads", str(threads)] if threads else []
+    keys = [part_cache.key(job.clips[i].sha256, vf, [*seg, *part_codec(codec, audio, job.clips[i].meta)])
+            for i, vf, seg, codec in zip(clip_indices, vfs, seg_args, codec_args)]
+    parts = []
+    for pos, k in enumerate(keys):
+        done = checkpoint.finished(pos) if checkpoint is not None else None
+        parts.append(done or part_cache.lookup(k))
+        if checkpoint is not None and done is None and parts[pos] is not None:
+            checkpoint.mark_done(pos, parts[pos])
+    todo = [pos for pos in range(len(keys)) if parts[pos] is None]
+    if on_part is not None:
+        for pos, p in enumerate(parts):
+            if p is not None:
+                on_part(pos, p)
+
+    cmds, labels, cmd_durations = [], [], []
+    cmd_part = []                      # コマンド → パーツの位置
+    tmp_out = {}                       # パーツの位置 → 書き込み中のパス
+    chunked = {}                       # パーツの位置 → (チャンクのパス, 音声のパス or None)
+    remaining = {}                     # パーツの位置 → 未完了のコマンド数
+    for pos in todo:
+        i, seg, codec = clip_indices[pos], seg_args[pos], [*codec_args[pos], *thread_args]
+        clip = job.clips[i]
+        tmp_out[pos] = part_cache.tmp_path(keys[pos])
+        n_chunks = chunk_count(meta_duration(clip.meta), workers, len(todo)) if split_long and not seg else 1
+        chunks = plan_chunks(meta_duration(clip.meta), keyframe_times(clip.sha256, clip.path), n_chunks) if n_chunks > 1 else []
+        if not chunks:
+            cmds.append([
+                get_ffmpeg_exe(), "-y",
+                *seg,
+                "-i", clip.path,
+                *part_codec(codec, audio, clip.meta),
+                "-movflags", "+faststart",
+                str(tmp_out[pos])
+            ])
+            labels.append(f"エンコード クリップ {i + 1}")
+            cmd_durations.append(durations[pos])
+            cmd_part.append(pos)
+            remaining[pos] = 1
+            continue
+        # 映像はチャンクごとに並列、音声はクリップ全体を1本で（チャンク境界で音が途切れないように）
+        reporter.notice(f"クリップ {i + 1}（{clip.name}）をキーフレームで {len(chunks)} 分割して並列にエンコードします。")
+        chunk_paths = []
+        for k, (start, length) in enumerate(chunks):
+            out_k = part_cache.tmp_path(f"{keys[pos]}.c{k:03d}")
+            cmds.append(chunk_cmd(clip.path, start, length, codec, out_k))
+            labels.append(f"エンコード クリップ {i + 1}（{k + 1}/{len(chunks)}）")
+            cmd_durations.append(length or max(0.0, meta_duration(clip.meta) - start))
+            cmd_part.append(pos)
+            chunk_paths.append(out_k)
+        audio_path = None
+        if audio is not None and audio.mode != "none":
+            audio_path = part_cache.tmp_path(f"{keys[pos]}.audio")
+            cmds.append(audio.track_cmd(clip.path, clip.meta, audio_path))
+            labels.append(f"音声 クリップ {i + 1}")
+            cmd_durations.append(meta_duration(clip.meta) * 0.02)  # 映像よりずっと速いので進捗の重みは小さく
+            cmd_part.append(pos)
+        chunked[pos] = (chunk_paths, audio_path)
+        remaining[pos] = len(chunk_paths) + (audio_path is not None)
+    timer.lap("字幕・キャッシュ準備")
+
+    lock = threading.Lock()
+    join_errors = {}  # パーツの位置 → チャンク連結のログ
+
+    def _commit(j: int):
+        pos = cmd_part[j]
+        with lock:
+            remaining[pos] -= 1
+            if remaining[pos]:
+                return
+        if pos in chunked:
+            ok, log = join_chunks(*chunked[pos], tmp_out[pos], cancel)
+            _discard_chunks(part_cache, *chunked[pos])
+            if not ok:
+                join_errors[pos] = log
+                return
+        parts[pos] = part_cache.commit(keys[pos], tmp_out[pos])
+        if checkpoint is not None:
+            checkpoint.mark_done(pos, parts[pos])
+        if on_part is not None:
+            on_part(pos, parts[pos])
+
+    ok, fail_idx, log = _run_parts(cmds, labels, workers, timer, reporter,
+                                   durations=cmd_durations, cancel=cancel, on_done=_commit, remote=remote)
+    fail_pos = cmd_part[fail_idx] if not ok else None
+    if ok and join_errors:
+        fail_pos, log = next(iter(join_errors.items()))
+    if fail_pos is not None:
+        for pos in todo:
+            if parts[pos] is None:
+                part_cache.discard(tmp_out[pos])
+                if pos in chunked:
+                    _discard_chunks(part_cache, *chunked[pos])
+        _check_cancel(cancel)
+        i = clip_indices[fail_pos]
+        raise RenderError(f"クリップ {i + 1}（{job.clips[i].name}）の処理に失敗しました。", log)
+    part_cache.evict(protect=set(keys))
+    return parts
+
+def _job_workers(workers: Optional[int], cpus: Optional[int]) -> int:
+    """クリップの同時エンコード数。cpus（この処理に割り当てた CPU スレッド数）を超えない"""
+    workers = int(workers or default_workers())
+    return max(1, min(workers, cpus)) if cpus else workers
+
+@_tracked("export")
+def render_export(job: Job, out_path: Path, workers: Optional[int] = None, use_part_cache: bool = True,
+                  reporter: Optional[Reporter] = None, cpus: Optional[int] = None,
+                  cancel: Optional[CancelToken] = None,
+                  renditions: Sequence[Tuple[Job, Path]] = (),
+                  remote: Optional[RemotePool] = None) -> RenderResult:
+    """
+    本番の書き出し。一括（filter_complex）か2段階（クリップごと→連結）、字幕なし・同一形式ならストリームコピー。
+    cpus を渡すと x264 のスレッド数の合計をその数に抑える（スケジューラから複数ジョブを同時に走らせる場合）。
+    cancel がキャンセルされると ffmpeg を止めて RenderCancelled を送出する。
+    renditions（同じクリップ並びの別レイアウトのジョブと出力先）を渡すと、クリップを1回ずつデコードして
+    全部を同時に書き出す。別レイアウトの結果は戻り値の renditions に入る。
+    encode.time_budget（秒）があれば、その時間に収まる見込みの中でいちばん画質の良い encoder / preset に置き換える。
+    remote（省略時は MOVIE_CONNECTER_WORKERS のワーカー）があれば、クリップごとのエンコードをワーカーに振り分けて
+    連結だけをこのマシンで行う。一括・ストリームコピー・同時書き出しはこのマシンで処理する。
+    """
+    reporter = reporter or Reporter()
+    workers = _job_workers(workers, cpus)
+    if job.encode.time_budget > 0:
+        # 時間の予算から encoder / preset を決める（同時書き出しの別レイアウトも同じ設定）
+        prepare_clips(job)
+        renditions = [(prepare_clips(j), p) for j, p in renditions]
+        plan, text = plan_export_budget([job, *[j for j, _ in renditions]], cpus)
+        reporter.notice(text)
+        if plan is not None:
+            job, renditions = plan.apply(job), [(plan.apply(j), p) for j, p in renditions]
+    if renditions:
+        return _render_renditions([(job, Path(out_path)), *[(j, Path(p)) for j, p in renditions]],
+                                  workers, use_part_cache, reporter, cpus, cancel)
+    timer = StageTimer()
+    prepare_clips(job)
+    out_path = Path(out_path)
+    enc_args = job.encode.args()
+    sweep_checkpoints()
+    with tempfile.TemporaryDirectory(prefix="concat_export_") as tmpd, ExitStack() as runs:
+        tmpdir = Path(tmpd)
+        vfs = [caption_vf(job.layout, job.captions, c, tmpdir / f"lines_{idx:03d}") for idx, c in enumerate(job.clips)]
+        # 字幕なし・同一形式ならパーツは再エンコードせずストリームコピー
+        passthrough = plan_passthrough(vfs, [c.meta for c in job.clips])
+        n = len(job.clips)
+        # 音声は全パーツで同じ形式にする（同じ形式の AAC ならコピー、それ以外は揃えて再エンコード）
+        audio = None if passthrough else plan_audio([c.meta for c in job.clips])
+        threads = None
+        if passthrough:
+            codec_args = [COPY_ARGS] * n
+        else:
+            threads = x264_threads_for(workers, cpus)
+            codec_args = [["-vf", vf, *job.encode.video_args()] for vf in vfs]
+            n_silent = sum(audio.silent(c.meta) for c in job.clips)
+            if n_silent:
+                reporter.notice(f"音声のないクリップ {n_silent} 本には無音の音声を入れて連結します。")
+        # ワーカーに振り分けるときは並列数をワーカーの空きに合わせる（-threads はパーツのキーに含めず、
+        # ワーカー側でも決め直すので、キーはこのマシンでエンコードしたときと同じ）
+        remote = None if passthrough else remote if remote is not None else default_pool()
+        if remote is not None:
+            if remote.refresh():
+                workers = remote.capacity
+                reporter.notice(f"クリップのエンコードをワーカー {remote.describe()} に振り分けます。")
+            else:
+                reporter.notice("ワーカーに接続できないため、このマシンでエンコードします。")
+                remote = None
+        keys = [part_key(c.sha256, vf, part_codec(codec, audio, c.meta))
+                for c, vf, codec in zip(job.clips, vfs, codec_args)]
+        # 同じ内容の書き出しが途中で止まっていれば、一括ではなくパーツ方式で続きから
+        resumable = has_checkpoint(keys)
+        # 長いクリップを分割して並列にできるなら、一括（x264 が1本）より2段階の方が速い
+        split_long = job.encode.split_long and not passthrough
+        splittable = split_long and any(chunk_count(meta_duration(c.meta), workers, n) > 1 for c in job.clips)
+
+        graph = build_concat_graph(vfs, audio, [c.meta for c in job.clips])
+        engine = choose_render_mode(job.encode.render_mode, len(vfs), graph,
+                                    prefer_parts=use_part_cache or resumable or splittable or remote is not None)
+        if passthrough:
+            engine = "passthrough"
+            reporter.notice("字幕がなく全クリップの形式が揃っているため、再エンコードせずストリームコピーで連結します。")
+        if engine == "single":
+            timer.lap("字幕・キャッシュ準備")
+            # 一括: 全クリップを1つのグラフで連結し、1回だけエンコード
+            graph_file = tmpdir / "graph.txt"
+            graph_file.write_text(graph, encoding="utf-8")
+            single_args = [*enc_args, "-threads", str(cpus)] if cpus else enc_args
+            cmd = single_pass_cmd([Path(c.path) for c in job.clips], graph_file, single_args, out_path,
+                                  with_audio=audio.mode != "none")
+            ok, log = _run_with_progress(cmd, "一括レンダリング中…", reporter, cancel)
+            timer.lap("一括レンダリング")
+            _check_cancel(cancel)
+            if ok:
+                return RenderResult(out_path, timer, engine="single")
+            if job.encode.render_mode == "single":
+                raise RenderError("一括レンダリングに失敗しました。", log)
+            reporter.notice("一括レンダリングに失敗したため、2段階方式で書き出します（解像度の異なるクリップや音声のないクリップがある場合など）。")
+            engine = "two_stage"
+
+        # パーツの完了状態をジョブディレクトリに記録しながらエンコードする。
+        # キャッシュ無効時のパーツも一時ディレクトリではなくジョブディレクトリに置き、書き出しが終わるまで残す
+        checkpoint = ExportCheckpoint(keys, {"layout": job.layout, "name": job.name, "output": job.output,
+                                             "clips": [c.name for c in job.clips], "engine": engine})
+        runs.callback(checkpoint.release)  # 失敗・キャンセルでも登録は外す（ディレクトリは再開用に残る）
+        part_cache = (PartCache(CACHE_ROOT / "parts", PART_CACHE_MAX_BYTES) if use_part_cache
+                      else PartCache(checkpoint.dir / "parts", PART_CACHE_MAX_BYTES))
+        if checkpoint.resumed:
+            reporter.notice(f"前回止まった書き出しの続きから再開します（完了済み {checkpoint.resumed}/{n} パーツ）。")
+        parts = _encode_parts(job, vfs, [[]] * n, codec_args, part_cache, workers, timer, reporter,
+                              list(range(n)), [meta_duration(c.meta) for c in job.clips], cancel, checkpoint,
+                              split_long=split_long, audio=audio, remote=remote,
+                              threads=threads)
+        # 連結は全パーツが揃っているときだけ
+        missing = sorted(set(checkpoint.missing()) | {i for i, p in enumerate(parts) if not p.exists()})
+        if missing:
+            raise RenderError("パーツが揃っていないため連結できません: クリップ " + ", ".join(str(i + 1) for i in missing))
+        checkpoint.set_state("concat")
+        ok, log = _concat_copy(parts, tmpdir / "concat.txt", out_path, cancel)
+        _check_cancel(cancel)
+        if not ok:
+            raise RenderError("結合に失敗しました。", log)
+        timer.lap("連結")
+        checkpoint.remove()
+        return RenderResult(out_path, timer, engine=engine, cache_stats=part_cache.stats_text() if use_part_cache else "")
+
+@dataclass
+class _Rendition:
+    """同時書き出しの1レイアウト分（パーツのキー・完了状態は通常の2段階方式と同じ形）"""
+    job: Job
+    out_path: Path
+    vfs: List[str]
+    passthrough: bool
+    keys: List[str]
+    checkpoint: ExportCheckpoint
+    part_cache: PartCache
+    parts: List[Optional[Path]]
+
+def _render_renditions(targets: List[Tuple[Job, Path]], workers: int, use_part_cache: bool, reporter: Reporter,
+                       cpus: Optional[int], cancel: Optional[CancelToken]) -> RenderResult:
+    """
+    同じクリップ並びの複数レイアウト（横動画とショートなど）を同時に書き出す。
+    クリップごとに ffmpeg を1回だけ起動し、デコードした映像を split で各レイアウトの vf に分けて
+    それぞれエンコードする。最後にレイアウトごとに連結する。
+    """
+    timer = StageTimer()
+    for job, _ in targets:
+        prepare_clips(job)
+    base = targets[0][0]
+    if any([c.sha256 for c in job.clips] != [c.sha256 for c in base.clips] for job, _ in targets[1:]):
+        raise RenderError("同時に書き出すジョブはクリップの並びが同じである必要があります。")
+    sweep_checkpoints()
+    n = len(base.clips)
+    # 1プロセスでレイアウトの数だけ x264 が動くので、スレッドはその本数で分け合う
+    threads = max(1, x264_threads_for(workers, cpus) // len(targets))
+    shared_cache = PartCache(CACHE_ROOT / "parts", PART_CACHE_MAX_BYTES) if use_part_cache else None
+    # 音声プランはクリップだけで決まるので全レイアウト共通
+    audio = plan_audio([c.meta for c in base.clips])
+    with tempfile.TemporaryDirectory(prefix="concat_multi_") as tmpd, ExitStack() as runs:
+        tmpdir = Path(tmpd)
+        rends = []
+        for k, (job, out_path) in enumerate(targets):
+            vfs = [caption_vf(job.layout, job.captions, c, tmpdir / f"r{k}" / f"lines_{idx:03d}")
+                   for idx, c in enumerate(job.clips)]
+            passthrough = plan_passthrough(vfs, [c.meta for c in job.clips])
+            codec_args = [COPY_ARGS] * n if passthrough else [["-vf", vf, *job.encode.video_args()] for vf in vfs]
+            keys = [part_key(c.sha256, vf, part_codec(codec, None if passthrough else audio, c.meta))
+                    for c, vf, codec in zip(job.clips, vfs, codec_args)]
+            checkpoint = ExportCheckpoint(keys, {"layout": job.layout, "name": job.name, "output": job.output,
+                                                 "clips": [c.name for c in job.clips], "engine": "multi"})
+            runs.callback(checkpoint.release)
+            part_cache = shared_cache or PartCache(checkpoint.dir / "parts", PART_CACHE_MAX_BYTES)
+            if checkpoint.resumed:
+                reporter.notice(f"{out_path.name}: 前回止まった書き出しの続きから再開します（完了済み {checkpoint.resumed}/{n} パーツ）。")
+            parts = []
+            for pos, key in enumerate(keys):
+                done = checkpoint.finished(pos)
+                parts.append(done or part_cache.lookup(key))
+                if done is None and parts[pos] is not None:
+                    checkpoint.mark_done(pos, parts[pos])
+            rends.append(_Rendition(job, out_path, vfs, passthrough, keys, checkpoint, part_cache, parts))
+
+        cmds, labels, durations = [], [], []
+        cmd_outputs = []  # コマンド → (クリップの位置, [(レイアウト, 書き込み中のパス)])
+        for i, clip in enumerate(base.clips):
+            outputs, pending = [], []
+            for rd in rends:
+                if rd.parts[i] is not None:
+                    continue
+                tmp = rd.part_cache.tmp_path(rd.keys[i])
+                if rd.passthrough:
+                    outputs.append((None, COPY_ARGS, tmp))
+                else:
+                    outputs.append((rd.vfs[i], [*rd.job.encode.video_args(), "-threads", str(threads)], tmp))
+                pending.append((rd, tmp))
+            if not outputs:
+                continue
+            cmds.append(multi_output_cmd(clip.path, outputs, audio, clip.meta))
+            labels.append(f"エンコード クリップ {i + 1}" + (f"（{len(outputs)} 本同時）" if len(outputs) > 1 else ""))
+            durations.append(meta_duration(clip.meta))
+            cmd_outputs.append((i, pending))
+        timer.lap("字幕・キャッシュ準備")
+
+        def _commit(j: int):
+            i, pending = cmd_outputs[j]
+            for rd, tmp in pending:
+                rd.parts[i] = rd.part_cache.commit(rd.keys[i], tmp)
+                rd.checkpoint.mark_done(i, rd.parts[i])
+
+        if cmds:
+            ok, fail_idx, log = _run_parts(cmds, labels, workers, timer, reporter,
+                                           durations=durations, cancel=cancel, on_done=_commit)
+            if not ok:
+                for i, pending in cmd_outputs:
+                    for rd, tmp in pending:
+                        if rd.parts[i] is None:
+                            rd.part_cache.discard(tmp)
+                _check_cancel(cancel)
+                i = cmd_outputs[fail_idx][0]
+                raise RenderError(f"クリップ {i + 1}（{base.clips[i].name}）の処理に失敗しました。", log)
+        if shared_cache is not None:
+            shared_cache.evict(protect={k for rd in rends for k in rd.keys})
+
+        results = []
+        for k, rd in enumerate(rends):
+            missing = sorted(set(rd.checkpoint.missing()) | {i for i, p in enumerate(rd.parts) if p is None or not p.exists()})
+            if missing:
+                raise RenderError(f"{rd.out_path.name}: パーツが揃っていないため連結できません: クリップ "
+                                  + ", ".join(str(i + 1) for i in missing))
+            rd.checkpoint.set_state("concat")
+            ok, log = _concat_copy(rd.parts, tmpdir / f"concat_{k}.txt", rd.out_path, cancel)
+            _check_cancel(cancel)
+            if not ok:
+                raise RenderError(f"{rd.out_path.name} の結合に失敗しました。", log)
+            timer.lap(f"連結 {rd.out_path.name}")
+            rd.checkpoint.remove()
+            results.append(RenderResult(rd.out_path, timer, engine="multi",
+                                        cache_stats=shared_cache.stats_text() if shared_cache is not None else ""))
+        results[0].renditions = results[1:]
+        return results[0]
+
+def preview_segments(job: Job) -> Tuple[Optional[List[Tuple[int, float, float]]], float]:
+    """
+    プレビューでエンコードする (idx, クリップ内の開始秒, 秒数) と、結合後の開始位置。
+    horizontal は範囲に掛かるクリップだけ、shorts は各クリップの先頭 N 秒。
+    horizontal で尺が分からなければ None（全体を作ってからトリム）。
+    """
+    pv = job.preview
+    durations = [meta_duration(c.meta) for c in job.clips]
+    if job.layout == "shorts":
+        return [(i, 0.0, min(pv.seconds, d) if d > 0 else float(pv.seconds)) for i, d in enumerate(durations)], 0.0
+    start = preview_window_start(durations, pv.anchor, float(pv.seconds), pv.offset, pv.join)
+    if start is None:
+        start = 0.0
+    window = plan_preview_window(durations, start, float(pv.seconds))
+    if window is not None:
+        start = sum(durations[:window[0][0]]) + window[0][1]
+    return window, start
+
+@_tracked("preview")
+def render_preview(job: Job, out_path: Path, workers: Optional[int] = None, use_part_cache: bool = True,
+                   reporter: Optional[Reporter] = None, cpus: Optional[int] = None,
+                   cancel: Optional[CancelToken] = None) -> RenderResult:
+    """低解像度・高速設定のプレビュー。必要な区間だけを -ss/-t でエンコードして連結する"""
+    reporter = reporter or Reporter()
+    workers = _job_workers(workers, cpus)
+    timer = StageTimer()
+    prepare_clips(job)
+    out_path = Path(out_path)
+    pv = job.preview
+    window, start = preview_segments(job)
+    if job.layout == "horizontal" and pv.anchor == "join" and window is None:
+        reporter.notice("クリップの尺が取得できないため、つなぎ目ではなく先頭からプレビューします。")
+    if job.layout == "shorts":
+        enc_args = ["-c:v", "libx264", "-crf", "28", "-preset", "veryfast"]
+        pv_height = 960 if pv.downscale else None
+    else:
+        pv_crf = 28 if pv.fast else max(20, min(30, job.encode.crf))
+        pv_preset = "ultrafast" if pv.fast else job.encode.preset
+        enc_args = ["-c:v", "libx264", "-crf", str(pv_crf), "-preset", pv_preset]
+        pv_height = 480 if pv.downscale else None
+
+    with tempfile.TemporaryDirectory(prefix="concat_preview_") as tmpd:
+        tmpdir = Path(tmpd)
+        part_cache = _open_part_cache(use_part_cache, tmpdir)
+        segments = window if window is not None else [(i, 0.0, 0.0) for i in range(len(job.clips))]
+        threads = x264_threads_for(workers, cpus)
+        vfs, seg_args, codec_args = [], [], []
+        for idx, seg_start, seg_len in segments:
+            # 縮小（任意）は字幕より前。字幕は縮小後の解像度に合わせて描く
+            vf = caption_vf(job.layout, job.captions, job.clips[idx], tmpdir / f"lines_{idx:03d}", pv_height)
+            vfs.append(vf)
+            seg_args.append(["-ss", f"{seg_start:g}", "-t", f"{seg_len:g}"] if seg_len else [])
+            codec_args.append(["-vf", vf, *enc_args])
+        audio = plan_audio([job.clips[idx].meta for idx, _, _ in segments])
+        if audio.mode == "copy" and any(seg_args):
+            # -ss/-t で切り出すパーツを -c:a copy にすると音声が切り口で切れず（前のパケットから始まる）尺がずれるので、
+            # 区間プレビューは copy できる形式でも作り直して揃える
+            audio = AudioPlan("encode", audio.sample_rate, audio.channels)
+        seg_durations = [s[2] or meta_duration(job.clips[s[0]].meta) for s in segments]
+        stream = None
+        if pv.stream and window is not None:
+            # 仕上がったパーツから HLS に足していき、残りのエンコード中に先頭から再生できるようにする
+            stream = HlsPreview(out_path.with_suffix(".m3u8"), seg_durations, cancel=cancel, on_ready=reporter.stream)
+        elif pv.stream:
+            reporter.notice("クリップの尺が取得できないため、全体を作ってから再生します。")
+        parts = _encode_parts(job, vfs, seg_args, codec_args, part_cache, workers, timer, reporter,
+                              [s[0] for s in segments], seg_durations, cancel, audio=audio,
+                              on_part=stream.add if stream is not None else None, threads=threads)
+        if stream is not None:
+            stream.finish()
+
+        concat_all = out_path if window is not None else tmpdir / "preview_all.mp4"
+        ok, log = _concat_copy(parts, tmpdir / "concat_prev.txt", concat_all, cancel)
+        _check_cancel(cancel)
+        if not ok:
+            raise RenderError("プレビューの連結に失敗しました。", log)
+        timer.lap("連結")
+        engine = "per_clip" if job.layout == "shorts" else "window"
+
+        # 尺が分からなかったときだけ、全体から範囲を切り出す
+        if window is None:
+            engine = "trim"
+            trim = ["-ss", f"{start:g}", "-t", str(int(pv.seconds))]
+            ok, log = run_ffmpeg([get_ffmpeg_exe(), "-y", *trim, "-i", str(concat_all), "-c", "copy", str(out_path)],
+                                 cancel=cancel)
+            _check_cancel(cancel)
+            if not ok:
+                # stream copy が合わない場合の超高速再エンコード
+                ok2, log2 = run_ffmpeg([
+                    get_ffmpeg_exe(), "-y", *trim,
+                    "-i", str(concat_all),
+                    "-c:v", "libx264", "-preset", "ultrafast", "-crf", "30",
+                    "-c:a", "aac",
+                    "-movflags", "+faststart",
+                    str(out_path)
+                ], cancel=cancel)
+                _check_cancel(cancel)
+                if not ok2:
+                    raise RenderError("プレビューのトリムに失敗しました。", f"{log}\n{log2}")
+            timer.lap("トリム")
+        return RenderResult(out_path, timer, engine=engine, start=start, window=window or [],
+                            cache_stats=part_cache.stats_text() if use_part_cache else "")
+
+@_tracked("stills")
+def render_stills(job: Job, seconds: float, workers: Optional[int] = None) -> Tuple[List[Tuple[Optional[Path], str]], StageTimer]:
+    """各クリップ1枚の字幕入り静止画（JPEG）。戻り値: ([(JPEG, 失敗時のログ)], 所要時間)"""
+    workers = int(workers or default_workers())
+    timer = StageTimer()
+    prepare_clips(job)
+    still_height = 960 if job.layout == "shorts" else 540
+    with tempfile.TemporaryDirectory(prefix="concat_still_") as tmpd:
+        tmpdir = Path(tmpd)
+        stills = []
+        for idx, c in enumerate(job.clips):
+            vf = caption_vf(job.layout, job.captions, c, tmpdir / f"lines_{idx:03d}", still_height)
+            stills.append((c.path, c.sha256, vf, still_time(c, seconds)))
+        timer.lap("字幕準備")
+        # 1クリップ1フレームなので、キャッシュに無いものもクリップ数ぶん並列に作る
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            results = list(ex.map(lambda s: contextvars.copy_context().run(render_still, *s), stills))
+        timer.lap("静止画")
+    evict_stills()
+    return results, timer
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+プロセス内のレンダリング・キュー。同時に走るジョブ数と x264 のスレッド数の合計を抑える。
+
+- 待ち行列からはプレビューを書き出しより先に取り出す
+- 同じ種類の中では、実行中のジョブが少ないセッション → 最後に順番が回ってきたのが古いセッション → 投入順
+- 状態は status() でいつでも取れる（Streamlit の再実行をブロックしない）
+- cancel() で待ち行列から外す／実行中の ffmpeg を止める
+"""
+import itertools, os, threading, time, uuid
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from .ffmpeg import CancelToken
+from .jobs import Job
+from .render import RenderCancelled, RenderError, RenderResult, Reporter, render_export, render_preview
+from .store import ClipStore
+
+# 同時に走らせるジョブ数と、全ジョブで分け合う CPU スレッド数
+CPU_BUDGET = int(os.environ.get("MOVIE_CONNECTER_CPU_BUDGET") or os.cpu_count() or 1)
+MAX_JOBS = int(os.environ.get("MOVIE_CONNECTER_MAX_JOBS") or max(1, min(4, CPU_BUDGET // 4)))
+STATUS_TTL_SECONDS = 3600  # 終わったジョブの状態を残す時間
+
+# 種類ごとの優先度（小さいほど先）と処理
+JOB_KINDS: Dict[str, int] = {"preview": 0, "export": 1}
+_RENDERERS: Dict[str, Callable[..., RenderResult]] = {"preview": render_preview, "export": render_export}
+
+@dataclass
+class JobStatus:
+    id: str
+    session: str
+    kind: str                   # preview / export
+    name: str = ""
+    state: str = "queued"       # queued / running / done / failed / cancelled
+    fraction: float = 0.0
+    text: str = ""
+    position: int = 0           # queued のとき、自分より前に待っているジョブ数
+    notices: List[str] = field(default_factory=list)
+    stream: Optional[Path] = None  # 段階再生のプレイリスト（プレビューで最初のセグメントができたら）
+    result: Optional[RenderResult] = None
+    error: str = ""
+    log: str = ""
+    submitted: float = field(default_factory=time.time)
+    started: float = 0.0
+    finished: float = 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("done", "failed", "cancelled")
+
+class _StatusReporter(Reporter):
+    """render_* の進捗をジョブの状態に書き込む（ワーカースレッドから呼ばれる）"""
+    def __init__(self, scheduler: "Scheduler", status: JobStatus):
+        self.scheduler = scheduler
+        self.status = status
+
+    def progress(self, fraction: float, text: str):
+        with self.scheduler.lock:
+            self.status.fraction, self.status.text = fraction, text
+
+    def clear(self):
+        with self.scheduler.lock:
+            self.status.text = ""
+
+    def notice(self, text: str):
+        with self.scheduler.lock:
+            self.status.notices.append(text)
+
+    def stream(self, playlist: Path):
+        with self.scheduler.lock:
+            self.status.stream = playlist
+
+@dataclass
+class _Pending:
+    status: JobStatus
+    job: Job
+    out_path: Path
+    kwargs: dict
+    seq: int
+    cancel: CancelToken = field(default_factory=CancelToken)
+    clip_store: Optional[ClipStore] = None
+    held: List[str] = field(default_factory=list)  # clip_store.hold で参照を付けたクリップ
+
+    def release_clips(self):
+        if self.clip_store is not None:
+            self.clip_store.unhold(self.held)
+            self.held = []
+
+class Scheduler:
+    """
+    max_jobs 本のディスパッチ用スレッドが待ち行列からジョブを取り、ffmpeg を子プロセスとして実行する。
+    各ジョブには cpu_budget / max_jobs の CPU スレッドを割り当てる（x264 の -threads と並列数をこの範囲に収める）。
+    """
+    def __init__(self, max_jobs: int = MAX_JOBS, cpu_budget: int = CPU_BUDGET):
+        self.max_jobs = max(1, int(max_jobs))
+        self.cpus_per_job = max(1, int(cpu_budget) // self.max_jobs)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.queue: List[_Pending] = []
+        self.jobs: Dict[str, JobStatus] = {}
+        self.tokens: Dict[str, CancelToken] = {}  # 実行中のジョブ → キャンセル用
+        self.running: Dict[str, int] = {}     # セッション → 実行中のジョブ数
+        self.last_turn: Dict[str, float] = {}  # セッション → 最後にジョブを開始した時刻
+        self.seq = itertools.count()
+        for n in range(self.max_jobs):
+            threading.Thread(target=self._worker, name=f"concat-scheduler-{n}", daemon=True).start()
+
+    def submit(self, session: str, kind: str, job: Job, out_path: Path,
+               clip_store: Optional[ClipStore] = None, **kwargs) -> str:
+        """
+        ジョブを待ち行列に入れて ID を返す。kwargs は render_export / render_preview にそのまま渡す。
+        clip_store を渡すと、ジョブが終わるまでクリップのファイルを消さないように参照を付けておく。
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f"kind は {' / '.join(JOB_KINDS)} のどれかです: {kind!r}")
+        status = JobStatus(id=uuid.uuid4().hex, session=session, kind=kind, name=job.name or Path(out_path).name)
+        pending = _Pending(status, job, Path(out_path), kwargs, next(self.seq), clip_store=clip_store)
+        if clip_store is not None:
+            jobs = [job, *[j for j, _ in kwargs.get("renditions", ())]]
+            pending.held = clip_store.hold(c.path for j in jobs for c in j.clips)
+        with self.cond:
+            self._forget_old()
+            self.jobs[status.id] = status
+            self.queue.append(pending)
+            self.cond.notify()
+        return status.id
+
+    def status(self, job_id: str) -> Optional[JobStatus]:
+        """その時点の状態のコピー（無ければ None）"""
+        with self.lock:
+            status = self.jobs.get(job_id)
+            if status is None:
+                return None
+            if status.state == "queued":
+                order = sorted(self.queue, key=self._priority)
+                status.position = next(n for n, p in enumerate(order) if p.status is status)
+            return replace(status, notices=list(status.notices))
+
+    def cancel(self, job_id: str):
+        """待っていれば待ち行列から外し、実行中なら ffmpeg を止める（終わっていれば何もしない）"""
+        with self.lock:
+            status = self.jobs.get(job_id)
+            if status is None or status.done:
+                return
+            queued = next((p for p in self.queue if p.status is status), None)
+            if queued is not None:
+                self.queue.remove(queued)
+                status.state, status.finished = "cancelled", time.time()
+            token = self.tokens.get(job_id)
+        if queued is not None:
+            queued.release_clips()
+        elif token is not None:
+            token.cancel()
+
+    def wait(self, job_id: str, reporter: Optional[Reporter] = None, poll: float = 0.5) -> RenderResult:
+        """
+        終わるまで待って結果を返す（失敗なら RenderError）。
+        待っている間の進捗・お知らせは呼び出し元のスレッドで reporter に流す。
+        """
+        reporter = reporter or Reporter()
+        n_notices = 0
+        while True:
+            s = self.status(job_id)
+            if s is None:
+                raise RenderError("ジョブが見つかりません。")
+            for text in s.notices[n_notices:]:
+                reporter.notice(text)
+            n_notices = len(s.notices)
+            if s.done:
+                reporter.clear()
+                if s.state == "cancelled":
+                    raise RenderCancelled()
+                if s.state == "failed":
+                    raise RenderError(s.error, s.log)
+                return s.result
+            if s.state == "queued":
+                reporter.progress(0.0, f"順番待ち…（前に {s.position} 件）")
+            elif s.text:
+                reporter.progress(min(1.0, s.fraction), s.text)
+            time.sleep(poll)
+
+    def _priority(self, p: _Pending):
+        session = p.status.session
+        return (JOB_KINDS[p.status.kind], self.running.get(session, 0), self.last_turn.get(session, 0.0), p.seq)
+
+    def _forget_old(self):
+        limit = time.time() - STATUS_TTL_SECONDS
+        for job_id in [k for k, s in self.jobs.items() if s.done and s.finished < limit]:
+            del self.jobs[job_id]
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                p = min(self.queue, key=self._priority)
+                self.queue.remove(p)
+                session = p.status.session
+                self.running[session] = self.running.get(session, 0) + 1
+                self.last_turn[session] = time.time()
+                p.status.state, p.status.started = "running", time.time()
+                self.tokens[p.status.id] = p.cancel
+            try:
+                render = _RENDERERS[p.status.kind]
+                result = render(p.job, p.out_path, reporter=_StatusReporter(self, p.status),
+                                cpus=self.cpus_per_job, cancel=p.cancel, **p.kwargs)
+                outcome = {"state": "done", "result": result}
+            except RenderCancelled:
+                # 書きかけの出力は残さない
+                p.out_path.unlink(missing_ok=True)
+                outcome = {"state": "cancelled"}
+            except RenderError as e:
+                outcome = {"state": "failed", "error": str(e), "log": e.log}
+            except Exception as e:
+                outcome = {"state": "failed", "error": f"予期しないエラー: {e}"}
+            p.release_clips()
+            with self.cond:
+                for k, v in outcome.items():
+                    setattr(p.status, k, v)
+                p.status.finished = time.time()
+                self.running[session] -= 1
+                self.tokens.pop(p.status.id, None)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""アップロードされたクリップ・フォントのディスク保存（中身のハッシュで重複排除）"""
+import hashlib, os, threading, time, uuid
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .cache import CACHE_ROOT
+
+CLIP_TTL_SECONDS = float(os.environ.get("MOVIE_CONNECTER_CLIP_TTL_H", "24")) * 3600
+SWEEP_INTERVAL_SECONDS = 600  # 期限切れの掃除を put / touch のついでに行う間隔
+
+class ClipStore:
+    """
+    アップロード動画をディスクへ一度だけ書き出し、SHA-256（書き込みながら計算）で重複排除して保持する。
+    セッションから外されて参照が 0 になったファイルは、実行待ち・実行中のジョブが使っていなければ削除する。
+    セッションは再実行のたびに touch で使用中の印（mtime）を付ける。閉じたセッションの分は更新されなくなり、
+    ttl_seconds を過ぎたらジョブが使っていない限り参照ごと削除する。
+    """
+    CHUNK = 4 * 1024 * 1024
+
+    def __init__(self, root: Path, ttl_seconds: float):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.refs: Dict[str, int] = {}    # セッションの行からの参照
+        self.holds: Dict[str, int] = {}   # 実行待ち・実行中のジョブからの参照
+        self.last_sweep = 0.0
+        self.sweep(ttl_seconds)
+
+    def _find(self, digest: str) -> Optional[Path]:
+        for p in self.root.glob(f"{digest}.*"):
+            return p
+        return None
+
+    def put(self, fileobj, suffix: str) -> Tuple[str, Path, int]:
+        """ファイルオブジェクトをチャンク単位で保存し (sha256, 保存先, サイズ) を返す"""
+        h = hashlib.sha256()
+        size = 0
+        tmp = self.root / f".{uuid.uuid4().hex}.upload"
+        fileobj.seek(0)
+        with open(tmp, "wb") as out:
+            for chunk in iter(lambda: fileobj.read(self.CHUNK), b""):
+                h.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        digest = h.hexdigest()
+        with self.lock:
+            path = self._find(digest)
+            if path is None:
+                path = self.root / f"{digest}{suffix.lower() or '.bin'}"
+                os.replace(tmp, path)
+            else:
+                tmp.unlink()
+                os.utime(path)
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+        self._maybe_sweep()
+        return digest, path, size
+
+    def _unlink_unused(self, digest: str):
+        """セッションにもジョブにも参照されていなければファイルを消す（lock を持って呼ぶ）"""
+        if self.refs.get(digest) or self.holds.get(digest):
+            return
+        path = self._find(digest)
+        if path is not None:
+            path.unlink(missing_ok=True)
+
+    def release(self, digest: str):
+        """セッションの行からの参照を1つ外す（期限切れで参照ごと消えていれば何もしない）"""
+        with self.lock:
+            if digest not in self.refs:
+                return
+            n = self.refs[digest] - 1
+            if n > 0:
+                self.refs[digest] = n
+                return
+            self.refs.pop(digest, None)
+            self._unlink_unused(digest)
+
+    def hold(self, paths: Iterable[str]) -> List[str]:
+        """
+        ジョブが使うクリップのファイルを、unhold されるまで消さないようにする。
+        このストアのファイルだけが対象で、参照を付けたハッシュを返す（unhold にそのまま渡す）
+        """
+        digests = []
+        with self.lock:
+            for path in paths:
+                p = Path(path)
+                if p.parent.resolve() != self.root.resolve() or not p.exists():
+                    continue
+                digest = p.name.split(".")[0]
+                self.holds[digest] = self.holds.get(digest, 0) + 1
+                digests.append(digest)
+        return digests
+
+    def unhold(self, digests: Iterable[str]):
+        """hold の参照を外し、セッションからも外されていたファイルはここで消す"""
+        with self.lock:
+            for digest in digests:
+                n = self.holds.get(digest, 0) - 1
+                if n > 0:
+                    self.holds[digest] = n
+                    continue
+                self.holds.pop(digest, None)
+                self._unlink_unused(digest)
+
+    def touch(self, digests: Iterable[str]) -> Set[str]:
+        """セッションで使用中のクリップの mtime を更新し、ファイルが残っているハッシュを返す"""
+        alive = set()
+        with self.lock:
+            for digest in digests:
+                path = self._find(digest)
+                if path is None:
+                    continue
+                try:
+                    os.utime(path)
+                except OSError:
+                    continue
+                alive.add(digest)
+        self._maybe_sweep()
+        return alive
+
+    def _maybe_sweep(self):
+        if time.time() - self.last_sweep >= SWEEP_INTERVAL_SECONDS:
+            self.sweep(self.ttl_seconds)
+
+    def sweep(self, ttl_seconds: float):
+        """
+        ttl_seconds のあいだ使われていないファイル（閉じたセッションの分や前回起動の残りなど）を参照ごと削除。
+        実行待ち・実行中のジョブが使っているファイルは残す
+        """
+        now = time.time()
+        with self.lock:
+            self.last_sweep = now
+            for p in self.root.iterdir():
+                digest = p.name.split(".")[0]
+                if digest in self.holds:
+                    continue
+                try:
+                    if now - p.stat().st_mtime > ttl_seconds:
+                        p.unlink()
+                        self.refs.pop(digest, None)
+                except OSError:
+                    pass
+
+def store_font(data: bytes, name: str) -> Path:
+    """
+    アップロードされたフォントを CACHE_ROOT/fonts に中身のハッシュ名で保存してパスを返す。
+    一時ディレクトリと違って消えないので、バックグラウンドのジョブやマニフェストからも参照できる。
+    """
+    root = CACHE_ROOT / "fonts"
+    root.mkdir(parents=True, exist_ok=True)
+    path = root / f"{hashlib.sha256(data).hexdigest()}{Path(name).suffix.lower() or '.ttf'}"
+    if not path.exists():
+        tmp = root / f".{uuid.uuid4().hex}.tmp"
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    return path
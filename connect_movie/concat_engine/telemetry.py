@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+リソース使用量の記録。ffmpeg の子プロセス1回ごと・ジョブ（render_* の呼び出し）1件ごとに
+経過時間・CPU 時間・ピーク RSS・読み書きしたバイト数・エンコード fps を JSON Lines へ追記し、
+累計は Prometheus のテキスト形式で返す（127.0.0.1 で待ち受ける /metrics。outputs.serve_metrics）。
+"""
+import contextvars, json, os, threading, time, uuid
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .cache import CACHE_ROOT
+
+_TELEMETRY_ENV = os.environ.get("MOVIE_CONNECTER_TELEMETRY", "")
+TELEMETRY_PATH: Optional[Path] = (None if _TELEMETRY_ENV == "0" else
+                                  Path(_TELEMETRY_ENV) if _TELEMETRY_ENV else CACHE_ROOT / "telemetry" / "events.jsonl")
+TELEMETRY_MAX_BYTES = int(float(os.environ.get("MOVIE_CONNECTER_TELEMETRY_MB", "50")) * 1024 ** 2)
+METRIC_PREFIX = "movie_connecter_"
+
+@dataclass
+class ProcessUsage:
+    """ffmpeg 1回分。取れない環境の項目は None"""
+    output: str                          # 出力ファイル名（null 出力なら "-"）
+    ok: bool
+    wall_s: float
+    cpu_s: Optional[float] = None        # 子プロセスの user + sys
+    peak_rss_mb: Optional[float] = None
+    read_bytes: Optional[int] = None
+    written_bytes: Optional[int] = None
+    frames: int = 0
+    fps: float = 0.0                     # frames / wall_s
+    errors: List[str] = field(default_factory=list)  # 失敗したときのエラー行
+    failed_filter: str = ""
+    worker: str = ""                     # リモートのワーカーで動いたときはその host:port
+
+class JobUsage:
+    """1ジョブの中で動いた ffmpeg をまとめる。state は呼び出し側が done / cancelled に書き換える（既定は failed）"""
+    def __init__(self, kind: str, name: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.name = name
+        self.state = "failed"
+        self.t0 = time.perf_counter()
+        self.lock = threading.Lock()
+        self.procs: List[ProcessUsage] = []
+        self.record: Optional[dict] = None  # 終わったら summary() の結果
+
+    def add(self, usage: ProcessUsage):
+        with self.lock:
+            self.procs.append(usage)
+
+    def summary(self) -> dict:
+        wall = time.perf_counter() - self.t0
+        with self.lock:
+            procs = list(self.procs)
+
+        def _sum(name: str):
+            values = [getattr(p, name) for p in procs if getattr(p, name) is not None]
+            return sum(values) if values else None
+
+        rss = [p.peak_rss_mb for p in procs if p.peak_rss_mb is not None]
+        cpu = _sum("cpu_s")
+        frames = sum(p.frames for p in procs)
+        return {
+            "job": self.id, "kind": self.kind, "name": self.name, "state": self.state,
+            "wall_s": round(wall, 3),
+            "cpu_s": round(cpu, 3) if cpu is not None else None,
+            "peak_rss_mb": max(rss) if rss else None,
+            "read_bytes": _sum("read_bytes"),
+            "written_bytes": _sum("written_bytes"),
+            "frames": frames,
+            "fps": round(frames / wall, 1) if wall > 0 else 0.0,
+            "ffmpeg_runs": len(procs),
+        }
+
+# 今のスレッド（とそこから投げたワーカー）が処理しているジョブ
+_current_job: contextvars.ContextVar[Optional[JobUsage]] = contextvars.ContextVar("concat_job", default=None)
+
+# ---------------- JSON Lines ----------------
+_write_lock = threading.Lock()
+
+def _append(record: dict):
+    """1件追記。上限を超えたら .1 に回して新しいファイルにする。書けなくてもレンダリングは止めない"""
+    if TELEMETRY_PATH is None:
+        return
+    line = json.dumps({"ts": round(time.time(), 3), **record}, ensure_ascii=False) + "\n"
+    with _write_lock:
+        try:
+            TELEMETRY_PATH.parent.mkdir(parents=True, exist_ok=True)
+            if TELEMETRY_PATH.exists() and TELEMETRY_PATH.stat().st_size > TELEMETRY_MAX_BYTES:
+                os.replace(TELEMETRY_PATH, TELEMETRY_PATH.with_name(TELEMETRY_PATH.name + ".1"))
+            with TELEMETRY_PATH.open("a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError:
+            pass
+
+# ---------------- Prometheus ----------------
+_METRICS_HELP = {
+    "ffmpeg_runs_total": ("counter", "ffmpeg の実行回数"),
+    "ffmpeg_wall_seconds_total": ("counter", "ffmpeg の経過時間の合計"),
+    "ffmpeg_cpu_seconds_total": ("counter", "ffmpeg の CPU 時間（user + sys）の合計"),
+    "ffmpeg_read_bytes_total": ("counter", "ffmpeg が読んだバイト数の合計"),
+    "ffmpeg_written_bytes_total": ("counter", "ffmpeg が書いたバイト数の合計"),
+    "ffmpeg_frames_total": ("counter", "ffmpeg が出力したフレーム数の合計"),
+    "ffmpeg_peak_rss_bytes": ("gauge", "ffmpeg 1回のピーク RSS の最大値"),
+    "jobs_total": ("counter", "終わったジョブの数"),
+    "jobs_running": ("gauge", "実行中のジョブの数"),
+    "job_wall_seconds_total": ("counter", "ジョブの経過時間の合計"),
+    "job_cpu_seconds_total": ("counter", "ジョブ内の ffmpeg の CPU 時間の合計"),
+}
+_metrics_lock = threading.Lock()
+_metrics: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+
+def _inc(name: str, value: Optional[float], **labels):
+    if value is None:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _metrics[key] = _metrics.get(key, 0.0) + value
+
+def _set_max(name: str, value: Optional[float]):
+    if value is None:
+        return
+    key = (name, ())
+    with _metrics_lock:
+        _metrics[key] = max(_metrics.get(key, 0.0), value)
+
+def prometheus_text() -> str:
+    """このプロセスの累計（Prometheus のテキスト形式 0.0.4）"""
+    with _metrics_lock:
+        items = sorted(_metrics.items())
+    lines = []
+    for name, (kind, help_text) in _METRICS_HELP.items():
+        rows = [(labels, v) for (n, labels), v in items if n == name]
+        if not rows:
+            continue
+        lines += [f"# HELP {METRIC_PREFIX}{name} {help_text}", f"# TYPE {METRIC_PREFIX}{name} {kind}"]
+        for labels, v in rows:
+            label_text = ",".join(f'{k}="{val}"' for k, val in labels)
+            value = f"{v:.15g}"
+            lines.append(f"{METRIC_PREFIX}{name}{{{label_text}}} {value}" if label_text else f"{METRIC_PREFIX}{name} {value}")
+    return "\n".join(lines) + "\n"
+
+# ---------------- Recording ----------------
+def record_process(usage: ProcessUsage):
+    """ffmpeg 1回分を記録し、実行中のジョブがあればそれにも足す"""
+    job = _current_job.get()
+    if job is not None:
+        job.add(usage)
+    record = {"type": "ffmpeg", "job": job.id if job is not None else None, **asdict(usage)}
+    if usage.ok:
+        record.pop("errors")
+        record.pop("failed_filter")
+    if not usage.worker:
+        record.pop("worker")
+    _append(record)
+    _inc("ffmpeg_runs_total", 1, ok=str(usage.ok).lower())
+    _inc("ffmpeg_wall_seconds_total", usage.wall_s)
+    _inc("ffmpeg_cpu_seconds_total", usage.cpu_s)
+    _inc("ffmpeg_read_bytes_total", usage.read_bytes)
+    _inc("ffmpeg_written_bytes_total", usage.written_bytes)
+    _inc("ffmpeg_frames_total", usage.frames)
+    _set_max("ffmpeg_peak_rss_bytes", usage.peak_rss_mb * 1024 ** 2 if usage.peak_rss_mb is not None else None)
+
+@contextmanager
+def job_span(kind: str, name: str) -> Iterator[JobUsage]:
+    """
+    この中（と run_ffmpeg_parallel などで投げたワーカー）で動いた ffmpeg を1ジョブとしてまとめ、抜けるときに記録する。
+    まとめた結果は span.record に入る。
+    """
+    span = JobUsage(kind, name)
+    token = _current_job.set(span)
+    _inc("jobs_running", 1, kind=kind)
+    try:
+        yield span
+    finally:
+        _current_job.reset(token)
+        _inc("jobs_running", -1, kind=kind)
+        span.record = span.summary()
+        _append({"type": "job", **span.record})
+        _inc("jobs_total", 1, kind=kind, state=span.state)
+        _inc("job_wall_seconds_total", span.record["wall_s"], kind=kind)
+        _inc("job_cpu_seconds_total", span.record["cpu_s"], kind=kind)
+
+def format_usage(record: Optional[dict]) -> str:
+    """ジョブの記録を1行に（アプリの表示用）"""
+    if not record:
+        return ""
+    parts = [f"ffmpeg {record['ffmpeg_runs']} 回"]
+    if record.get("cpu_s") is not None:
+        parts.append(f"CPU {record['cpu_s']:.1f} 秒")
+    if record.get("peak_rss_mb") is not None:
+        parts.append(f"ピーク RSS {record['peak_rss_mb']:.0f} MB")
+    if record.get("read_bytes") is not None:
+        parts.append(f"読み込み {record['read_bytes'] / 1024 ** 2:.0f} MB")
+    if record.get("written_bytes") is not None:
+        parts.append(f"書き込み {record['written_bytes'] / 1024 ** 2:.0f} MB")
+    if record.get("frames"):
+        parts.append(f"{record['fps']:.0f} fps")
+    return " · ".join(parts)